@@ -23,7 +23,15 @@ import os
 import asyncio
 import argparse
 
-from common.action import audio_convert, image_convert, file_copy
+from audio_converter.backend import backend_selector
+from common.admission import admission_controller
+from common.archive import archive_source
+from common.config import config
+from common.io_scheduler import io_scheduler
+from common.pipeline import Pipeline
+from common.tracer import tracer
+from common.router import Router
+from common.action import audio_convert, image_convert, file_copy, lossy_copy
 
 
 async def dispatcher(src_path, dst_path, worker_num):
@@ -49,40 +57,51 @@ async def dispatcher(src_path, dst_path, worker_num):
         'heif': file_copy,
         'heic': file_copy,
 
-        'mp3': file_copy,
-        'm4a': file_copy,
+        'mp3': lossy_copy,
+        'm4a': lossy_copy,
         'aac': file_copy,
-        'ogg': file_copy,
-        'opus': file_copy,
+        'ogg': lossy_copy,
+        'opus': lossy_copy,
 
         'mkv': file_copy,
         'avi': file_copy,
         'mp4': file_copy,
     }
 
-    semaphore = asyncio.Semaphore(worker_num)
-    workers_list = []
+    action_handlers = {
+        'audio': {'transcode': audio_convert, 'recompress': audio_convert, 'copy': lossy_copy},
+        'image': {'transcode': image_convert, 'recompress': image_convert, 'copy': file_copy},
+        'video': {'copy': file_copy},
+    }
+    router = Router(ext_handler, action_handlers, config.get('routing_config', {}).get('lossy_rules', []))
 
-    for path, _, file_names in os.walk(src_path):
-        for file_name in file_names:
-            ext = os.path.splitext(file_name)[1].strip('.')
-            handler = ext_handler.get(ext)
-            if handler is not None:
-                worker = asyncio.create_task(handler(semaphore, os.path.join(path, file_name), src_path, dst_path))
-                workers_list.append(worker)
-            await asyncio.sleep(0)
+    async with Pipeline(worker_num, [dst_path], [config.get('audio_codec', 'opus')]) as pipeline:
+        semaphore = pipeline.semaphore
+        dst_path = pipeline.dst_paths[0]
 
-    await asyncio.gather(*workers_list)
+        async def route_job(file_path):
+            if (handler := await router.route(file_path)) is not None:
+                job = io_scheduler.run(file_path, handler(semaphore, file_path, src_path, dst_path))
+                await admission_controller.run(file_path, job)
 
-    print('all done !')
+        for path, _, file_names in archive_source.walk(src_path):
+            album_jobs = []
+            for file_name in file_names:
+                album_jobs.append(pipeline.add_job(route_job(os.path.join(path, file_name))))
+                await asyncio.sleep(0)
+            pipeline.add_album(path, src_path, file_names, album_jobs)
 
 
 def main():
     args_parser = argparse.ArgumentParser()
     args_parser.add_argument('-n', '--worker_num', default=4, type=int)
+    args_parser.add_argument('--trace', metavar='TRACE_PATH')
+    args_parser.add_argument('--calibrate', action='store_true')
     args_parser.add_argument('src_path')
     args_parser.add_argument('dst_path')
     args = args_parser.parse_args()
+    tracer.setup(args.trace)
+    backend_selector.setup(args.calibrate)
     asyncio.run(dispatcher(args.src_path, args.dst_path, args.worker_num))
 
 
@@ -22,20 +22,35 @@
 import os
 import asyncio
 import argparse
+import functools
 
-from common.action import audio_convert_lossless, image_convert_lossless, file_copy
+from audio_converter.backend import backend_selector
+from common.admission import admission_controller
+from common.archive import archive_source
+from common.config import config
+from common.deadline import deadline_controller
+from common.io_scheduler import io_scheduler
+from common.pipeline import Pipeline
+from common.tracer import tracer
+from common.router import Router
+from audio_converter.verifier import pcm_verifier
+from common.action import audio_convert_lossless, audio_convert_hybrid, image_convert_lossless, file_copy, lossless_copy
 
 
-async def dispatcher(src_path, dst_path, worker_num):
+async def dispatcher(src_path, dst_path, worker_num, verify, portable_path):
+    audio_handler = audio_convert_lossless
+    if portable_path is not None:
+        audio_handler = functools.partial(audio_convert_hybrid, portable_path=portable_path)
+
     ext_handler = {
-        'wav': audio_convert_lossless,
-        'flac': audio_convert_lossless,
-        'aiff': audio_convert_lossless,
-        'ape': audio_convert_lossless,
-        'tak': audio_convert_lossless,
-        'tta': audio_convert_lossless,
-        'wv': audio_convert_lossless,
-        'alac': audio_convert_lossless,
+        'wav': audio_handler,
+        'flac': audio_handler,
+        'aiff': audio_handler,
+        'ape': audio_handler,
+        'tak': audio_handler,
+        'tta': audio_handler,
+        'wv': audio_handler,
+        'alac': audio_handler,
 
         'png': image_convert_lossless,
         'tiff': image_convert_lossless,
@@ -43,30 +58,55 @@ async def dispatcher(src_path, dst_path, worker_num):
         'bmp': image_convert_lossless,
     }
 
-    semaphore = asyncio.Semaphore(worker_num)
-    workers_list = []
+    action_handlers = {
+        'audio': {'transcode': audio_handler, 'recompress': audio_handler, 'copy': lossless_copy},
+        'image': {'transcode': image_convert_lossless, 'recompress': image_convert_lossless, 'copy': file_copy},
+        'video': {'copy': file_copy},
+    }
+    router = Router(
+        ext_handler, action_handlers, config.get('routing_config', {}).get('lossless_rules', []), file_copy
+    )
 
-    for path, _, file_names in os.walk(src_path):
-        for file_name in file_names:
-            ext = os.path.splitext(file_name)[1].strip('.')
-            if ext != 'cue':
-                handler = ext_handler.get(ext, file_copy)
-                worker = asyncio.create_task(handler(semaphore, os.path.join(path, file_name), src_path, dst_path))
-                workers_list.append(worker)
-            await asyncio.sleep(0)
+    lossless_audio_codec = config.get('lossless_audio_codec', 'flac')
+    extra_paths = [] if portable_path is None else [portable_path]
+    pipeline = Pipeline(worker_num, [dst_path], [lossless_audio_codec], extra_paths, lossless_audio_codec == 'als')
+    async with pipeline:
+        semaphore = pipeline.semaphore
+        dst_path = pipeline.dst_paths[0]
+        if verify:
+            pcm_verifier.setup(worker_num)
 
-    await asyncio.gather(*workers_list)
+        async def route_job(file_path):
+            if (handler := await router.route(file_path)) is not None:
+                job = io_scheduler.run(file_path, handler(semaphore, file_path, src_path, dst_path))
+                await deadline_controller.run(file_path, admission_controller.run(file_path, job))
 
-    print('all done !')
+        for path, _, file_names in archive_source.walk(src_path):
+            album_jobs = []
+            for file_name in file_names:
+                if os.path.splitext(file_name)[1].lower() != '.cue':
+                    album_jobs.append(pipeline.add_job(route_job(os.path.join(path, file_name))))
+                await asyncio.sleep(0)
+            pipeline.add_album(path, src_path, file_names, album_jobs)
 
 
 def main():
     args_parser = argparse.ArgumentParser()
     args_parser.add_argument('-n', '--worker_num', default=4, type=int)
+    args_parser.add_argument('--trace', metavar='TRACE_PATH')
+    args_parser.add_argument('--calibrate', action='store_true')
+    args_parser.add_argument('--deadline')
+    args_parser.add_argument('-V', '--verify', action='store_true')
+    args_parser.add_argument('--portable-dst', metavar='PORTABLE_PATH')
     args_parser.add_argument('src_path')
     args_parser.add_argument('dst_path')
     args = args_parser.parse_args()
-    asyncio.run(dispatcher(args.src_path, args.dst_path, args.worker_num))
+    if args.portable_dst is not None and config.get('lossless_audio_codec', 'flac') != 'wavpack':
+        args_parser.error('--portable-dst needs wavpack as lossless_audio_codec')
+    tracer.setup(args.trace)
+    backend_selector.setup(args.calibrate)
+    deadline_controller.setup(args.deadline)
+    asyncio.run(dispatcher(args.src_path, args.dst_path, args.worker_num, args.verify, args.portable_dst))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,128 @@
+#  py_album_condense - a simple tool to compress and condense your album collections
+#  Copyright (c) 2022 kewenyu
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#  SOFTWARE.
+
+
+import os
+import asyncio
+import argparse
+
+from audio_converter.backend import backend_selector
+from common.admission import admission_controller
+from common.archive import archive_source
+from common.deadline import deadline_controller
+from common.io_scheduler import io_scheduler
+from common.pipeline import Pipeline
+from common.tracer import tracer
+from common.action import audio_convert_multi, image_convert, image_convert_lossless, file_copy
+from common.action import audio_codec_handlers, lossless_audio_codec_handlers
+
+
+async def dispatcher(src_path, targets, worker_num):
+    audio_exts = ['wav', 'flac', 'aiff', 'ape', 'tak', 'tta', 'wv', 'alac']
+
+    ext_handler = {
+        'png': image_convert,
+        'tiff': image_convert,
+        'tif': image_convert,
+        'bmp': image_convert,
+
+        'jpg': file_copy,
+        'jpeg': file_copy,
+        'jp2': file_copy,
+        'webp': file_copy,
+        'heif': file_copy,
+        'heic': file_copy,
+
+        'mp3': file_copy,
+        'm4a': file_copy,
+        'aac': file_copy,
+        'ogg': file_copy,
+        'opus': file_copy,
+
+        'mkv': file_copy,
+        'avi': file_copy,
+        'mp4': file_copy,
+    }
+
+    lossless_ext_handler = {
+        'png': image_convert_lossless,
+        'tiff': image_convert_lossless,
+        'tif': image_convert_lossless,
+        'bmp': image_convert_lossless,
+    }
+
+    codecs = [codec for codec, _ in targets]
+    async with Pipeline(worker_num, [dst_path for _, dst_path in targets], codecs) as pipeline:
+        semaphore = pipeline.semaphore
+        targets = list(zip(codecs, pipeline.dst_paths))
+
+        for path, _, file_names in archive_source.walk(src_path):
+            album_jobs = []
+            for file_name in file_names:
+                file_path = os.path.join(path, file_name)
+                ext = os.path.splitext(file_name)[1].strip('.').lower()
+                if ext in audio_exts:
+                    job = io_scheduler.run(file_path, audio_convert_multi(semaphore, file_path, src_path, targets))
+                    job = admission_controller.run(file_path, job)
+                    album_jobs.append(pipeline.add_job(deadline_controller.run(file_path, job)))
+                else:
+                    for codec, dst_path in targets:
+                        if codec in audio_codec_handlers:
+                            handler = ext_handler.get(ext)
+                        elif ext != 'cue':
+                            handler = lossless_ext_handler.get(ext, file_copy)
+                        else:
+                            handler = None
+
+                        if handler is not None:
+                            job = io_scheduler.run(file_path, handler(semaphore, file_path, src_path, dst_path))
+                            job = admission_controller.run(file_path, job)
+                            album_jobs.append(pipeline.add_job(deadline_controller.run(file_path, job)))
+                await asyncio.sleep(0)
+            pipeline.add_album(path, src_path, file_names, album_jobs)
+
+
+def parse_target(target):
+    codec, _, dst_path = target.partition(':')
+    if codec not in audio_codec_handlers and (codec not in lossless_audio_codec_handlers or codec == 'als'):
+        raise argparse.ArgumentTypeError(f'unsupported target codec: {codec}')
+    if not dst_path:
+        raise argparse.ArgumentTypeError(f'missing destination path for target: {target}')
+    return codec, dst_path
+
+
+def main():
+    args_parser = argparse.ArgumentParser()
+    args_parser.add_argument('-n', '--worker_num', default=4, type=int)
+    args_parser.add_argument('--trace', metavar='TRACE_PATH')
+    args_parser.add_argument('--calibrate', action='store_true')
+    args_parser.add_argument('--deadline')
+    args_parser.add_argument('-t', '--target', action='append', required=True, type=parse_target)
+    args_parser.add_argument('src_path')
+    args = args_parser.parse_args()
+    tracer.setup(args.trace)
+    backend_selector.setup(args.calibrate)
+    deadline_controller.setup(args.deadline)
+    asyncio.run(dispatcher(args.src_path, args.target, args.worker_num))
+
+
+if __name__ == '__main__':
+    main()
@@ -23,10 +23,15 @@ import abc
 import os
 import asyncio
 import json
+import re
 
+from audio_converter.pcm_source import PCMSource
+from common.archive import archive_source
 from common.config import config
-from cue.cue_parser import CueContentParser
-from cue.cue_loader import CueFileLoader
+from common.supervisor import supervisor
+from common.tracer import tracer
+from common.util import PathUtils
+from cue.cue_cache import cue_cache
 
 
 class AudioConverter(metaclass=abc.ABCMeta):
@@ -35,6 +40,11 @@ class AudioConverter(metaclass=abc.ABCMeta):
         self.file_path = file_path
         self.src_path = src_path
         self.dst_path = dst_path
+        self.audio_info = None
+
+    @property
+    def input_path(self):
+        return archive_source.get_input(self.file_path)
 
     @abc.abstractmethod
     async def single_convert(self):
@@ -48,18 +58,181 @@ class AudioConverter(metaclass=abc.ABCMeta):
     def get_ext(self):
         raise NotImplemented
 
+    @classmethod
+    def get_executables(cls):
+        return [config.get('executable', {}).get('ffmpeg', 'ffmpeg')]
+
+    async def chapter_convert(self):
+        await self.single_convert()
+
+        async with tracer.hold(self.semaphore, 'convert with chapters', file=self.file_path):
+            new_file_path = PathUtils.create_file_path_struct(
+                self.file_path, self.src_path, self.dst_path, self.get_ext()
+            )
+            print(f'adding chapters: {new_file_path}')
+
+            chapter_path = f'{new_file_path}.chapters'
+            metadata = await self._create_chapter_file(chapter_path)
+            tmp_file_path = os.path.join(os.path.dirname(new_file_path), f'_tmp_{os.path.basename(new_file_path)}')
+            os.replace(new_file_path, tmp_file_path)
+            await AudioUtils.add_chapters_by_ffmpeg(chapter_path, metadata, tmp_file_path, new_file_path)
+
+    def _get_pcm_source(self, sliced=False, metered=False):
+        containers = self._get_pcm_containers()
+        if not containers or archive_source.split(self.file_path) is not None:
+            return None
+        if os.path.splitext(self.file_path)[1].lower() not in ('.wav', '.aiff', '.aif'):
+            return None
+
+        pcm_source = PCMSource.probe(self.file_path)
+        if pcm_source is None or pcm_source.container not in containers:
+            return None
+        input_format = self._get_input_format()
+        sample_rate = pcm_source.sample_rate
+        if input_format.get('float') or input_format.get('sample_rate', sample_rate) != sample_rate:
+            return None
+        if sample_rate > input_format.get('max_sample_rate', sample_rate):
+            return None
+        if pcm_source.bits_per_sample > input_format.get('max_bit_depth', pcm_source.bits_per_sample):
+            return None
+        # slices and loudness analysis need a wav stream, which aiff can only provide through ffmpeg
+        if pcm_source.container != 'wav' and (sliced or metered):
+            return None
+        return pcm_source
+
+    def _get_pcm_containers(self):
+        return ()
+
+    def get_tee_target(self, new_file_path, metadata):
+        raise NotImplementedError(f'{self.__class__.__name__} does not support multi-target output')
+
+    async def encode(self, new_file_path, meter=None):
+        # the whole-file encode of single_convert, without the slot, tags and cover around it
+        raise NotImplementedError(f'{self.__class__.__name__} does not support plain encoding')
+
+    def is_chunk_joinable(self):
+        # only lossless codecs without priming or per-frame sample positions can be joined by stream copy, lossy
+        # segments would each carry their own encoder delay and padding at the joints. The container must also keep
+        # the length of every packet, as each segment ends in a partial frame
+        return False
+
+    async def chunked_convert(self, audio_info):
+        # returns whether the segments were joined, otherwise the file has been converted in one pass instead
+        chunk_config = config.get('chunk_config', {})
+        sample_rate = audio_info['sample_rate']
+        duration = audio_info['duration']
+        segment_duration = chunk_config.get('segment_duration', 600)
+
+        boundaries = [segment_duration * i for i in range(1, int(duration // segment_duration) + 1)]
+        while boundaries and duration - boundaries[-1] < segment_duration / 2:
+            boundaries.pop()
+
+        if chunk_config.get('split_at_silence', True) and boundaries:
+            silences = await AudioUtils.detect_silence_by_ffmpeg(self.file_path)
+            search_range = chunk_config.get('silence_search_range', 30)
+            for i, boundary in enumerate(boundaries):
+                candidates = [(s + e) / 2 for s, e in silences if abs((s + e) / 2 - boundary) <= search_range]
+                if candidates:
+                    boundaries[i] = min(candidates, key=lambda c: abs(c - boundary))
+
+        sample_boundaries = [0] + [round(b * sample_rate) for b in boundaries] + [None]
+
+        new_file_path = PathUtils.create_file_path_struct(self.file_path, self.src_path, self.dst_path, self.get_ext())
+        tmp_file_prefix = os.path.join(os.path.dirname(new_file_path), f'_tmp_{os.path.basename(new_file_path)}')
+        segment_paths = [f'{tmp_file_prefix}.part{i:03d}{self.get_ext()}' for i in range(len(sample_boundaries) - 1)]
+
+        async def segment_task(start_sample, end_sample, segment_path, idx):
+            async with tracer.hold(self.semaphore, 'segment', file=self.file_path, idx=idx):
+                print(f'converting: {self.file_path}, segment {idx:02d}')
+                # seek near the segment on the input side, then cut at exact sample positions
+                seek_second = max(0, start_sample // sample_rate - 1)
+                input_args = f'-ss {seek_second}'
+                trim_filter = f'atrim=start_sample={start_sample - seek_second * sample_rate}'
+                if end_sample is not None:
+                    trim_filter += f':end_sample={end_sample - seek_second * sample_rate}'
+                await self._convert_segment(input_args, trim_filter, segment_path)
+
+        await supervisor.gather(*[
+            segment_task(sample_boundaries[i], sample_boundaries[i + 1], segment_path, i)
+            for i, segment_path in enumerate(segment_paths)
+        ])
+
+        async with tracer.hold(self.semaphore, 'join segments', file=self.file_path):
+            print(f'joining {len(segment_paths)} segments: {new_file_path}')
+            returncode = await AudioUtils.concat_by_ffmpeg(segment_paths, self.file_path, new_file_path)
+        if returncode == 0:
+            return True
+
+        # the segments are only removed once the output exists, here after the single pass
+        print(f'joining segments failed ({returncode}), converting in one pass: {self.file_path}')
+        await self.single_convert()
+        for file_name in os.listdir(os.path.dirname(tmp_file_prefix)):
+            if file_name.startswith(f'{os.path.basename(tmp_file_prefix)}.part'):
+                os.remove(os.path.join(os.path.dirname(tmp_file_prefix), file_name))
+        return False
+
+    async def _convert_segment(self, input_args, trim_filter, segment_path):
+        raise NotImplementedError(f'{self.__class__.__name__} does not support chunked conversion')
+
+    def _get_input_format(self):
+        # preferred pcm input of the encoder, keys left out keep the source format:
+        # sample_rate (required rate), max_sample_rate, max_bit_depth and float
+        return {}
+
+    async def _get_decode_args(self, *filters, pcm=True):
+        input_format = self._get_input_format()
+        if not pcm and not input_format:
+            return ' '.join([f'-af {",".join(filters)}'] if filters else [])
+
+        if self.audio_info is None:
+            self.audio_info = await AudioUtils.get_audio_info_by_ffprobe(self.file_path)
+
+        decode_args = []
+        if resample_filter := AudioUtils.get_resample_filter(self.audio_info, input_format):
+            filters += (resample_filter, )
+        if filters:
+            decode_args.append(f'-af {",".join(filters)}')
+        if pcm:
+            decode_args.append(f'-c:a {AudioUtils.get_pcm_codec(self.audio_info, input_format)}')
+        return ' '.join(decode_args)
+
+    async def _create_chapter_file(self, chapter_path):
+        tracks = self._get_cue_tracks()
+        audio_info = await AudioUtils.get_audio_info_by_ffprobe(self.file_path)
+
+        chapters = []
+        for track in tracks:
+            end_ms = track.end_ms if track.end_ms is not None else round(audio_info['duration'] * 1000)
+            chapters.append((track.start_ms, end_ms, track.metadata.get('title', track.title)))
+        AudioUtils.write_chapter_file(chapters, chapter_path)
+
+        # tags shared by every track describe the album
+        metadata = {
+            k: v for k, v in tracks[0].metadata.items()
+            if k not in ('title', 'track') and all(t.metadata.get(k) == v for t in tracks)
+        }
+        metadata['title'] = metadata.get('album', os.path.splitext(os.path.basename(self.file_path))[0])
+        return metadata
+
     def _get_cue_tracks(self):
         cue_path = os.path.splitext(self.file_path)[0] + '.cue'
-        cue_content = CueFileLoader(cue_path).get_content()
-        tracks = CueContentParser(os.path.splitext(os.path.basename(self.file_path))[0], cue_content).get_tracks()
-        return tracks
+        return cue_cache.get_sheet(cue_path).get_tracks(self.file_path)
+
+
+class TeeTarget:
+    def __init__(self, ffmpeg_output=None, encoder_cmd=None, finalize=None):
+        self.ffmpeg_output = ffmpeg_output
+        self.encoder_cmd = encoder_cmd
+        self.finalize = finalize
 
 
 class AudioUtils:
     @staticmethod
+    @tracer.traced('ffprobe metadata')
     async def get_metadata_by_ffprobe(file_path):
         ffprobe_path = config.get('executable', {}).get('ffprobe', 'ffprobe')
-        ffprobe_cmd = f'"{ffprobe_path}" -loglevel error -show_format -of json "{file_path}"'
+        ffprobe_cmd = f'"{ffprobe_path}" -loglevel error -show_format'
+        ffprobe_cmd += f' -of json "{archive_source.get_input(file_path)}"'
         ffprobe_process = await asyncio.create_subprocess_shell(
             ffprobe_cmd,
             stdout=asyncio.subprocess.PIPE,
@@ -73,11 +246,240 @@ class AudioUtils:
         return metadata
 
     @staticmethod
-    async def add_metadata_by_ffmpeg(metadata, origin_file_path, new_file_path):
+    @tracer.traced('ffprobe audio info')
+    async def get_audio_info_by_ffprobe(file_path):
+        ffprobe_path = config.get('executable', {}).get('ffprobe', 'ffprobe')
+        ffprobe_cmd = f'"{ffprobe_path}" -loglevel error -show_format -show_streams -select_streams a:0'
+        ffprobe_cmd += f' -of json "{archive_source.get_input(file_path)}"'
+        ffprobe_process = await asyncio.create_subprocess_shell(
+            ffprobe_cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        ffprobe_stdout, ffprobe_stderr = await ffprobe_process.communicate()
+
+        src_info = json.loads(ffprobe_stdout)
+        stream = (src_info.get('streams') or [{}])[0]
+        sample_fmt = stream.get('sample_fmt', '')
+        audio_info = {
+            'duration': float(src_info.get('format', {}).get('duration', 0)),
+            'sample_rate': int(stream.get('sample_rate', 0)),
+            'bits_per_sample': int(stream.get('bits_per_raw_sample') or stream.get('bits_per_sample') or 0),
+            'float': sample_fmt.startswith(('flt', 'dbl')),
+        }
+        if not audio_info['bits_per_sample']:
+            audio_info['bits_per_sample'] = 16 if sample_fmt.startswith('s16') else 32
+
+        return audio_info
+
+    @staticmethod
+    def get_resample_filter(audio_info, input_format):
+        sample_rate = audio_info['sample_rate']
+        target_rate = input_format.get('sample_rate')
+        if target_rate is None and sample_rate > (max_rate := input_format.get('max_sample_rate', sample_rate)):
+            # stay within the rate family of the source, e.g. 88.2kHz goes to 44.1kHz rather than 48kHz
+            base_rate = 44100 if sample_rate % 11025 == 0 else 48000
+            target_rate = base_rate * (max_rate // base_rate) if max_rate >= base_rate else max_rate
+        if not sample_rate or target_rate in (None, sample_rate):
+            return ''
+
+        resampler = config.get('resample_config', {}).get('resampler', 'soxr')
+        resample_filter = f'aresample={target_rate}:resampler={resampler}'
+        if resampler == 'soxr':
+            resample_filter += f':precision={config.get("resample_config", {}).get("precision", 28)}'
+        return resample_filter
+
+    @staticmethod
+    def get_pcm_codec(audio_info, input_format):
+        if input_format.get('float'):
+            return 'pcm_f32le'
+
+        bits = min(audio_info['bits_per_sample'], input_format.get('max_bit_depth', 32))
+        if bits <= 16:
+            return 'pcm_s16le'
+        if bits <= 24:
+            return 'pcm_s24le'
+        return 'pcm_s32le'
+
+    @staticmethod
+    @tracer.traced('detect silence')
+    async def detect_silence_by_ffmpeg(file_path):
+        ffmpeg_path = config.get('executable', {}).get('ffmpeg', 'ffmpeg')
+        noise = config.get('chunk_config', {}).get('silence_threshold', -50)
+        ffmpeg_cmd = f'"{ffmpeg_path}" -i "{archive_source.get_input(file_path)}"'
+        ffmpeg_cmd += f' -map 0:a:0 -af silencedetect=n={noise}dB:d=0.5 -f null -'
+        ffmpeg_process = await asyncio.create_subprocess_shell(
+            ffmpeg_cmd,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        _, ffmpeg_stderr = await ffmpeg_process.communicate()
+
+        log = ffmpeg_stderr.decode('utf-8', errors='ignore')
+        starts = [float(t) for t in re.findall(r'silence_start: (-?[\d.]+)', log)]
+        ends = [float(t) for t in re.findall(r'silence_end: (-?[\d.]+)', log)]
+        return list(zip(starts, ends))
+
+    @staticmethod
+    @tracer.traced('concat segments')
+    async def concat_by_ffmpeg(segment_paths, origin_file_path, new_file_path):
+        list_path = f'{os.path.splitext(segment_paths[0])[0]}.txt'
+        with open(list_path, 'w', encoding='utf-8') as list_file:
+            for segment_path in segment_paths:
+                escaped_path = os.path.abspath(segment_path).replace("'", "'\\''")
+                list_file.write(f"file '{escaped_path}'\n")
+
+        ffmpeg_path = config.get('executable', {}).get('ffmpeg', 'ffmpeg')
+        ffmpeg_cmd = f'"{ffmpeg_path}" -y -f concat -safe 0 -i "{list_path}"'
+        ffmpeg_cmd += f' -i "{archive_source.get_input(origin_file_path)}"'
+        ffmpeg_cmd += f' -map 0:a -map_metadata 1 -c copy "{new_file_path}"'
+        ffmpeg_process = await supervisor.create_subprocess_shell(ffmpeg_cmd, stderr=asyncio.subprocess.DEVNULL)
+        await supervisor.wait([ffmpeg_process])
+        # a failed join keeps its segments, the caller decides what to do with them
+        if ffmpeg_process.returncode != 0:
+            return ffmpeg_process.returncode
+
+        os.remove(list_path)
+        for segment_path in segment_paths:
+            os.remove(segment_path)
+        return ffmpeg_process.returncode
+
+    @staticmethod
+    @tracer.traced('remux metadata')
+    async def add_metadata_by_ffmpeg(metadata, origin_file_path, new_file_path, cover_path=None):
+        ffmpeg_path = config.get('executable', {}).get('ffmpeg', 'ffmpeg')
+        ffmpeg_cmd = f'"{ffmpeg_path}" -i "{origin_file_path}"'
+        if cover_path is not None:
+            ffmpeg_cmd += f' -i "{cover_path}" -map 0:a -map 1:v -disposition:v:0 attached_pic'
+        ffmpeg_cmd += ' -c copy'
+        ffmpeg_cmd += ' ' + ' '.join([f'-metadata "{k}"="{v}"' for k, v in metadata.items()])
+        ffmpeg_cmd += f' "{new_file_path}"'
+        ffmpeg_process = await supervisor.create_subprocess_shell(ffmpeg_cmd, stderr=asyncio.subprocess.DEVNULL)
+        await supervisor.wait([ffmpeg_process])
+        os.remove(origin_file_path)
+
+    @staticmethod
+    @tracer.traced('remux chapters')
+    async def add_chapters_by_ffmpeg(chapter_path, metadata, origin_file_path, new_file_path):
         ffmpeg_path = config.get('executable', {}).get('ffmpeg', 'ffmpeg')
-        ffmpeg_cmd = f'"{ffmpeg_path}" -i "{origin_file_path}" -c copy'
+        ffmpeg_cmd = f'"{ffmpeg_path}" -i "{origin_file_path}" -f ffmetadata -i "{chapter_path}"'
+        ffmpeg_cmd += ' -map 0 -map_chapters 1 -c copy'
         ffmpeg_cmd += ' ' + ' '.join([f'-metadata "{k}"="{v}"' for k, v in metadata.items()])
         ffmpeg_cmd += f' "{new_file_path}"'
-        ffmpeg_process = await asyncio.create_subprocess_shell(ffmpeg_cmd, stderr=asyncio.subprocess.DEVNULL)
-        await ffmpeg_process.communicate()
+        ffmpeg_process = await supervisor.create_subprocess_shell(ffmpeg_cmd, stderr=asyncio.subprocess.DEVNULL)
+        await supervisor.wait([ffmpeg_process])
         os.remove(origin_file_path)
+        os.remove(chapter_path)
+
+    @staticmethod
+    def write_chapter_file(chapters, chapter_path):
+        def escape(value):
+            return re.sub(r'([=;#\\\n])', r'\\\1', value)
+
+        lines = [';FFMETADATA1\n']
+        for start, end, title in chapters:
+            lines += ['[CHAPTER]\n', 'TIMEBASE=1/1000\n', f'START={start}\n', f'END={end}\n']
+            lines.append(f'title={escape(title)}\n')
+        with open(chapter_path, 'w', encoding='utf-8') as chapter_file:
+            chapter_file.writelines(lines)
+
+    @staticmethod
+    @tracer.traced('ffmpeg encode')
+    async def ffmpeg_convert(ffmpeg_cmd, meter=None, seek=''):
+        if meter is None:
+            ffmpeg_process = await supervisor.create_subprocess_shell(ffmpeg_cmd, stderr=asyncio.subprocess.DEVNULL)
+            await supervisor.wait([ffmpeg_process])
+            return
+
+        # tap the decoded stream with an extra wav output of the same ffmpeg process
+        ffmpeg_process = await supervisor.create_subprocess_shell(
+            f'{ffmpeg_cmd}{seek} -f wav -',
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL
+        )
+        await supervisor.wait([ffmpeg_process], AudioUtils.tee_stream(ffmpeg_process.stdout, [], [meter.feed]))
+
+    @staticmethod
+    @tracer.traced('decode and pipe encode')
+    async def pipe_convert(ffmpeg_cmd, encoder_cmd, meter=None, quiet=False):
+        encoder_output = asyncio.subprocess.DEVNULL if quiet else None
+
+        if meter is None:
+            pipe_reader, pipe_writer = os.pipe()
+
+            ffmpeg_process = await supervisor.create_subprocess_shell(
+                ffmpeg_cmd,
+                stdout=pipe_writer,
+                stderr=asyncio.subprocess.DEVNULL
+            )
+            os.close(pipe_writer)
+
+            encoder_process = await supervisor.create_subprocess_shell(
+                encoder_cmd,
+                stdin=pipe_reader,
+                stdout=encoder_output,
+                stderr=encoder_output,
+            )
+            os.close(pipe_reader)
+
+            await supervisor.wait([encoder_process, ffmpeg_process])
+            return encoder_process.returncode
+
+        ffmpeg_process = await supervisor.create_subprocess_shell(
+            ffmpeg_cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL
+        )
+        encoder_process = await supervisor.create_subprocess_shell(
+            encoder_cmd,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=encoder_output,
+            stderr=encoder_output,
+        )
+
+        await supervisor.wait(
+            [encoder_process, ffmpeg_process],
+            AudioUtils.tee_stream(ffmpeg_process.stdout, [encoder_process.stdin], [meter.feed])
+        )
+        return encoder_process.returncode
+
+    @staticmethod
+    async def tee_stream(reader, writers, sinks=(), chunk_size=1 << 16, sink_batch_size=1 << 20):
+        # sinks such as the loudness meter are cpu bound, they get batched chunks in an executor so the event loop
+        # keeps feeding the other pipes. One batch is in flight at a time, which keeps the chunks in order.
+        loop = asyncio.get_running_loop()
+        alive_writers = list(writers)
+        sink_batch = []
+        sink_batch_len = 0
+        sink_future = None
+
+        while chunk := await reader.read(chunk_size):
+            if sinks:
+                sink_batch.append(chunk)
+                sink_batch_len += len(chunk)
+                if sink_batch_len >= sink_batch_size:
+                    if sink_future is not None:
+                        await sink_future
+                    sink_future = loop.run_in_executor(None, AudioUtils._feed_sinks, sinks, b''.join(sink_batch))
+                    sink_batch = []
+                    sink_batch_len = 0
+
+            for writer in alive_writers[:]:
+                try:
+                    writer.write(chunk)
+                    await writer.drain()
+                except (BrokenPipeError, ConnectionResetError):
+                    alive_writers.remove(writer)
+
+        for writer in writers:
+            writer.close()
+
+        if sink_future is not None:
+            await sink_future
+        if sink_batch:
+            await loop.run_in_executor(None, AudioUtils._feed_sinks, sinks, b''.join(sink_batch))
+
+    @staticmethod
+    def _feed_sinks(sinks, data):
+        for sink in sinks:
+            sink(data)
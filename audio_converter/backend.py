@@ -0,0 +1,141 @@
+#  py_album_condense - a simple tool to compress and condense your album collections
+#  Copyright (c) 2022 kewenyu
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#  SOFTWARE.
+
+
+import os
+import time
+import shutil
+import asyncio
+import tempfile
+
+from audio_converter.ffmpeg_converter import OpusConverter, FLACConverter, WavPackConverter
+from audio_converter.xiph_converter import OpusencConverter, FLACToolConverter, WavPackToolConverter
+from common.config import config
+from common.stat_cache import StatCache
+from common.supervisor import supervisor
+from common.util import PathUtils
+
+
+# interchangeable encoders of a format, all of them take the same settings from the format's config
+audio_codec_backends = {
+    'opus': {'ffmpeg': OpusConverter, 'opusenc': OpusencConverter},
+    'flac': {'ffmpeg': FLACConverter, 'flac': FLACToolConverter},
+    'wavpack': {'ffmpeg': WavPackConverter, 'wavpack': WavPackToolConverter},
+}
+
+
+class BackendSelector:
+    def __init__(self):
+        self.calibrate = False
+        self.selected = {}
+        # timings are keyed by the stat of the encoder executable, so that an upgraded encoder is measured again
+        self.timings = StatCache('backend_config', 'backend_cache.json')
+
+    def setup(self, calibrate):
+        self.calibrate = calibrate
+
+    def get(self, codec, handlers):
+        return self.selected.get(codec, handlers.get(codec))
+
+    async def select(self, codecs):
+        tmp_dir = None
+        try:
+            for codec in dict.fromkeys(codecs):
+                if (backends := audio_codec_backends.get(codec)) is None:
+                    continue
+
+                name = config.get('backend_config', {}).get('backends', {}).get(codec, 'auto')
+                if name != 'auto':
+                    self.selected[codec] = backends[name]
+                    continue
+
+                available = {name: handler for name, handler in backends.items() if self._is_available(handler)}
+                if len(available) < 2:
+                    self.selected.update({codec: handler for handler in available.values()})
+                    continue
+
+                timings = {}
+                for name, handler in available.items():
+                    executable = shutil.which(handler.get_executables()[-1])
+                    cached_timings = self.timings.get(executable) or {}
+                    if not self.calibrate and codec in cached_timings:
+                        timings[name] = cached_timings[codec]
+                        continue
+
+                    if tmp_dir is None:
+                        tmp_dir = tempfile.mkdtemp(prefix='album_condense_benchmark_')
+                        await self._create_sample(tmp_dir)
+                    if (elapsed := await self._benchmark(handler, tmp_dir, name)) is not None:
+                        timings[name] = elapsed
+                        self.timings.put(executable, {**cached_timings, codec: elapsed})
+
+                if timings:
+                    name = min(timings, key=timings.get)
+                    print(f'encoder backend for {codec}: {name} '
+                          f'({", ".join([f"{k} {v:.2f}s" for k, v in timings.items()])})')
+                    self.selected[codec] = available[name]
+        finally:
+            if tmp_dir is not None:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+            self.timings.save()
+
+    @staticmethod
+    def _is_available(handler):
+        return all([shutil.which(executable) is not None for executable in handler.get_executables()])
+
+    @staticmethod
+    async def _create_sample(tmp_dir):
+        # uncorrelated pink noise on both channels, which is about as hard to compress as real music
+        duration = config.get('backend_config', {}).get('benchmark_duration', 30)
+        ffmpeg_path = config.get('executable', {}).get('ffmpeg', 'ffmpeg')
+        ffmpeg_cmd = f'"{ffmpeg_path}" -y -filter_complex'
+        ffmpeg_cmd += f' "anoisesrc=color=pink:amplitude=0.3:duration={duration}:sample_rate=44100:seed=1[l];'
+        ffmpeg_cmd += f'anoisesrc=color=pink:amplitude=0.3:duration={duration}:sample_rate=44100:seed=2[r];'
+        ffmpeg_cmd += '[l][r]join=inputs=2:channel_layout=stereo"'
+        ffmpeg_cmd += f' -c:a pcm_s16le "{os.path.join(tmp_dir, "sample.wav")}"'
+        ffmpeg_process = await supervisor.create_subprocess_shell(
+            ffmpeg_cmd,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.DEVNULL
+        )
+        await supervisor.wait([ffmpeg_process])
+
+    @staticmethod
+    async def _benchmark(handler, tmp_dir, name):
+        sample_path = os.path.join(tmp_dir, 'sample.wav')
+        semaphore = asyncio.Semaphore(1)
+        converter = handler(semaphore, sample_path, tmp_dir, os.path.join(tmp_dir, name))
+        new_file_path = PathUtils.create_file_path_struct(sample_path, tmp_dir, converter.dst_path, converter.get_ext())
+
+        # the same encode as a single file conversion decoded by ffmpeg, the best of a few runs counts
+        timings = []
+        for _ in range(config.get('backend_config', {}).get('benchmark_runs', 2)):
+            start = time.perf_counter()
+            await converter.encode(new_file_path)
+            timings.append(time.perf_counter() - start)
+            if not os.path.exists(new_file_path) or os.path.getsize(new_file_path) == 0:
+                print(f'encoder backend {name} failed, skipped')
+                return None
+            os.remove(new_file_path)
+        return min(timings)
+
+
+backend_selector = BackendSelector()
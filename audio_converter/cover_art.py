@@ -0,0 +1,132 @@
+#  py_album_condense - a simple tool to compress and condense your album collections
+#  Copyright (c) 2022 kewenyu
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#  SOFTWARE.
+
+
+import os
+import shutil
+import hashlib
+import asyncio
+import tempfile
+
+from common.archive import archive_source
+from common.config import config
+from common.supervisor import supervisor
+from common.tracer import tracer
+
+
+class CoverArtCache:
+    image_exts = ('.jpg', '.jpeg', '.png', '.webp', '.bmp', '.tif', '.tiff')
+
+    def __init__(self):
+        self.covers = {}
+        self.tmp_dir = None
+
+    @property
+    def enabled(self):
+        return config.get('cover_config', {}).get('enable', False)
+
+    async def get_cover(self, file_path, src_path):
+        if not self.enabled:
+            return None
+
+        # all tracks of an album share one resize task, so that the scan is decoded only once
+        album_dir = os.path.dirname(file_path)
+        if (task := self.covers.get(album_dir)) is None:
+            task = asyncio.create_task(self._create_cover(album_dir, src_path))
+            self.covers[album_dir] = task
+        return await task
+
+    def cleanup(self):
+        if self.tmp_dir is not None:
+            shutil.rmtree(self.tmp_dir, ignore_errors=True)
+            self.tmp_dir = None
+        self.covers.clear()
+
+    @tracer.traced('create cover')
+    async def _create_cover(self, album_dir, src_path):
+        if (cover_path := self._find_cover(album_dir, src_path)) is None:
+            return None
+
+        print(f'resizing cover: {cover_path}')
+        if self.tmp_dir is None:
+            self.tmp_dir = tempfile.mkdtemp(prefix='album_condense_cover_')
+        thumbnail_path = os.path.join(self.tmp_dir, f'{hashlib.md5(album_dir.encode()).hexdigest()}.jpg')
+
+        max_size = config.get('cover_config', {}).get('max_size', 500)
+        quality = config.get('cover_config', {}).get('qscale', 3)
+        ffmpeg_path = config.get('executable', {}).get('ffmpeg', 'ffmpeg')
+        ffmpeg_cmd = f'"{ffmpeg_path}" -y -i "{archive_source.get_input(cover_path)}" -frames:v 1'
+        ffmpeg_cmd += f' -vf "scale=\'min(iw,{max_size})\':\'min(ih,{max_size})\':force_original_aspect_ratio=decrease"'
+        ffmpeg_cmd += f' -qscale:v {quality} "{thumbnail_path}"'
+        ffmpeg_process = await supervisor.create_subprocess_shell(
+            ffmpeg_cmd,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.DEVNULL
+        )
+        await supervisor.wait([ffmpeg_process])
+
+        if not os.path.exists(thumbnail_path):
+            return None
+        with open(thumbnail_path, 'rb') as thumbnail:
+            return CoverArt(thumbnail_path, thumbnail.read())
+
+    def _find_cover(self, album_dir, src_path):
+        cover_config = config.get('cover_config', {})
+        names = [name.lower() for name in cover_config.get('names', ['cover', 'folder', 'front'])]
+        scan_dirs = [name.lower() for name in cover_config.get('scan_dirs', ['scans', 'scan', 'artwork', 'covers'])]
+        search_dirs = [album_dir]
+        # scans are often kept next to the disc folders, e.g. Album/CD1 and Album/Scans
+        if (parent_dir := os.path.dirname(album_dir)) != album_dir and \
+                not os.path.relpath(parent_dir, src_path).startswith(os.pardir):
+            search_dirs.append(parent_dir)
+
+        for search_dir in search_dirs:
+            # only the folder itself and its scan folders, any other sub folder of the parent is a sibling album
+            dir_names, file_names = archive_source.list_dir(search_dir)
+            file_paths = [os.path.join(search_dir, file_name) for file_name in file_names]
+            for dir_name in dir_names:
+                if dir_name.lower() in scan_dirs:
+                    scan_dir = os.path.join(search_dir, dir_name)
+                    file_paths += [os.path.join(scan_dir, name) for name in archive_source.list_dir(scan_dir)[1]]
+
+            candidates = []
+            for file_path in file_paths:
+                stem, ext = os.path.splitext(os.path.basename(file_path))
+                if ext.lower() not in self.image_exts:
+                    continue
+                # an exact name wins over a prefix such as cover_front or Cover (1)
+                for priority, name in enumerate(names):
+                    if stem.lower().startswith(name):
+                        candidates.append((priority, stem.lower() != name, file_path.count(os.sep), file_path))
+                        break
+            if candidates:
+                return min(candidates)[3]
+
+        return None
+
+
+class CoverArt:
+    def __init__(self, path, data):
+        self.path = path
+        self.data = data
+
+
+cover_art_cache = CoverArtCache()
@@ -22,8 +22,12 @@
 import os
 import asyncio
 
-from audio_converter.audio_converter import AudioConverter, AudioUtils
+from audio_converter.audio_converter import AudioConverter, AudioUtils, TeeTarget
+from audio_converter.cover_art import cover_art_cache
+from audio_converter.loudness import loudness_tracker
 from common.config import config
+from common.supervisor import supervisor
+from common.tracer import tracer
 from common.util import PathUtils
 
 
@@ -31,98 +35,97 @@ class ExhaleConverter(AudioConverter):
     def __init__(self, semaphore, file_path, src_path, dst_path):
         super().__init__(semaphore, file_path, src_path, dst_path)
 
+    @classmethod
+    def get_executables(cls):
+        return super().get_executables() + [config.get('executable', {}).get('exhale', 'exhale')]
+
     async def single_convert(self):
-        async with self.semaphore:
+        async with tracer.hold(self.semaphore, 'convert', file=self.file_path):
             print(f'converting to USAC: {self.file_path}')
 
             ffmpeg_path = config.get('executable', {}).get('ffmpeg', 'ffmpeg')
-            exhale_path = config.get('executable', {}).get('exhale', 'exhale')
-            exhale_preset = config.get('usac_config', {}).get('preset', 5)
             new_file_path = PathUtils.create_file_path_struct(self.file_path, self.src_path, self.dst_path, '.m4a')
-            tmp_file_path = os.path.join(os.path.dirname(new_file_path), f'_tmp_{os.path.basename(new_file_path)}')
-
-            ffmpeg_cmd = f'"{ffmpeg_path}" -y -i "{self.file_path}" -f wav -'
-            exhale_cmd = f'"{exhale_path}" {exhale_preset} "{tmp_file_path}"'
-
-            pipe_reader, pipe_writer = os.pipe()
+            tmp_file_path = self._get_tmp_path(new_file_path)
 
-            ffmpeg_process = await asyncio.create_subprocess_shell(
-                ffmpeg_cmd,
-                stdout=pipe_writer,
-                stderr=asyncio.subprocess.DEVNULL
-            )
-            os.close(pipe_writer)
+            meter = loudness_tracker.create_meter(self.file_path, new_file_path)
 
-            exhale_process = await asyncio.create_subprocess_shell(
-                exhale_cmd,
-                stdin=pipe_reader,
-                stderr=asyncio.subprocess.PIPE,
-                stdout=asyncio.subprocess.PIPE,
-            )
-            os.close(pipe_reader)
-
-            await exhale_process.communicate()
-            await ffmpeg_process.communicate()
+            if (pcm_source := self._get_pcm_source(metered=meter is not None)) is not None:
+                exhale_cmd = self._get_encoder_cmd(tmp_file_path, pcm_source.file_path)
+                await pcm_source.convert_file(exhale_cmd, meter, quiet=True)
+            else:
+                ffmpeg_cmd = f'"{ffmpeg_path}" -y -i "{self.input_path}" {await self._get_decode_args()} -f wav -'
+                exhale_cmd = self._get_encoder_cmd(tmp_file_path)
+                await AudioUtils.pipe_convert(ffmpeg_cmd, exhale_cmd, meter, quiet=True)
 
             metadata = await AudioUtils.get_metadata_by_ffprobe(self.file_path)
-            await AudioUtils.add_metadata_by_ffmpeg(metadata, tmp_file_path, new_file_path)
+            cover = await cover_art_cache.get_cover(self.file_path, self.src_path)
+            await AudioUtils.add_metadata_by_ffmpeg(metadata, tmp_file_path, new_file_path, cover and cover.path)
 
     async def cue_convert(self):
         sub_workers_list = []
 
-        async with self.semaphore:
+        async with tracer.hold(self.semaphore, 'cue setup', file=self.file_path):
             new_file_dir = PathUtils.create_dir_path_struct(self.file_path, self.src_path, self.dst_path)
             tracks = self._get_cue_tracks()
+            cover = await cover_art_cache.get_cover(self.file_path, self.src_path)
+            pcm_source = self._get_pcm_source(sliced=True)
+            decode_args = await self._get_decode_args()
             for track in tracks:
-                out_track_name = f'{track["idx"]:02d}. {track["title"]}.m4a'
+                out_track_name = f'{track.idx:02d}. {track.title}.m4a'
                 out_track_path = os.path.join(new_file_dir, out_track_name)
-                tmp_track_path = os.path.join(
-                    os.path.dirname(out_track_path),
-                    f'_tmp_{os.path.basename(out_track_path)}'
-                )
+                tmp_track_path = self._get_tmp_path(out_track_path)
 
                 ffmpeg_path = config.get('executable', {}).get('ffmpeg', 'ffmpeg')
-                ffmpeg_cmd = f'"{ffmpeg_path}" -y -i "{self.file_path}" -ss {track["start_time"]}'
-                if track.get('end_time'):
-                    ffmpeg_cmd += f' -to {track["end_time"]}'
-                ffmpeg_cmd += ' -f wav -'
+                ffmpeg_cmd = f'"{ffmpeg_path}" -y -i "{self.input_path}" -ss {track.start_time}'
+                if track.end_time is not None:
+                    ffmpeg_cmd += f' -to {track.end_time}'
+                ffmpeg_cmd += f' {decode_args} -f wav -'
 
-                exhale_path = config.get('executable', {}).get('exhale', 'exhale')
-                exhale_preset = config.get('usac_config', {}).get('preset', 5)
-                exhale_cmd = f'"{exhale_path}" {exhale_preset} "{tmp_track_path}"'
+                exhale_cmd = self._get_encoder_cmd(tmp_track_path)
+                meter = loudness_tracker.create_meter(self.file_path, out_track_path)
 
-                async def track_task(f_cmd, e_cmd, metadata, t_path, o_path, idx):
-                    async with self.semaphore:
+                async def track_task(f_cmd, e_cmd, m, t, t_path, o_path, idx):
+                    async with tracer.hold(self.semaphore, 'track', file=self.file_path, idx=idx):
                         print(f'converting to USAC: {self.file_path}, track {idx:02d}')
-
-                        pipe_reader, pipe_writer = os.pipe()
-
-                        ffmpeg_process = await asyncio.create_subprocess_shell(
-                            f_cmd,
-                            stderr=asyncio.subprocess.DEVNULL,
-                            stdout=pipe_writer
-                        )
-                        os.close(pipe_writer)
-
-                        exhale_process = await asyncio.create_subprocess_shell(
-                            e_cmd,
-                            stdin=pipe_reader,
-                            stderr=asyncio.subprocess.PIPE,
-                            stdout=asyncio.subprocess.PIPE,
-                        )
-                        os.close(pipe_reader)
-
-                        await exhale_process.communicate()
-                        await ffmpeg_process.communicate()
-
-                        await AudioUtils.add_metadata_by_ffmpeg(metadata, t_path, o_path)
+                        if pcm_source is not None:
+                            await pcm_source.convert_slice(e_cmd, t.start_frame, t.end_frame, m, quiet=True)
+                        else:
+                            await AudioUtils.pipe_convert(f_cmd, e_cmd, m, quiet=True)
+                        await AudioUtils.add_metadata_by_ffmpeg(t.metadata, t_path, o_path, cover and cover.path)
 
                 sub_worker = asyncio.create_task(
-                    track_task(ffmpeg_cmd, exhale_cmd, track['metadata'], tmp_track_path, out_track_path, track["idx"])
+                    track_task(
+                        ffmpeg_cmd, exhale_cmd, meter, track, tmp_track_path, out_track_path, track.idx
+                    )
                 )
                 sub_workers_list.append(sub_worker)
 
-        await asyncio.gather(*sub_workers_list)
+        await supervisor.gather(*sub_workers_list)
 
     def get_ext(self):
         return '.m4a'
+
+    def get_tee_target(self, new_file_path, metadata):
+        tmp_file_path = self._get_tmp_path(new_file_path)
+        return TeeTarget(
+            encoder_cmd=self._get_encoder_cmd(tmp_file_path),
+            finalize=lambda: AudioUtils.add_metadata_by_ffmpeg(metadata, tmp_file_path, new_file_path)
+        )
+
+    @staticmethod
+    def _get_tmp_path(new_file_path):
+        return os.path.join(os.path.dirname(new_file_path), f'_tmp_{os.path.basename(new_file_path)}')
+
+    def _get_pcm_containers(self):
+        return 'wav',
+
+    def _get_input_format(self):
+        return {'max_sample_rate': 48000, 'max_bit_depth': 24}
+
+    @staticmethod
+    def _get_encoder_cmd(tmp_file_path, input_path='-'):
+        exhale_path = config.get('executable', {}).get('exhale', 'exhale')
+        exhale_preset = config.get('usac_config', {}).get('preset', 5)
+        if input_path == '-':
+            return f'"{exhale_path}" {exhale_preset} "{tmp_file_path}"'
+        return f'"{exhale_path}" {exhale_preset} "{input_path}" "{tmp_file_path}"'
@@ -23,8 +23,14 @@ import os
 import abc
 import asyncio
 
-from audio_converter.audio_converter import AudioConverter
+from audio_converter.audio_converter import AudioConverter, AudioUtils, TeeTarget
+from audio_converter.cover_art import cover_art_cache
+from audio_converter.loudness import loudness_tracker
+from audio_converter.tag_utils import TagUtils
 from common.config import config
+from common.deadline import deadline_controller
+from common.supervisor import supervisor
+from common.tracer import tracer
 from common.util import PathUtils
 
 
@@ -33,50 +39,109 @@ class FFMPEGAudioConverter(AudioConverter, metaclass=abc.ABCMeta):
         super().__init__(semaphore, file_path, src_path, dst_path)
 
     async def single_convert(self):
-        async with self.semaphore:
+        async with tracer.hold(self.semaphore, 'convert', file=self.file_path):
             print(f'converting to {self._get_format_name()}: {self.file_path}')
 
             new_file_path = PathUtils.create_file_path_struct(
                 self.file_path, self.src_path, self.dst_path, self._get_ext()
             )
-            ffmpeg_path = config.get('executable', {}).get('ffmpeg', 'ffmpeg')
-            cmd = f'"{ffmpeg_path}" -y -i "{self.file_path}" {self._get_parameter()} "{new_file_path}"'
+            meter = loudness_tracker.create_meter(self.file_path, new_file_path)
+            await self.encode(new_file_path, meter)
+            await self._embed_cover(new_file_path)
 
-            process = await asyncio.create_subprocess_shell(cmd, stderr=asyncio.subprocess.DEVNULL)
-            await process.communicate()
+    async def encode(self, new_file_path, meter=None):
+        ffmpeg_path = config.get('executable', {}).get('ffmpeg', 'ffmpeg')
+        cmd = f'"{ffmpeg_path}" -y -i "{self.input_path}" {await self._get_decode_args(pcm=False)}'
+        cmd += f' {self._get_parameter()} "{new_file_path}"'
+        await AudioUtils.ffmpeg_convert(cmd, meter)
 
     async def cue_convert(self):
         sub_workers_list = []
 
-        async with self.semaphore:
+        async with tracer.hold(self.semaphore, 'cue setup', file=self.file_path):
             new_file_dir = PathUtils.create_dir_path_struct(self.file_path, self.src_path, self.dst_path)
 
             tracks = self._get_cue_tracks()
+            decode_args = await self._get_decode_args(pcm=False)
             for track in tracks:
-                out_track_name = f'{track["idx"]:02d}. {track["title"]}{self._get_ext()}'
+                out_track_name = f'{track.idx:02d}. {track.title}{self._get_ext()}'
                 out_track_path = os.path.join(new_file_dir, out_track_name)
 
+                seek = f' -ss {track.start_time}'
+                if track.end_time is not None:
+                    seek += f' -to {track.end_time}'
+
                 ffmpeg_path = config.get('executable', {}).get('ffmpeg', 'ffmpeg')
-                ffmpeg_cmd = f'"{ffmpeg_path}" -y -i "{self.file_path}" -ss {track["start_time"]}'
-                if track.get('end_time'):
-                    ffmpeg_cmd += f' -to {track["end_time"]}'
-                ffmpeg_cmd += ' ' + ' '.join([f'-metadata "{k}"="{v}"' for k, v in track['metadata'].items()])
-                ffmpeg_cmd += f' {self._get_parameter()} "{out_track_path}"'
+                ffmpeg_cmd = f'"{ffmpeg_path}" -y -i "{self.input_path}"{seek}'
+                ffmpeg_cmd += ' ' + ' '.join([f'-metadata "{k}"="{v}"' for k, v in track.metadata.items()])
+                ffmpeg_cmd += f' {decode_args} {self._get_parameter()} "{out_track_path}"'
 
-                async def track_task(cmd, idx):
-                    async with self.semaphore:
+                meter = loudness_tracker.create_meter(self.file_path, out_track_path)
+
+                async def track_task(cmd, m, s, o_path, idx):
+                    async with tracer.hold(self.semaphore, 'track', file=self.file_path, idx=idx):
                         print(f'converting to {self._get_format_name()}: {self.file_path}, track {idx:02d}')
-                        process = await asyncio.create_subprocess_shell(cmd, stderr=asyncio.subprocess.DEVNULL)
-                        await process.communicate()
+                        await AudioUtils.ffmpeg_convert(cmd, m, s)
+                        await self._embed_cover(o_path)
 
-                sub_worker = asyncio.create_task(track_task(ffmpeg_cmd, track["idx"]))
+                sub_worker = asyncio.create_task(track_task(ffmpeg_cmd, meter, seek, out_track_path, track.idx))
                 sub_workers_list.append(sub_worker)
 
-        await asyncio.gather(*sub_workers_list)
+        await supervisor.gather(*sub_workers_list)
+
+    async def chapter_convert(self):
+        async with tracer.hold(self.semaphore, 'convert with chapters', file=self.file_path):
+            print(f'converting to {self._get_format_name()} with chapters: {self.file_path}')
+
+            new_file_path = PathUtils.create_file_path_struct(
+                self.file_path, self.src_path, self.dst_path, self._get_ext()
+            )
+            chapter_path = f'{new_file_path}.chapters'
+            metadata = await self._create_chapter_file(chapter_path)
+
+            ffmpeg_path = config.get('executable', {}).get('ffmpeg', 'ffmpeg')
+            cmd = f'"{ffmpeg_path}" -y -i "{self.input_path}" -f ffmetadata -i "{chapter_path}"'
+            cmd += f' -map 0:a -map_chapters 1 {await self._get_decode_args(pcm=False)}'
+            cmd += ' ' + ' '.join([f'-metadata "{k}"="{v}"' for k, v in metadata.items()])
+            cmd += f' {self._get_parameter()} "{new_file_path}"'
+
+            meter = loudness_tracker.create_meter(self.file_path, new_file_path)
+            await AudioUtils.ffmpeg_convert(cmd, meter)
+            os.remove(chapter_path)
+            await self._embed_cover(new_file_path)
 
     def get_ext(self):
         return self._get_ext()
 
+    def _embeds_cover(self):
+        return False
+
+    async def _embed_cover(self, new_file_path):
+        if not self._embeds_cover():
+            return
+        cover = await cover_art_cache.get_cover(self.file_path, self.src_path)
+        if cover is None:
+            return
+
+        try:
+            import mutagen
+        except ModuleNotFoundError:
+            print(f'mutagen is required to embed cover art into {self._get_format_name()}, skipped')
+            return
+        await asyncio.get_running_loop().run_in_executor(None, TagUtils.embed_cover, cover.data, new_file_path)
+
+    async def _convert_segment(self, input_args, trim_filter, segment_path):
+        ffmpeg_path = config.get('executable', {}).get('ffmpeg', 'ffmpeg')
+        cmd = f'"{ffmpeg_path}" -y {input_args} -i "{self.input_path}"'
+        cmd += f' {await self._get_decode_args(trim_filter, pcm=False)}'
+        cmd += f' {self._get_parameter()} "{segment_path}"'
+        await AudioUtils.ffmpeg_convert(cmd)
+
+    def get_tee_target(self, new_file_path, metadata):
+        ffmpeg_output = ' '.join([f'-metadata "{k}"="{v}"' for k, v in metadata.items()])
+        ffmpeg_output += f' {self._get_parameter()} "{new_file_path}"'
+        return TeeTarget(ffmpeg_output=ffmpeg_output)
+
     @abc.abstractmethod
     def _get_ext(self):
         raise NotImplemented
@@ -94,6 +159,13 @@ class OpusConverter(FFMPEGAudioConverter):
     def __init__(self, semaphore, file_path, src_path, dst_path):
         super().__init__(semaphore, file_path, src_path, dst_path)
 
+    def _embeds_cover(self):
+        return True
+
+    def _get_input_format(self):
+        # libopus only runs at 48kHz, resample once here instead of letting ffmpeg pick its default resampler
+        return {'sample_rate': 48000}
+
     def _get_ext(self):
         return '.opus'
 
@@ -109,6 +181,12 @@ class MP3Converter(FFMPEGAudioConverter):
     def __init__(self, semaphore, file_path, src_path, dst_path):
         super().__init__(semaphore, file_path, src_path, dst_path)
 
+    def _embeds_cover(self):
+        return True
+
+    def _get_input_format(self):
+        return {'max_sample_rate': 48000}
+
     def _get_ext(self):
         return '.mp3'
 
@@ -125,6 +203,9 @@ class VorbisConverter(FFMPEGAudioConverter):
     def __init__(self, semaphore, file_path, src_path, dst_path):
         super().__init__(semaphore, file_path, src_path, dst_path)
 
+    def _embeds_cover(self):
+        return True
+
     def _get_ext(self):
         return '.ogg'
 
@@ -136,6 +217,52 @@ class VorbisConverter(FFMPEGAudioConverter):
         return f'-c:a libvorbis -b:a {bitrate}k'
 
 
+class StreamCopyConverter(FFMPEGAudioConverter):
+    def __init__(self, semaphore, file_path, src_path, dst_path):
+        super().__init__(semaphore, file_path, src_path, dst_path)
+
+    async def cue_convert(self):
+        sub_workers_list = []
+
+        async with tracer.hold(self.semaphore, 'cue setup', file=self.file_path):
+            new_file_dir = PathUtils.create_dir_path_struct(self.file_path, self.src_path, self.dst_path)
+
+            tracks = self._get_cue_tracks()
+            for track in tracks:
+                out_track_name = f'{track.idx:02d}. {track.title}{self._get_ext()}'
+                out_track_path = os.path.join(new_file_dir, out_track_name)
+
+                # input side seeking lets the demuxer jump to the nearest packet instead of reading from the start,
+                # packets are copied as they are so the cut lands on the packet boundary next to the cue timestamp
+                seek = f'-ss {track.start_time}'
+                if track.end_time is not None:
+                    seek += f' -to {track.end_time}'
+
+                ffmpeg_path = config.get('executable', {}).get('ffmpeg', 'ffmpeg')
+                ffmpeg_cmd = f'"{ffmpeg_path}" -y {seek} -i "{self.input_path}" -map_metadata -1'
+                ffmpeg_cmd += ' ' + ' '.join([f'-metadata "{k}"="{v}"' for k, v in track.metadata.items()])
+                ffmpeg_cmd += f' {self._get_parameter()} "{out_track_path}"'
+
+                async def track_task(cmd, idx):
+                    async with tracer.hold(self.semaphore, 'track', file=self.file_path, idx=idx):
+                        print(f'splitting: {self.file_path}, track {idx:02d}')
+                        await AudioUtils.ffmpeg_convert(cmd)
+
+                sub_worker = asyncio.create_task(track_task(ffmpeg_cmd, track.idx))
+                sub_workers_list.append(sub_worker)
+
+        await supervisor.gather(*sub_workers_list)
+
+    def _get_ext(self):
+        return os.path.splitext(self.file_path)[1].lower()
+
+    def _get_format_name(self):
+        return 'stream copy'
+
+    def _get_parameter(self):
+        return '-map 0:a -c:a copy'
+
+
 class FLACConverter(FFMPEGAudioConverter):
     def __init__(self, semaphore, file_path, src_path, dst_path):
         super().__init__(semaphore, file_path, src_path, dst_path)
@@ -147,7 +274,9 @@ class FLACConverter(FFMPEGAudioConverter):
         return 'FLAC'
 
     def _get_parameter(self):
-        compression_level = config.get('flac_config', {}).get('compression_level', 8)
+        compression_level = deadline_controller.get_effort(
+            'flac', config.get('flac_config', {}).get('compression_level', 8)
+        )
         return f'-c:a flac -compression_level {compression_level}'
 
 
@@ -176,5 +305,7 @@ class WavPackConverter(FFMPEGAudioConverter):
         return 'WavPack'
 
     def _get_parameter(self):
-        compression_level = config.get('wavpack_config', {}).get('compression_level', 6)
+        compression_level = deadline_controller.get_effort(
+            'wavpack', config.get('wavpack_config', {}).get('compression_level', 6)
+        )
         return f'-c:a wavpack -compression_level {compression_level}'
@@ -0,0 +1,269 @@
+#  py_album_condense - a simple tool to compress and condense your album collections
+#  Copyright (c) 2022 kewenyu
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#  SOFTWARE.
+
+
+import os
+import math
+import struct
+import asyncio
+
+from audio_converter.tag_utils import TagUtils
+from common.config import config
+
+
+class LoudnessMeter:
+    def __init__(self, np, lfilter):
+        self.np = np
+        self.lfilter = lfilter
+        self.header = b''
+        self.remainder = b''
+        self.fmt = None
+        self.zi = None
+        self.weights = None
+        self.square_sum = None
+        self.sub_block_energies = []
+        self.peak = 0.0
+
+    def feed(self, chunk):
+        if self.fmt is None:
+            self.header += chunk
+            if (data := self._parse_header()) is None:
+                return
+            chunk = data
+
+        data = self.remainder + chunk
+        block_align = self.fmt['block_align']
+        usable = len(data) - len(data) % block_align
+        self.remainder = data[usable:]
+        if usable:
+            self._process(self._decode(data[:usable]))
+
+    def feed_file(self, file_path, chunk_size=1 << 20):
+        with open(file_path, 'rb') as wav_file:
+            while chunk := wav_file.read(chunk_size):
+                self.feed(chunk)
+
+    def get_block_energies(self):
+        np = self.np
+        sub_blocks = np.asarray(self.sub_block_energies, dtype=np.float64)
+        if len(sub_blocks) < 4:
+            return np.zeros(0)
+        # 400ms gating blocks with 75% overlap are built from four consecutive 100ms sub blocks
+        return np.convolve(sub_blocks, np.full(4, 0.25), mode='valid')
+
+    def _parse_header(self):
+        header = self.header
+        if len(header) < 12:
+            return None
+        if header[:4] != b'RIFF' or header[8:12] != b'WAVE':
+            raise RuntimeError('loudness meter expects a WAV stream')
+
+        offset = 12
+        fmt = None
+        while len(header) >= offset + 8:
+            chunk_id = header[offset:offset + 4]
+            chunk_size = struct.unpack('<I', header[offset + 4:offset + 8])[0]
+            if chunk_id == b'data':
+                if fmt is None:
+                    raise RuntimeError('WAV stream has no fmt chunk before data chunk')
+                self._setup(fmt)
+                return header[offset + 8:]
+
+            if len(header) < offset + 8 + chunk_size:
+                return None
+            if chunk_id == b'fmt ':
+                fmt = header[offset + 8:offset + 8 + chunk_size]
+            offset += 8 + chunk_size + chunk_size % 2
+
+        return None
+
+    def _setup(self, fmt_chunk):
+        np = self.np
+        format_tag, channels, sample_rate, _, block_align, bits = struct.unpack('<HHIIHH', fmt_chunk[:16])
+        if format_tag == 0xFFFE:
+            format_tag = struct.unpack('<H', fmt_chunk[24:26])[0]
+        if format_tag not in (1, 3):
+            raise RuntimeError(f'unsupported WAV format tag: {format_tag}')
+
+        self.fmt = {
+            'float': format_tag == 3,
+            'channels': channels,
+            'sample_rate': sample_rate,
+            'block_align': block_align,
+            'bits': bits,
+        }
+
+        # K-weighting: high shelf followed by high pass, coefficients derived for the actual sample rate
+        k = math.tan(math.pi * 1681.974450955533 / sample_rate)
+        q = 0.7071752369554196
+        vh = math.pow(10.0, 3.999843853973347 / 20.0)
+        vb = math.pow(vh, 0.4996667741545416)
+        a0 = 1.0 + k / q + k * k
+        shelf_b = [(vh + vb * k / q + k * k) / a0, 2.0 * (k * k - vh) / a0, (vh - vb * k / q + k * k) / a0]
+        shelf_a = [1.0, 2.0 * (k * k - 1.0) / a0, (1.0 - k / q + k * k) / a0]
+
+        k = math.tan(math.pi * 38.13547087602444 / sample_rate)
+        q = 0.5003270373238773
+        a0 = 1.0 + k / q + k * k
+        high_pass_b = [1.0, -2.0, 1.0]
+        high_pass_a = [1.0, 2.0 * (k * k - 1.0) / a0, (1.0 - k / q + k * k) / a0]
+
+        self.filter_b = np.convolve(shelf_b, high_pass_b)
+        self.filter_a = np.convolve(shelf_a, high_pass_a)
+        self.zi = np.zeros((len(self.filter_a) - 1, channels))
+
+        weights = np.ones(channels)
+        if channels == 6:
+            # L R C LFE Ls Rs, LFE is excluded and surround channels are boosted by 1.5dB
+            weights[:] = [1.0, 1.0, 1.0, 0.0, 1.41, 1.41]
+        self.weights = weights
+
+        self.step = sample_rate // 10
+        self.square_sum = np.zeros(0)
+
+    def _decode(self, data):
+        np = self.np
+        bits = self.fmt['bits']
+        if self.fmt['float']:
+            samples = np.frombuffer(data, dtype='<f4' if bits == 32 else '<f8').astype(np.float64)
+        elif bits == 8:
+            samples = (np.frombuffer(data, dtype=np.uint8).astype(np.float64) - 128.0) / 128.0
+        elif bits == 16:
+            samples = np.frombuffer(data, dtype='<i2') / 32768.0
+        elif bits == 24:
+            packed = np.frombuffer(data, dtype=np.uint8).reshape(-1, 3)
+            padded = np.zeros((len(packed), 4), dtype=np.uint8)
+            padded[:, 1:] = packed
+            samples = (padded.view('<i4').reshape(-1) >> 8) / 8388608.0
+        elif bits == 32:
+            samples = np.frombuffer(data, dtype='<i4') / 2147483648.0
+        else:
+            raise RuntimeError(f'unsupported WAV bit depth: {bits}')
+        return samples.reshape(-1, self.fmt['channels'])
+
+    def _process(self, samples):
+        np = self.np
+        self.peak = max(self.peak, float(np.max(np.abs(samples))))
+
+        filtered, self.zi = self.lfilter(self.filter_b, self.filter_a, samples, axis=0, zi=self.zi)
+        weighted = np.square(filtered) @ self.weights
+
+        pending = np.concatenate((self.square_sum, weighted))
+        complete = len(pending) - len(pending) % self.step
+        if complete:
+            sub_blocks = pending[:complete].reshape(-1, self.step).mean(axis=1)
+            self.sub_block_energies.extend(sub_blocks.tolist())
+        self.square_sum = pending[complete:]
+
+
+class LoudnessTracker:
+    def __init__(self):
+        self.albums = {}
+        self.album_tasks = {}
+        self.modules = None
+
+    def create_meter(self, file_path, *new_file_paths):
+        if not config.get('replaygain_config', {}).get('enable', False):
+            return None
+
+        new_file_paths = [path for path in new_file_paths if TagUtils.is_writable(path)]
+        if not new_file_paths or (modules := self._import_modules()) is None:
+            return None
+
+        meter = LoudnessMeter(*modules)
+        self.albums.setdefault(os.path.dirname(file_path), []).append((meter, new_file_paths, file_path))
+        return meter
+
+    def remove_meters(self, file_path):
+        # a retried job measures its outputs once more, and a failed one leaves none to tag
+        if (album_meters := self.albums.get(os.path.dirname(file_path))) is not None:
+            album_meters[:] = [entry for entry in album_meters if entry[2] != file_path]
+
+    async def write_tags(self, semaphore):
+        await asyncio.gather(*[self.write_album_tags(semaphore, album_dir) for album_dir in list(self.albums)])
+
+    async def write_album_tags(self, semaphore, album_dir):
+        # every destination of an album waits for the same tagging task
+        if (task := self.album_tasks.get(album_dir)) is None:
+            album_meters = self.albums.pop(album_dir, None)
+            if not album_meters:
+                return
+            task = self.album_tasks[album_dir] = asyncio.create_task(self._write_album_tags(semaphore, album_meters))
+        await task
+
+    async def _write_album_tags(self, semaphore, album_meters):
+        reference = config.get('replaygain_config', {}).get('reference_loudness', -18.0)
+        workers_list = []
+
+        np = album_meters[0][0].np
+        album_blocks = np.concatenate([meter.get_block_energies() for meter, _, _ in album_meters])
+        album_loudness = self._get_integrated_loudness(np, album_blocks)
+        album_peak = max(meter.peak for meter, _, _ in album_meters)
+
+        for meter, new_file_paths, _ in album_meters:
+            track_loudness = self._get_integrated_loudness(np, meter.get_block_energies())
+            if track_loudness is None or album_loudness is None:
+                continue
+
+            tags = {
+                'REPLAYGAIN_TRACK_GAIN': f'{reference - track_loudness:.2f} dB',
+                'REPLAYGAIN_TRACK_PEAK': f'{meter.peak:.6f}',
+                'REPLAYGAIN_ALBUM_GAIN': f'{reference - album_loudness:.2f} dB',
+                'REPLAYGAIN_ALBUM_PEAK': f'{album_peak:.6f}',
+            }
+            for new_file_path in new_file_paths:
+                file_tags = tags.copy()
+                if os.path.splitext(new_file_path)[1] == '.opus':
+                    # RFC 7845 gains are Q7.8 numbers relative to -23 LUFS
+                    file_tags['R128_TRACK_GAIN'] = str(round((-23.0 - track_loudness) * 256))
+                    file_tags['R128_ALBUM_GAIN'] = str(round((-23.0 - album_loudness) * 256))
+                workers_list.append(
+                    asyncio.create_task(TagUtils.write_tags(semaphore, file_tags, new_file_path))
+                )
+
+        await asyncio.gather(*workers_list)
+
+    @staticmethod
+    def _get_integrated_loudness(np, block_energies):
+        with np.errstate(divide='ignore'):
+            block_loudness = -0.691 + 10.0 * np.log10(block_energies)
+
+        gated = block_energies[block_loudness > -70.0]
+        if len(gated) == 0:
+            return None
+
+        relative_gate = -0.691 + 10.0 * math.log10(gated.mean()) - 10.0
+        gated = block_energies[block_loudness > max(relative_gate, -70.0)]
+        return -0.691 + 10.0 * math.log10(gated.mean())
+
+    def _import_modules(self):
+        if self.modules is None:
+            try:
+                import numpy
+                from scipy.signal import lfilter
+                self.modules = (numpy, lfilter)
+            except ModuleNotFoundError:
+                print('numpy and scipy are required for replaygain analysis, skipped')
+                self.modules = False
+        return self.modules or None
+
+
+loudness_tracker = LoudnessTracker()
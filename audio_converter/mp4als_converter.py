@@ -23,7 +23,10 @@ import os
 import asyncio
 
 from audio_converter.audio_converter import AudioConverter, AudioUtils
+from audio_converter.loudness import loudness_tracker
 from common.config import config
+from common.supervisor import supervisor
+from common.tracer import tracer
 from common.util import PathUtils
 
 
@@ -31,11 +34,15 @@ class ALSConverter(AudioConverter):
     def __init__(self, semaphore, file_path, src_path, dst_path):
         super().__init__(semaphore, file_path, src_path, dst_path)
 
+    @classmethod
+    def get_executables(cls):
+        return super().get_executables() + [config.get('executable', {}).get('mp4als', 'mp4als')]
+
     async def single_convert(self):
         ffmpeg_path = config.get('executable', {}).get('ffmpeg', 'ffmpeg')
         mp4als_path = config.get('executable', {}).get('mp4als', 'mp4als')
 
-        async with self.semaphore:
+        async with tracer.hold(self.semaphore, 'convert', file=self.file_path):
             print(f'converting to ALS: {self.file_path}')
             new_file_path = PathUtils.create_file_path_struct(self.file_path, self.src_path, self.dst_path, '.mp4')
             tmp_wav_file_path = os.path.join(
@@ -44,21 +51,27 @@ class ALSConverter(AudioConverter):
             )
             tmp_mp4_file_path = os.path.join(os.path.dirname(new_file_path), f'_tmp_{os.path.basename(new_file_path)}')
 
-            ffmpeg_cmd = f'"{ffmpeg_path}" -y -i "{self.file_path}" "{tmp_wav_file_path}"'
-            ffmpeg_process = await asyncio.create_subprocess_shell(
+            ffmpeg_cmd = f'"{ffmpeg_path}" -y -i "{self.input_path}"'
+            ffmpeg_cmd += f' {await self._get_decode_args()} "{tmp_wav_file_path}"'
+            ffmpeg_process = await supervisor.create_subprocess_shell(
                 ffmpeg_cmd,
                 stdout=asyncio.subprocess.DEVNULL,
                 stderr=asyncio.subprocess.DEVNULL
             )
-            await ffmpeg_process.communicate()
+            await supervisor.wait([ffmpeg_process])
+
+            # the intermediate wav is analysed directly, no extra decode is needed
+            meter = loudness_tracker.create_meter(self.file_path, os.path.splitext(new_file_path)[0] + '.m4a')
+            if meter is not None:
+                await asyncio.get_running_loop().run_in_executor(None, meter.feed_file, tmp_wav_file_path)
 
             mp4als_cmd = f'"{mp4als_path}" -7 -r-1 -MP4 "{tmp_wav_file_path}" "{tmp_mp4_file_path}"'
-            mp4als_process = await asyncio.create_subprocess_shell(
+            mp4als_process = await supervisor.create_subprocess_shell(
                 mp4als_cmd,
                 stderr=asyncio.subprocess.DEVNULL,
                 stdout=asyncio.subprocess.DEVNULL,
             )
-            await mp4als_process.communicate()
+            await supervisor.wait([mp4als_process])
 
             metadata = await AudioUtils.get_metadata_by_ffprobe(self.file_path)
             await AudioUtils.add_metadata_by_ffmpeg(metadata, tmp_mp4_file_path, new_file_path)
@@ -70,12 +83,12 @@ class ALSConverter(AudioConverter):
         ffmpeg_path = config.get('executable', {}).get('ffmpeg', 'ffmpeg')
         mp4als_path = config.get('executable', {}).get('mp4als', 'mp4als')
 
-        async with self.semaphore:
+        async with tracer.hold(self.semaphore, 'cue setup', file=self.file_path):
             new_file_dir = PathUtils.create_dir_path_struct(self.file_path, self.src_path, self.dst_path)
             tracks = self._get_cue_tracks()
 
             for track in tracks:
-                out_track_name = f'{track["idx"]:02d}. {track["title"]}.mp4'
+                out_track_name = f'{track.idx:02d}. {track.title}.mp4'
                 out_track_path = os.path.join(new_file_dir, out_track_name)
                 tmp_wav_track_path = os.path.join(
                     os.path.dirname(out_track_path),
@@ -86,43 +99,53 @@ class ALSConverter(AudioConverter):
                     f'_tmp_{os.path.basename(out_track_path)}'
                 )
 
-                ffmpeg_cmd = f'"{ffmpeg_path}" -y -i "{self.file_path}" -ss {track["start_time"]}'
-                if track.get('end_time'):
-                    ffmpeg_cmd += f' -to {track["end_time"]}'
-                ffmpeg_cmd += f' "{tmp_wav_track_path}"'
+                ffmpeg_cmd = f'"{ffmpeg_path}" -y -i "{self.input_path}" -ss {track.start_time}'
+                if track.end_time is not None:
+                    ffmpeg_cmd += f' -to {track.end_time}'
+                ffmpeg_cmd += f' {await self._get_decode_args()} "{tmp_wav_track_path}"'
 
                 mp4als_cmd = f'"{mp4als_path}" -7 -r-1 -MP4 "{tmp_wav_track_path}" "{tmp_mp4_track_path}"'
 
-                async def track_task(f_cmd, m_cmd, metadata, t_path, o_path, idx):
-                    async with self.semaphore:
+                async def track_task(f_cmd, m_cmd, metadata, w_path, t_path, o_path, idx):
+                    async with tracer.hold(self.semaphore, 'track', file=self.file_path, idx=idx):
                         print(f'converting to ALS: {self.file_path}, track {idx:02d}')
 
-                        ffmpeg_process = await asyncio.create_subprocess_shell(
+                        ffmpeg_process = await supervisor.create_subprocess_shell(
                             f_cmd,
                             stderr=asyncio.subprocess.DEVNULL,
                             stdout=asyncio.subprocess.DEVNULL
                         )
-                        await ffmpeg_process.communicate()
+                        await supervisor.wait([ffmpeg_process])
+
+                        meter = loudness_tracker.create_meter(self.file_path, os.path.splitext(o_path)[0] + '.m4a')
+                        if meter is not None:
+                            await asyncio.get_running_loop().run_in_executor(None, meter.feed_file, w_path)
 
-                        mp4als_process = await asyncio.create_subprocess_shell(
+                        mp4als_process = await supervisor.create_subprocess_shell(
                             m_cmd,
                             stderr=asyncio.subprocess.DEVNULL,
                             stdout=asyncio.subprocess.DEVNULL,
                         )
-                        await mp4als_process.communicate()
+                        await supervisor.wait([mp4als_process])
 
                         await AudioUtils.add_metadata_by_ffmpeg(metadata, t_path, o_path)
                         os.rename(o_path, os.path.splitext(o_path)[0] + '.m4a')
-                        os.remove(t_path)
+                        os.remove(w_path)
 
                 sub_worker = asyncio.create_task(
                     track_task(
-                        ffmpeg_cmd, mp4als_cmd, track['metadata'], tmp_mp4_track_path, out_track_path, track["idx"]
+                        ffmpeg_cmd,
+                        mp4als_cmd,
+                        track.metadata,
+                        tmp_wav_track_path,
+                        tmp_mp4_track_path,
+                        out_track_path,
+                        track.idx
                     )
                 )
                 sub_workers_list.append(sub_worker)
 
-        await asyncio.gather(*sub_workers_list)
+        await supervisor.gather(*sub_workers_list)
 
     def get_ext(self):
         return '.m4a'
@@ -0,0 +1,139 @@
+#  py_album_condense - a simple tool to compress and condense your album collections
+#  Copyright (c) 2022 kewenyu
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#  SOFTWARE.
+
+
+import os
+import asyncio
+
+from audio_converter.audio_converter import AudioUtils
+from audio_converter.loudness import loudness_tracker
+from common.config import config
+from common.supervisor import supervisor
+from common.tracer import tracer
+from common.util import PathUtils
+
+
+class MultiTargetConverter:
+    def __init__(self, semaphore, file_path, src_path, converters):
+        self.semaphore = semaphore
+        self.file_path = file_path
+        self.src_path = src_path
+        self.converters = converters
+        self.audio_info = None
+
+    @property
+    def input_path(self):
+        return self.converters[0].input_path
+
+    async def single_convert(self):
+        async with tracer.hold(self.semaphore, 'convert', file=self.file_path):
+            print(f'converting to {len(self.converters)} targets: {self.file_path}')
+
+            metadata = await AudioUtils.get_metadata_by_ffprobe(self.file_path)
+            targets = []
+            new_file_paths = []
+            for converter in self.converters:
+                new_file_path = PathUtils.create_file_path_struct(
+                    self.file_path, self.src_path, converter.dst_path, converter.get_ext()
+                )
+                targets.append(converter.get_tee_target(new_file_path, metadata))
+                new_file_paths.append(new_file_path)
+
+            meter = loudness_tracker.create_meter(self.file_path, *new_file_paths)
+            await self._tee_convert(targets, meter, '')
+
+    async def cue_convert(self):
+        sub_workers_list = []
+
+        async with tracer.hold(self.semaphore, 'cue setup', file=self.file_path):
+            new_file_dirs = [
+                PathUtils.create_dir_path_struct(self.file_path, self.src_path, converter.dst_path)
+                for converter in self.converters
+            ]
+
+            # every converter shares the same source, so the cue sheet only needs to be parsed once
+            for track in self.converters[0]._get_cue_tracks():
+                targets = []
+                out_track_paths = []
+                for converter, new_file_dir in zip(self.converters, new_file_dirs):
+                    out_track_name = f'{track.idx:02d}. {track.title}{converter.get_ext()}'
+                    out_track_path = os.path.join(new_file_dir, out_track_name)
+                    targets.append(converter.get_tee_target(out_track_path, track.metadata))
+                    out_track_paths.append(out_track_path)
+
+                meter = loudness_tracker.create_meter(self.file_path, *out_track_paths)
+
+                seek = f' -ss {track.start_time}'
+                if track.end_time is not None:
+                    seek += f' -to {track.end_time}'
+
+                async def track_task(t_list, m, s, idx):
+                    async with tracer.hold(self.semaphore, 'track', file=self.file_path, idx=idx):
+                        print(f'converting to {len(t_list)} targets: {self.file_path}, track {idx:02d}')
+                        await self._tee_convert(t_list, m, s)
+
+                sub_worker = asyncio.create_task(track_task(targets, meter, seek, track.idx))
+                sub_workers_list.append(sub_worker)
+
+        await supervisor.gather(*sub_workers_list)
+
+    @tracer.traced('tee encode')
+    async def _tee_convert(self, targets, meter, seek):
+        ffmpeg_path = config.get('executable', {}).get('ffmpeg', 'ffmpeg')
+        ffmpeg_cmd = f'"{ffmpeg_path}" -y -i "{self.input_path}"'
+        for target in targets:
+            if target.ffmpeg_output is not None:
+                ffmpeg_cmd += f'{seek} {target.ffmpeg_output}'
+
+        pipe_targets = [target for target in targets if target.encoder_cmd is not None]
+        need_pcm = pipe_targets or meter is not None
+        if need_pcm:
+            # the wav stream is shared by every pipe target, so it keeps the source format
+            if self.audio_info is None:
+                self.audio_info = await AudioUtils.get_audio_info_by_ffprobe(self.file_path)
+            ffmpeg_cmd += f'{seek} -c:a {AudioUtils.get_pcm_codec(self.audio_info, {})} -f wav -'
+
+        ffmpeg_process = await supervisor.create_subprocess_shell(
+            ffmpeg_cmd,
+            stdout=asyncio.subprocess.PIPE if need_pcm else asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.DEVNULL
+        )
+
+        encoder_processes = []
+        for target in pipe_targets:
+            encoder_process = await supervisor.create_subprocess_shell(
+                target.encoder_cmd,
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.DEVNULL
+            )
+            encoder_processes.append(encoder_process)
+
+        tee_tasks = []
+        if need_pcm:
+            sinks = [meter.feed] if meter is not None else []
+            tee_tasks.append(AudioUtils.tee_stream(ffmpeg_process.stdout, [p.stdin for p in encoder_processes], sinks))
+
+        await supervisor.wait([ffmpeg_process, *encoder_processes], *tee_tasks)
+
+        for target in targets:
+            if target.finalize is not None:
+                await target.finalize()
@@ -0,0 +1,175 @@
+#  py_album_condense - a simple tool to compress and condense your album collections
+#  Copyright (c) 2022 kewenyu
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#  SOFTWARE.
+
+
+import os
+import mmap
+import struct
+import asyncio
+
+from common.supervisor import supervisor
+from common.tracer import tracer
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_EXTENSIBLE = 0xfffe
+KSDATAFORMAT_SUBTYPE_PCM = b'\x01\x00\x00\x00\x00\x00\x10\x00\x80\x00\x00\xaa\x00\x38\x9b\x71'
+
+
+class PCMSource:
+    def __init__(self, file_path, container, fmt_chunk, data_offset, data_size, sample_rate, block_align, bits):
+        self.file_path = file_path
+        self.container = container
+        self.fmt_chunk = fmt_chunk
+        self.data_offset = data_offset
+        self.data_size = data_size
+        self.sample_rate = sample_rate
+        self.block_align = block_align
+        self.bits_per_sample = bits
+
+    @classmethod
+    def probe(cls, file_path, header_size=1 << 16):
+        try:
+            file_size = os.path.getsize(file_path)
+            with open(file_path, 'rb') as pcm_file:
+                header = pcm_file.read(header_size)
+        except OSError:
+            return None
+
+        if header[:4] == b'RIFF' and header[8:12] == b'WAVE':
+            return cls._probe_wav(file_path, header, file_size)
+        if header[:4] == b'FORM' and header[8:12] == b'AIFF':
+            return cls._probe_aiff(file_path, header, file_size)
+        return None
+
+    @classmethod
+    def _probe_wav(cls, file_path, header, file_size):
+        offset = 12
+        fmt_chunk = None
+        while len(header) >= offset + 8:
+            chunk_id = header[offset:offset + 4]
+            chunk_size = struct.unpack('<I', header[offset + 4:offset + 8])[0]
+            if chunk_id == b'fmt ':
+                fmt_chunk = header[offset:offset + 8 + chunk_size]
+            elif chunk_id == b'data':
+                if fmt_chunk is None or len(fmt_chunk) < 24:
+                    return None
+                format_tag, _, sample_rate, _, block_align, bits = struct.unpack('<HHIIHH', fmt_chunk[8:24])
+                # only integer pcm is handed over, every encoder here reads it while float support varies
+                if format_tag == WAVE_FORMAT_EXTENSIBLE:
+                    if fmt_chunk[32:48] != KSDATAFORMAT_SUBTYPE_PCM:
+                        return None
+                elif format_tag != WAVE_FORMAT_PCM:
+                    return None
+                data_size = min(chunk_size, file_size - offset - 8)
+                return cls(file_path, 'wav', fmt_chunk, offset + 8, data_size, sample_rate, block_align, bits)
+            offset += 8 + chunk_size + chunk_size % 2
+        return None
+
+    @classmethod
+    def _probe_aiff(cls, file_path, header, file_size):
+        offset = 12
+        comm_chunk = None
+        while len(header) >= offset + 8:
+            chunk_id = header[offset:offset + 4]
+            chunk_size = struct.unpack('>I', header[offset + 4:offset + 8])[0]
+            if chunk_id == b'COMM':
+                comm_chunk = header[offset + 8:offset + 8 + chunk_size]
+            elif chunk_id == b'SSND':
+                if comm_chunk is None or len(comm_chunk) < 18:
+                    return None
+                channels, _, bits = struct.unpack('>hIh', comm_chunk[:8])
+                # the sample rate is stored as an 80 bit extended precision float
+                exponent, mantissa = struct.unpack('>HQ', comm_chunk[8:18])
+                sample_rate = round(mantissa * 2.0 ** ((exponent & 0x7fff) - 16383 - 63))
+                data_offset = offset + 16 + struct.unpack('>I', header[offset + 8:offset + 12])[0]
+                data_size = min(chunk_size - 8, file_size - data_offset)
+                # aiff samples are big endian, so they are only handed over as a whole file
+                block_align = channels * ((bits + 7) // 8)
+                return cls(file_path, 'aiff', None, data_offset, data_size, sample_rate, block_align, bits)
+            offset += 8 + chunk_size + chunk_size % 2
+        return None
+
+    @tracer.traced('pcm file encode')
+    async def convert_file(self, encoder_cmd, meter=None, quiet=False):
+        encoder_output = asyncio.subprocess.DEVNULL if quiet else None
+        encoder_process = await supervisor.create_subprocess_shell(
+            encoder_cmd,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=encoder_output,
+            stderr=encoder_output,
+        )
+
+        if meter is not None:
+            await asyncio.get_running_loop().run_in_executor(None, meter.feed_file, self.file_path)
+        await supervisor.wait([encoder_process])
+        return encoder_process.returncode
+
+    @tracer.traced('pcm slice encode')
+    async def convert_slice(self, encoder_cmd, start_frame, end_frame=None, meter=None, quiet=False):
+        start = self._get_byte_offset(start_frame)
+        end = self._get_byte_offset(end_frame) if end_frame is not None else self.data_size
+        encoder_output = asyncio.subprocess.DEVNULL if quiet else None
+
+        pipe_reader, pipe_writer = os.pipe()
+        encoder_process = await supervisor.create_subprocess_shell(
+            encoder_cmd,
+            stdin=pipe_reader,
+            stdout=encoder_output,
+            stderr=encoder_output,
+        )
+        os.close(pipe_reader)
+
+        sinks = [meter.feed] if meter is not None else []
+        writer = asyncio.get_running_loop().run_in_executor(None, self._write_slice, pipe_writer, start, end, sinks)
+        await supervisor.wait([encoder_process], writer)
+
+    def _get_byte_offset(self, frame):
+        # cue frames are 1/75 second, which is a whole number of samples at every common cd and hi-res rate
+        sample = frame * self.sample_rate // 75
+        return min(sample * self.block_align, self.data_size)
+
+    def _get_wav_header(self, data_size):
+        fmt_chunk = self.fmt_chunk + b'\x00' * (len(self.fmt_chunk) % 2)
+        riff_size = 4 + len(fmt_chunk) + 8 + data_size
+        return b'RIFF' + struct.pack('<I', riff_size) + b'WAVE' + fmt_chunk + b'data' + struct.pack('<I', data_size)
+
+    def _write_slice(self, fd, start, end, sinks, chunk_size=1 << 20):
+        # the slice is written straight from the page cache mapping, nothing is decoded or copied in between
+        with open(self.file_path, 'rb') as pcm_file, mmap.mmap(pcm_file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            view = memoryview(mm)
+            try:
+                self._write_chunk(fd, self._get_wav_header(end - start), sinks)
+                for pos in range(self.data_offset + start, self.data_offset + end, chunk_size):
+                    with view[pos:min(pos + chunk_size, self.data_offset + end)] as chunk:
+                        self._write_chunk(fd, chunk, sinks)
+            except BrokenPipeError:
+                pass
+            finally:
+                view.release()
+                os.close(fd)
+
+    @staticmethod
+    def _write_chunk(fd, chunk, sinks):
+        for sink in sinks:
+            sink(chunk)
+        written = 0
+        while written < len(chunk):
+            written += os.write(fd, chunk[written:])
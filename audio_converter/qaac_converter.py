@@ -23,8 +23,12 @@ import os
 import asyncio
 import abc
 
-from audio_converter.audio_converter import AudioConverter, AudioUtils
+from audio_converter.audio_converter import AudioConverter, AudioUtils, TeeTarget
+from audio_converter.cover_art import cover_art_cache
+from audio_converter.loudness import loudness_tracker
 from common.config import config
+from common.supervisor import supervisor
+from common.tracer import tracer
 from common.util import PathUtils
 
 
@@ -32,90 +36,99 @@ class QAACConverter(AudioConverter, metaclass=abc.ABCMeta):
     def __init__(self, semaphore, file_path, src_path, dst_path):
         super().__init__(semaphore, file_path, src_path, dst_path)
 
+    @classmethod
+    def get_executables(cls):
+        return super().get_executables() + [config.get('executable', {}).get('qaac', 'qaac')]
+
     async def single_convert(self):
         ffmpeg_path = config.get('executable', {}).get('ffmpeg', 'ffmpeg')
-        qaac_path = config.get('executable', {}).get('qaac', 'qaac')
 
-        async with self.semaphore:
+        async with tracer.hold(self.semaphore, 'convert', file=self.file_path):
             print(f'converting to {self._get_format_name()}: {self.file_path}')
 
             new_file_path = PathUtils.create_file_path_struct(self.file_path, self.src_path, self.dst_path, '.m4a')
             metadata = await AudioUtils.get_metadata_by_ffprobe(self.file_path)
 
-            ffmpeg_cmd = f'"{ffmpeg_path}" -y -i "{self.file_path}" -f wav -'
-            qaac_cmd = f'"{qaac_path}" {self._get_parameters()} --ignorelength --silent'
-            qaac_cmd += ' ' + ' '.join([f'--long-tag "{k}":"{v}"' for k, v in metadata.items()])
-            qaac_cmd += f' -o "{new_file_path}" -'
-
-            pipe_reader, pipe_writer = os.pipe()
+            cover = await self._get_cover()
+            meter = loudness_tracker.create_meter(self.file_path, new_file_path)
 
-            ffmpeg_process = await asyncio.create_subprocess_shell(
-                ffmpeg_cmd,
-                stdout=pipe_writer,
-                stderr=asyncio.subprocess.DEVNULL
-            )
-            os.close(pipe_writer)
+            if (pcm_source := self._get_pcm_source(metered=meter is not None)) is not None:
+                qaac_cmd = self._get_encoder_cmd(new_file_path, metadata, cover, pcm_source.file_path)
+                await pcm_source.convert_file(qaac_cmd, meter)
+                return
 
-            qaac_process = await asyncio.create_subprocess_shell(
-                qaac_cmd,
-                stdin=pipe_reader,
-            )
-            os.close(pipe_reader)
-
-            await qaac_process.communicate()
-            await ffmpeg_process.communicate()
+            ffmpeg_cmd = f'"{ffmpeg_path}" -y -i "{self.input_path}" {await self._get_decode_args()} -f wav -'
+            qaac_cmd = self._get_encoder_cmd(new_file_path, metadata, cover)
+            await AudioUtils.pipe_convert(ffmpeg_cmd, qaac_cmd, meter)
 
     async def cue_convert(self):
         sub_workers_list = []
 
-        async with self.semaphore:
+        async with tracer.hold(self.semaphore, 'cue setup', file=self.file_path):
             new_file_dir = PathUtils.create_dir_path_struct(self.file_path, self.src_path, self.dst_path)
             tracks = self._get_cue_tracks()
+            cover = await self._get_cover()
+            pcm_source = self._get_pcm_source(sliced=True)
+            decode_args = await self._get_decode_args()
             for track in tracks:
-                out_track_name = f'{track["idx"]:02d}. {track["title"]}.m4a'
+                out_track_name = f'{track.idx:02d}. {track.title}.m4a'
                 out_track_path = os.path.join(new_file_dir, out_track_name)
 
                 ffmpeg_path = config.get('executable', {}).get('ffmpeg', 'ffmpeg')
-                ffmpeg_cmd = f'"{ffmpeg_path}" -y -i "{self.file_path}" -ss {track["start_time"]}'
-                if track.get('end_time'):
-                    ffmpeg_cmd += f' -to {track["end_time"]}'
-                ffmpeg_cmd += ' -f wav -'
-
-                qaac_path = config.get('executable', {}).get('qaac', 'qaac')
-                qaac_cmd = f'"{qaac_path}" {self._get_parameters()} --ignorelength --silent'
-                qaac_cmd += ' ' + ' '.join([f'--long-tag "{k}":"{v}"' for k, v in track['metadata'].items()])
-                qaac_cmd += f' -o "{out_track_path}" -'
-
-                async def track_task(f_cmd, q_cmd, idx):
-                    async with self.semaphore:
-                        print(f'converting to {self._get_format_name()}: {self.file_path}, track {idx:02d}')
+                ffmpeg_cmd = f'"{ffmpeg_path}" -y -i "{self.input_path}" -ss {track.start_time}'
+                if track.end_time is not None:
+                    ffmpeg_cmd += f' -to {track.end_time}'
+                ffmpeg_cmd += f' {decode_args} -f wav -'
 
-                        pipe_reader, pipe_writer = os.pipe()
+                qaac_cmd = self._get_encoder_cmd(out_track_path, track.metadata, cover)
+                meter = loudness_tracker.create_meter(self.file_path, out_track_path)
 
-                        ffmpeg_process = await asyncio.create_subprocess_shell(
-                            f_cmd,
-                            stderr=asyncio.subprocess.DEVNULL,
-                            stdout=pipe_writer
-                        )
-                        os.close(pipe_writer)
-
-                        qaac_process = await asyncio.create_subprocess_shell(
-                            q_cmd,
-                            stdin=pipe_reader,
-                        )
-                        os.close(pipe_reader)
-
-                        await qaac_process.communicate()
-                        await ffmpeg_process.communicate()
+                async def track_task(f_cmd, q_cmd, m, t, idx):
+                    async with tracer.hold(self.semaphore, 'track', file=self.file_path, idx=idx):
+                        print(f'converting to {self._get_format_name()}: {self.file_path}, track {idx:02d}')
+                        if pcm_source is not None:
+                            await pcm_source.convert_slice(q_cmd, t.start_frame, t.end_frame, m)
+                        else:
+                            await AudioUtils.pipe_convert(f_cmd, q_cmd, m)
 
-                sub_worker = asyncio.create_task(track_task(ffmpeg_cmd, qaac_cmd, track["idx"]))
+                sub_worker = asyncio.create_task(track_task(ffmpeg_cmd, qaac_cmd, meter, track, track.idx))
                 sub_workers_list.append(sub_worker)
 
-        await asyncio.gather(*sub_workers_list)
+        await supervisor.gather(*sub_workers_list)
 
     def get_ext(self):
         return '.m4a'
 
+    async def _convert_segment(self, input_args, trim_filter, segment_path):
+        ffmpeg_path = config.get('executable', {}).get('ffmpeg', 'ffmpeg')
+        ffmpeg_cmd = f'"{ffmpeg_path}" -y {input_args} -i "{self.input_path}"'
+        ffmpeg_cmd += f' {await self._get_decode_args(trim_filter)} -f wav -'
+        await AudioUtils.pipe_convert(ffmpeg_cmd, self._get_encoder_cmd(segment_path, {}))
+
+    def get_tee_target(self, new_file_path, metadata):
+        return TeeTarget(encoder_cmd=self._get_encoder_cmd(new_file_path, metadata))
+
+    async def _get_cover(self):
+        if not self._embeds_cover():
+            return None
+        return await cover_art_cache.get_cover(self.file_path, self.src_path)
+
+    def _embeds_cover(self):
+        return False
+
+    def _get_pcm_containers(self):
+        return 'wav', 'aiff'
+
+    def _get_encoder_cmd(self, new_file_path, metadata, cover=None, input_path='-'):
+        qaac_path = config.get('executable', {}).get('qaac', 'qaac')
+        qaac_cmd = f'"{qaac_path}" {self._get_parameters()} --ignorelength --silent'
+        if cover is not None:
+            qaac_cmd += f' --artwork "{cover.path}"'
+        qaac_cmd += ' ' + ' '.join([f'--long-tag "{k}":"{v}"' for k, v in metadata.items()])
+        qaac_cmd += f' -o "{new_file_path}"'
+        qaac_cmd += ' -' if input_path == '-' else f' "{input_path}"'
+        return qaac_cmd
+
     @abc.abstractmethod
     def _get_format_name(self):
         raise NotImplemented
@@ -129,6 +142,13 @@ class AACConverter(QAACConverter):
     def __init__(self, semaphore, file_path, src_path, dst_path):
         super().__init__(semaphore, file_path, src_path, dst_path)
 
+    def _embeds_cover(self):
+        return True
+
+    def _get_input_format(self):
+        # aac is limited to 48kHz, and more than 24 bits are of no use to a lossy encoder
+        return {'max_sample_rate': 48000, 'max_bit_depth': 24}
+
     def _get_format_name(self):
         return 'AAC'
 
@@ -145,6 +165,9 @@ class ALACConverter(QAACConverter):
     def __init__(self, semaphore, file_path, src_path, dst_path):
         super().__init__(semaphore, file_path, src_path, dst_path)
 
+    def is_chunk_joinable(self):
+        return True
+
     def _get_format_name(self):
         return 'ALAC'
 
@@ -0,0 +1,117 @@
+#  py_album_condense - a simple tool to compress and condense your album collections
+#  Copyright (c) 2022 kewenyu
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#  SOFTWARE.
+
+
+import os
+import base64
+import asyncio
+
+from audio_converter.audio_converter import AudioUtils
+from common.tracer import tracer
+
+
+class TagUtils:
+    @staticmethod
+    def is_writable(file_path):
+        try:
+            import mutagen
+            return True
+        except ModuleNotFoundError:
+            # ffmpeg can not remux TAK and drops non-iTunes tags in MP4
+            return os.path.splitext(file_path)[1] not in ('.tak', '.m4a', '.mp4')
+
+    @staticmethod
+    @tracer.traced('write tags')
+    async def write_tags(semaphore, tags, file_path):
+        async with semaphore:
+            print(f'writing replaygain tags: {file_path}')
+            try:
+                import mutagen
+                await asyncio.get_running_loop().run_in_executor(None, TagUtils._write_tags_in_place, tags, file_path)
+            except ModuleNotFoundError:
+                tmp_file_path = os.path.join(os.path.dirname(file_path), f'_tmp_{os.path.basename(file_path)}')
+                os.replace(file_path, tmp_file_path)
+                await AudioUtils.add_metadata_by_ffmpeg(tags, tmp_file_path, file_path)
+
+    @staticmethod
+    def _write_tags_in_place(tags, file_path):
+        from mutagen.apev2 import APEv2, APENoHeaderError
+        from mutagen.id3 import ID3, ID3NoHeaderError, TXXX
+        from mutagen.mp4 import MP4, MP4FreeForm
+        import mutagen
+
+        ext = os.path.splitext(file_path)[1]
+        if ext in ('.tak', '.wv', '.tta', '.ape'):
+            try:
+                ape_tags = APEv2(file_path)
+            except APENoHeaderError:
+                ape_tags = APEv2()
+            ape_tags.update(tags)
+            ape_tags.save(file_path)
+        elif ext == '.mp3':
+            try:
+                id3_tags = ID3(file_path)
+            except ID3NoHeaderError:
+                id3_tags = ID3()
+            for k, v in tags.items():
+                id3_tags.add(TXXX(encoding=3, desc=k, text=[v]))
+            id3_tags.save(file_path)
+        elif ext in ('.m4a', '.mp4'):
+            mp4_file = MP4(file_path)
+            for k, v in tags.items():
+                mp4_file[f'----:com.apple.iTunes:{k.lower()}'] = [MP4FreeForm(v.encode('utf-8'))]
+            mp4_file.save()
+        else:
+            tagged_file = mutagen.File(file_path)
+            for k, v in tags.items():
+                tagged_file[k] = [v]
+            tagged_file.save()
+
+    @staticmethod
+    def embed_cover(cover_data, file_path):
+        from mutagen.flac import FLAC, Picture
+        from mutagen.id3 import ID3, ID3NoHeaderError, APIC
+        from mutagen.mp4 import MP4, MP4Cover
+        import mutagen
+
+        ext = os.path.splitext(file_path)[1]
+        if ext == '.mp3':
+            try:
+                id3_tags = ID3(file_path)
+            except ID3NoHeaderError:
+                id3_tags = ID3()
+            id3_tags.add(APIC(encoding=3, mime='image/jpeg', type=3, desc='Cover', data=cover_data))
+            id3_tags.save(file_path)
+        elif ext in ('.m4a', '.mp4'):
+            mp4_file = MP4(file_path)
+            mp4_file['covr'] = [MP4Cover(cover_data, imageformat=MP4Cover.FORMAT_JPEG)]
+            mp4_file.save()
+        else:
+            picture = Picture()
+            picture.type = 3
+            picture.mime = 'image/jpeg'
+            picture.data = cover_data
+            tagged_file = mutagen.File(file_path)
+            if isinstance(tagged_file, FLAC):
+                tagged_file.add_picture(picture)
+            else:
+                tagged_file['METADATA_BLOCK_PICTURE'] = [base64.b64encode(picture.write()).decode('ascii')]
+            tagged_file.save()
@@ -22,8 +22,12 @@
 import os
 import asyncio
 
-from audio_converter.audio_converter import AudioConverter, AudioUtils
+from audio_converter.audio_converter import AudioConverter, AudioUtils, TeeTarget
+from audio_converter.loudness import loudness_tracker
 from common.config import config
+from common.deadline import deadline_controller
+from common.supervisor import supervisor
+from common.tracer import tracer
 from common.util import PathUtils
 
 
@@ -31,89 +35,82 @@ class TakConverter(AudioConverter):
     def __init__(self, semaphore, file_path, src_path, dst_path):
         super().__init__(semaphore, file_path, src_path, dst_path)
 
+    @classmethod
+    def get_executables(cls):
+        return super().get_executables() + [config.get('executable', {}).get('takc', 'takc')]
+
     async def single_convert(self):
         ffmpeg_path = config.get('executable', {}).get('ffmpeg', 'ffmpeg')
-        takc_path = config.get('executable', {}).get('takc', 'takc')
-        tak_preset = config.get('tak_config', {}).get('preset', 'p4m')
 
-        async with self.semaphore:
+        async with tracer.hold(self.semaphore, 'convert', file=self.file_path):
             print(f'converting to TAK: {self.file_path}')
 
             new_file_path = PathUtils.create_file_path_struct(self.file_path, self.src_path, self.dst_path, '.tak')
             metadata = await AudioUtils.get_metadata_by_ffprobe(self.file_path)
 
-            ffmpeg_cmd = f'"{ffmpeg_path}" -y -i "{self.file_path}" -f wav -'
-            takc_cmd = f'"{takc_path}" -e -ihs -silent -md5 -overwrite -{tak_preset}'
-            takc_cmd += ' ' + ' '.join([f'-tt "{k}"="{v}"' for k, v in metadata.items()])
-            takc_cmd += f' - "{new_file_path}"'
-
-            pipe_reader, pipe_writer = os.pipe()
+            meter = loudness_tracker.create_meter(self.file_path, new_file_path)
 
-            ffmpeg_process = await asyncio.create_subprocess_shell(
-                ffmpeg_cmd,
-                stdout=pipe_writer,
-                stderr=asyncio.subprocess.DEVNULL
-            )
-            os.close(pipe_writer)
+            if (pcm_source := self._get_pcm_source(metered=meter is not None)) is not None:
+                takc_cmd = self._get_encoder_cmd(new_file_path, metadata, pcm_source.file_path)
+                await pcm_source.convert_file(takc_cmd, meter)
+                return
 
-            takc_process = await asyncio.create_subprocess_shell(
-                takc_cmd,
-                stdin=pipe_reader,
-            )
-            os.close(pipe_reader)
-
-            await takc_process.communicate()
-            await ffmpeg_process.communicate()
+            ffmpeg_cmd = f'"{ffmpeg_path}" -y -i "{self.input_path}" {await self._get_decode_args()} -f wav -'
+            takc_cmd = self._get_encoder_cmd(new_file_path, metadata)
+            await AudioUtils.pipe_convert(ffmpeg_cmd, takc_cmd, meter)
 
     async def cue_convert(self):
         sub_workers_list = []
         ffmpeg_path = config.get('executable', {}).get('ffmpeg', 'ffmpeg')
-        takc_path = config.get('executable', {}).get('takc', 'takc')
-        tak_preset = config.get('tak_config', {}).get('preset', 'p4m')
 
-        async with self.semaphore:
+        async with tracer.hold(self.semaphore, 'cue setup', file=self.file_path):
             new_file_dir = PathUtils.create_dir_path_struct(self.file_path, self.src_path, self.dst_path)
             tracks = self._get_cue_tracks()
+            pcm_source = self._get_pcm_source(sliced=True)
+            decode_args = await self._get_decode_args()
 
             for track in tracks:
-                out_track_name = f'{track["idx"]:02d}. {track["title"]}.tak'
+                out_track_name = f'{track.idx:02d}. {track.title}.tak'
                 out_track_path = os.path.join(new_file_dir, out_track_name)
 
-                ffmpeg_cmd = f'"{ffmpeg_path}" -y -i "{self.file_path}" -ss {track["start_time"]}'
-                if track.get('end_time'):
-                    ffmpeg_cmd += f' -to {track["end_time"]}'
-                ffmpeg_cmd += ' -f wav -'
+                ffmpeg_cmd = f'"{ffmpeg_path}" -y -i "{self.input_path}" -ss {track.start_time}'
+                if track.end_time is not None:
+                    ffmpeg_cmd += f' -to {track.end_time}'
+                ffmpeg_cmd += f' {decode_args} -f wav -'
 
-                takc_cmd = f'"{takc_path}" -e -ihs -silent -md5 -overwrite -{tak_preset}'
-                takc_cmd += ' ' + ' '.join([f'-tt "{k}"="{v}"' for k, v in track['metadata'].items()])
-                takc_cmd += f' - "{out_track_path}"'
+                takc_cmd = self._get_encoder_cmd(out_track_path, track.metadata)
+                meter = loudness_tracker.create_meter(self.file_path, out_track_path)
 
-                async def track_task(f_cmd, t_cmd, idx):
-                    async with self.semaphore:
+                async def track_task(f_cmd, t_cmd, m, t, idx):
+                    async with tracer.hold(self.semaphore, 'track', file=self.file_path, idx=idx):
                         print(f'converting to TAK: {self.file_path}, track {idx:02d}')
+                        if pcm_source is not None:
+                            await pcm_source.convert_slice(t_cmd, t.start_frame, t.end_frame, m)
+                        else:
+                            await AudioUtils.pipe_convert(f_cmd, t_cmd, m)
 
-                        pipe_reader, pipe_writer = os.pipe()
+                sub_worker = asyncio.create_task(track_task(ffmpeg_cmd, takc_cmd, meter, track, track.idx))
+                sub_workers_list.append(sub_worker)
 
-                        ffmpeg_process = await asyncio.create_subprocess_shell(
-                            f_cmd,
-                            stderr=asyncio.subprocess.DEVNULL,
-                            stdout=pipe_writer
-                        )
-                        os.close(pipe_writer)
+        await supervisor.gather(*sub_workers_list)
 
-                        takc_process = await asyncio.create_subprocess_shell(
-                            t_cmd,
-                            stdin=pipe_reader,
-                        )
-                        os.close(pipe_reader)
+    def get_ext(self):
+        return '.tak'
 
-                        await takc_process.communicate()
-                        await ffmpeg_process.communicate()
+    def get_tee_target(self, new_file_path, metadata):
+        return TeeTarget(encoder_cmd=self._get_encoder_cmd(new_file_path, metadata))
 
-                sub_worker = asyncio.create_task(track_task(ffmpeg_cmd, takc_cmd, track["idx"]))
-                sub_workers_list.append(sub_worker)
+    def _get_pcm_containers(self):
+        return 'wav',
 
-        await asyncio.gather(*sub_workers_list)
+    def _get_input_format(self):
+        return {'max_bit_depth': 24}
 
-    def get_ext(self):
-        return '.tak'
+    def _get_encoder_cmd(self, new_file_path, metadata, input_path='-'):
+        takc_path = config.get('executable', {}).get('takc', 'takc')
+        tak_preset = deadline_controller.get_effort('tak', config.get('tak_config', {}).get('preset', 'p4m'))
+        takc_cmd = f'"{takc_path}" -e -ihs -silent -md5 -overwrite -{tak_preset}'
+        takc_cmd += ' ' + ' '.join([f'-tt "{k}"="{v}"' for k, v in metadata.items()])
+        takc_cmd += ' -' if input_path == '-' else f' "{input_path}"'
+        takc_cmd += f' "{new_file_path}"'
+        return takc_cmd
@@ -0,0 +1,96 @@
+#  py_album_condense - a simple tool to compress and condense your album collections
+#  Copyright (c) 2022 kewenyu
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#  SOFTWARE.
+
+
+import asyncio
+import hashlib
+
+from common.archive import archive_source
+from common.config import config
+from common.supervisor import supervisor
+from common.tracer import tracer
+
+
+class PCMVerifier:
+    def __init__(self):
+        self.semaphore = None
+        self.failures = []
+
+    @property
+    def enabled(self):
+        return self.semaphore is not None
+
+    def setup(self, worker_num):
+        # verification gets its own pool so that it overlaps with the conversions still in progress
+        self.semaphore = asyncio.Semaphore(config.get('verify_config', {}).get('worker_num', worker_num))
+
+    def get_retries(self):
+        return config.get('verify_config', {}).get('retries', 1)
+
+    @tracer.traced('verify')
+    async def verify(self, file_path, new_file_path):
+        async with self.semaphore:
+            print(f'verifying: {new_file_path}')
+            src_digest, dst_digest = await asyncio.gather(
+                self._hash_pcm(file_path),
+                self._hash_pcm(new_file_path),
+            )
+
+        if src_digest is None or src_digest != dst_digest:
+            print(f'verification failed: {new_file_path}')
+            return False
+        return True
+
+    def report(self):
+        if self.failures:
+            print(f'{len(self.failures)} files failed verification:')
+            for file_path in self.failures:
+                print(f'    {file_path}')
+
+    @staticmethod
+    async def _hash_pcm(file_path, chunk_size=1 << 20):
+        ffmpeg_path = config.get('executable', {}).get('ffmpeg', 'ffmpeg')
+        # decode to 32 bit integer samples, so that any lossless bit depth compares equal
+        ffmpeg_cmd = f'"{ffmpeg_path}" -i "{archive_source.get_input(file_path)}"'
+        ffmpeg_cmd += ' -map 0:a:0 -c:a pcm_s32le -f s32le -'
+        ffmpeg_process = await supervisor.create_subprocess_shell(
+            ffmpeg_cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL
+        )
+
+        digest = hashlib.blake2b()
+        size = 0
+
+        async def read_pcm():
+            nonlocal size
+            while chunk := await ffmpeg_process.stdout.read(chunk_size):
+                digest.update(chunk)
+                size += len(chunk)
+
+        await supervisor.wait([ffmpeg_process], read_pcm())
+
+        if ffmpeg_process.returncode != 0:
+            return None
+        return size, digest.hexdigest()
+
+
+pcm_verifier = PCMVerifier()
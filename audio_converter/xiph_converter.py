@@ -0,0 +1,233 @@
+#  py_album_condense - a simple tool to compress and condense your album collections
+#  Copyright (c) 2022 kewenyu
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#  SOFTWARE.
+
+
+import os
+import asyncio
+import abc
+
+from audio_converter.audio_converter import AudioConverter, AudioUtils, TeeTarget
+from audio_converter.cover_art import cover_art_cache
+from audio_converter.loudness import loudness_tracker
+from audio_converter.verifier import pcm_verifier
+from common.config import config
+from common.deadline import deadline_controller
+from common.supervisor import supervisor
+from common.tracer import tracer
+from common.util import PathUtils
+
+
+class XiphConverter(AudioConverter, metaclass=abc.ABCMeta):
+    def __init__(self, semaphore, file_path, src_path, dst_path):
+        super().__init__(semaphore, file_path, src_path, dst_path)
+
+    async def single_convert(self):
+        async with tracer.hold(self.semaphore, 'convert', file=self.file_path):
+            print(f'converting to {self._get_format_name()}: {self.file_path}')
+
+            new_file_path = PathUtils.create_file_path_struct(
+                self.file_path, self.src_path, self.dst_path, self.get_ext()
+            )
+            metadata = await AudioUtils.get_metadata_by_ffprobe(self.file_path)
+
+            cover = await self._get_cover()
+            meter = loudness_tracker.create_meter(self.file_path, new_file_path)
+
+            if (pcm_source := self._get_pcm_source(metered=meter is not None)) is not None:
+                encoder_cmd = self._get_encoder_cmd(new_file_path, metadata, cover, pcm_source.file_path)
+                return await pcm_source.convert_file(encoder_cmd, meter)
+
+            return await self.encode(new_file_path, meter, metadata, cover)
+
+    async def encode(self, new_file_path, meter=None, metadata=None, cover=None):
+        ffmpeg_path = config.get('executable', {}).get('ffmpeg', 'ffmpeg')
+        ffmpeg_cmd = f'"{ffmpeg_path}" -y -i "{self.input_path}" {await self._get_decode_args()} -f wav -'
+        encoder_cmd = self._get_encoder_cmd(new_file_path, metadata or {}, cover)
+        return await AudioUtils.pipe_convert(ffmpeg_cmd, encoder_cmd, meter)
+
+    async def cue_convert(self):
+        sub_workers_list = []
+
+        async with tracer.hold(self.semaphore, 'cue setup', file=self.file_path):
+            new_file_dir = PathUtils.create_dir_path_struct(self.file_path, self.src_path, self.dst_path)
+            tracks = self._get_cue_tracks()
+            cover = await self._get_cover()
+            pcm_source = self._get_pcm_source(sliced=True)
+            decode_args = await self._get_decode_args()
+            for track in tracks:
+                out_track_name = f'{track.idx:02d}. {track.title}{self.get_ext()}'
+                out_track_path = os.path.join(new_file_dir, out_track_name)
+
+                ffmpeg_path = config.get('executable', {}).get('ffmpeg', 'ffmpeg')
+                ffmpeg_cmd = f'"{ffmpeg_path}" -y -i "{self.input_path}" -ss {track.start_time}'
+                if track.end_time is not None:
+                    ffmpeg_cmd += f' -to {track.end_time}'
+                ffmpeg_cmd += f' {decode_args} -f wav -'
+
+                encoder_cmd = self._get_encoder_cmd(out_track_path, track.metadata, cover)
+                meter = loudness_tracker.create_meter(self.file_path, out_track_path)
+
+                async def track_task(f_cmd, e_cmd, m, t, idx):
+                    async with tracer.hold(self.semaphore, 'track', file=self.file_path, idx=idx):
+                        print(f'converting to {self._get_format_name()}: {self.file_path}, track {idx:02d}')
+                        if pcm_source is not None:
+                            await pcm_source.convert_slice(e_cmd, t.start_frame, t.end_frame, m)
+                        else:
+                            await AudioUtils.pipe_convert(f_cmd, e_cmd, m)
+
+                sub_worker = asyncio.create_task(track_task(ffmpeg_cmd, encoder_cmd, meter, track, track.idx))
+                sub_workers_list.append(sub_worker)
+
+        await supervisor.gather(*sub_workers_list)
+
+    def get_tee_target(self, new_file_path, metadata):
+        return TeeTarget(encoder_cmd=self._get_encoder_cmd(new_file_path, metadata))
+
+    async def _get_cover(self):
+        if not self._embeds_cover():
+            return None
+        return await cover_art_cache.get_cover(self.file_path, self.src_path)
+
+    def _embeds_cover(self):
+        return False
+
+    def _get_pcm_containers(self):
+        return 'wav', 'aiff'
+
+    @abc.abstractmethod
+    def _get_encoder_cmd(self, new_file_path, metadata, cover=None, input_path='-'):
+        raise NotImplemented
+
+    @abc.abstractmethod
+    def _get_format_name(self):
+        raise NotImplemented
+
+
+class FLACToolConverter(XiphConverter):
+    def __init__(self, semaphore, file_path, src_path, dst_path):
+        super().__init__(semaphore, file_path, src_path, dst_path)
+
+    @classmethod
+    def get_executables(cls):
+        return super().get_executables() + [config.get('executable', {}).get('flac', 'flac')]
+
+    def get_ext(self):
+        return '.flac'
+
+    def _get_format_name(self):
+        return 'FLAC'
+
+    def _get_encoder_cmd(self, new_file_path, metadata, cover=None, input_path='-'):
+        flac_path = config.get('executable', {}).get('flac', 'flac')
+        # same level as the ffmpeg backend, so that both produce equivalent files
+        compression_level = deadline_controller.get_effort(
+            'flac', config.get('flac_config', {}).get('compression_level', 8)
+        )
+        flac_cmd = f'"{flac_path}" -{compression_level} --silent -f'
+        if (threads := config.get('flac_config', {}).get('threads', 1)) > 1:
+            flac_cmd += f' -j {threads}'
+        flac_cmd += ' ' + ' '.join([f'-T "{k}={v}"' for k, v in metadata.items()])
+        flac_cmd += f' -o "{new_file_path}"'
+        # the wav header written by ffmpeg to a pipe has no valid sizes
+        flac_cmd += ' --ignore-chunk-sizes -' if input_path == '-' else f' "{input_path}"'
+        return flac_cmd
+
+
+class OpusencConverter(XiphConverter):
+    def __init__(self, semaphore, file_path, src_path, dst_path):
+        super().__init__(semaphore, file_path, src_path, dst_path)
+
+    @classmethod
+    def get_executables(cls):
+        return super().get_executables() + [config.get('executable', {}).get('opusenc', 'opusenc')]
+
+    def get_ext(self):
+        return '.opus'
+
+    def _embeds_cover(self):
+        return True
+
+    def _get_input_format(self):
+        return {'sample_rate': 48000}
+
+    def _get_format_name(self):
+        return 'OPUS'
+
+    def _get_encoder_cmd(self, new_file_path, metadata, cover=None, input_path='-'):
+        opusenc_path = config.get('executable', {}).get('opusenc', 'opusenc')
+        bitrate = config.get('opus_config', {}).get('bitrate', 128)
+        opusenc_cmd = f'"{opusenc_path}" --quiet --bitrate {bitrate}'
+        if cover is not None:
+            opusenc_cmd += f' --picture "{cover.path}"'
+        opusenc_cmd += ' ' + ' '.join([f'--comment "{k}={v}"' for k, v in metadata.items()])
+        opusenc_cmd += ' --ignorelength -' if input_path == '-' else f' "{input_path}"'
+        opusenc_cmd += f' "{new_file_path}"'
+        return opusenc_cmd
+
+
+class WavPackToolConverter(XiphConverter):
+    def __init__(self, semaphore, file_path, src_path, dst_path):
+        super().__init__(semaphore, file_path, src_path, dst_path)
+
+    @classmethod
+    def get_executables(cls):
+        return super().get_executables() + [config.get('executable', {}).get('wavpack', 'wavpack')]
+
+    def get_ext(self):
+        return '.wv'
+
+    def _get_format_name(self):
+        return 'WavPack'
+
+    def _get_encoder_cmd(self, new_file_path, metadata, cover=None, input_path='-'):
+        wavpack_path = config.get('executable', {}).get('wavpack', 'wavpack')
+        compression_level = deadline_controller.get_effort(
+            'wavpack', config.get('wavpack_config', {}).get('compression_level', 6)
+        )
+        wavpack_cmd = f'"{wavpack_path}" -q -y'
+        if mode_args := self._get_mode_args(compression_level):
+            wavpack_cmd += f' {mode_args}'
+        wavpack_cmd += ' ' + ' '.join([f'-w "{k}={v}"' for k, v in metadata.items()])
+        # the wav header written by ffmpeg to a pipe has no valid sizes
+        wavpack_cmd += ' -i -' if input_path == '-' else f' "{input_path}"'
+        wavpack_cmd += f' "{new_file_path}"'
+        return wavpack_cmd
+
+    def _get_mode_args(self, compression_level):
+        # roughly the effort of the same ffmpeg compression level: fast, normal, high and very high mode,
+        # and extra processing on top of very high mode above that
+        if compression_level < 4:
+            return ['-f', '', '-h', '-hh'][max(compression_level, 0)]
+        return f'-hh -x{min(compression_level - 3, 6)}'
+
+
+class WavPackHybridConverter(WavPackToolConverter):
+    def __init__(self, semaphore, file_path, src_path, dst_path):
+        super().__init__(semaphore, file_path, src_path, dst_path)
+
+    def _get_mode_args(self, compression_level):
+        # a lossy .wv and a .wvc correction file next to it, both together decode to the original
+        bitrate = config.get('wavpack_config', {}).get('hybrid_bitrate', 320)
+        mode_args = f'{super()._get_mode_args(compression_level)} -b{bitrate} -c'
+        if pcm_verifier.enabled:
+            # ffmpeg ignores correction files, so wavpack verifies the lossless result itself
+            mode_args += ' -v'
+        return mode_args
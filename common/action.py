@@ -21,12 +21,21 @@
 
 import os
 import asyncio
+import shutil
+import functools
 
+from common.checksum import checksum_cache
 from common.config import config
+from common.supervisor import supervisor, job_duration, job_outputs, ProcessStalledError
+from common.probe_cache import probe_cache
+from common.tracer import tracer
+from common.archive import archive_source
 from common.util import PathUtils
 from cue.cue_loader import CueFileLoader
+from audio_converter.audio_converter import AudioUtils
+from audio_converter.loudness import loudness_tracker
 
-from audio_converter.ffmpeg_converter import MP3Converter, OpusConverter, VorbisConverter
+from audio_converter.ffmpeg_converter import MP3Converter, OpusConverter, VorbisConverter, StreamCopyConverter
 from audio_converter.qaac_converter import AACConverter
 from audio_converter.exhale_converter import ExhaleConverter
 from image_converter.ffmpeg_converter import WebpConverter, JPEGConverter
@@ -35,28 +44,86 @@ from audio_converter.ffmpeg_converter import FLACConverter, TrueAudioConverter,
 from audio_converter.qaac_converter import ALACConverter
 from audio_converter.tak_converter import TakConverter
 from audio_converter.mp4als_converter import ALSConverter
+from audio_converter.xiph_converter import WavPackHybridConverter
 from image_converter.ffmpeg_converter import PNGConverter, WebpLosslessConverter
+from audio_converter.multi_converter import MultiTargetConverter
+from audio_converter.verifier import pcm_verifier
+from audio_converter.backend import backend_selector
 
 
-async def audio_convert(semaphore, file_path, src_path, dst_path):
-    audio_codec_handlers = {
-        'opus': OpusConverter,
-        'aac': AACConverter,
-        'usac': ExhaleConverter,
-        'vorbis': VorbisConverter,
-        'mp3': MP3Converter,
-    }
+audio_codec_handlers = {
+    'opus': OpusConverter,
+    'aac': AACConverter,
+    'usac': ExhaleConverter,
+    'vorbis': VorbisConverter,
+    'mp3': MP3Converter,
+}
+
+lossless_audio_codec_handlers = {
+    'flac': FLACConverter,
+    'alac': ALACConverter,
+    'tak': TakConverter,
+    'wavpack': WavPackConverter,
+    'tta': TrueAudioConverter,
+    'als': ALSConverter,
+}
+
+
+def supervised(convert):
+    @functools.wraps(convert)
+    async def wrapper(semaphore, file_path, *args, **kwargs):
+        if not supervisor.enabled:
+            return await convert(semaphore, file_path, *args, **kwargs)
+
+        # the timeout of every process started by this job scales with the source duration
+        job_duration.set((await probe_cache.get_info(file_path)).get('duration') or 0)
+        outputs_token = job_outputs.set(outputs := set())
+        retries = 0
+        try:
+            while True:
+                try:
+                    return await convert(semaphore, file_path, *args, **kwargs)
+                except ProcessStalledError as e:
+                    loudness_tracker.remove_meters(file_path)
+                    if retries == supervisor.get_retries():
+                        supervisor.remove_outputs(outputs)
+                        supervisor.failures.append((file_path, str(e)))
+                        return
+                    retries += 1
+                    print(f're-queued: {file_path}, {e}')
+        finally:
+            job_outputs.reset(outputs_token)
 
+    return wrapper
+
+
+@supervised
+async def audio_convert(semaphore, file_path, src_path, dst_path):
     target_audio_codec = config.get('audio_codec', 'opus')
-    audio_codec_handler = audio_codec_handlers.get(target_audio_codec)(semaphore, file_path, src_path, dst_path)
+    audio_codec_handler = backend_selector.get(target_audio_codec, audio_codec_handlers)(
+        semaphore, file_path, src_path, dst_path
+    )
+
+    cue_path = os.path.splitext(file_path)[0] + '.cue'
+    if archive_source.exists(cue_path):
+        if config.get('cue_output_mode', 'tracks') == 'chapters':
+            await audio_codec_handler.chapter_convert()
+        else:
+            await audio_codec_handler.cue_convert()
+    else:
+        await _single_or_chunked_convert(audio_codec_handler)
+
 
+@supervised
+async def lossy_copy(semaphore, file_path, src_path, dst_path):
     cue_path = os.path.splitext(file_path)[0] + '.cue'
-    if os.path.exists(cue_path):
-        await audio_codec_handler.cue_convert()
+    if archive_source.exists(cue_path):
+        await StreamCopyConverter(semaphore, file_path, src_path, dst_path).cue_convert()
     else:
-        await audio_codec_handler.single_convert()
+        await file_copy(semaphore, file_path, src_path, dst_path)
 
 
+@supervised
 async def image_convert(semaphore, file_path, src_path, dst_path):
     image_codec_handlers = {
         'webp': WebpConverter,
@@ -68,31 +135,142 @@ async def image_convert(semaphore, file_path, src_path, dst_path):
     await image_codec_handler.convert()
 
 
+@supervised
 async def audio_convert_lossless(semaphore, file_path, src_path, dst_path):
-    audio_codec_handlers = {
-        'flac': FLACConverter,
-        'alac': ALACConverter,
-        'tak': TakConverter,
-        'wavpack': WavPackConverter,
-        'tta': TrueAudioConverter,
-        'als': ALSConverter,
-    }
-
     target_audio_codec = config.get('lossless_audio_codec', 'flac')
-    audio_codec_handler = audio_codec_handlers.get(target_audio_codec)(semaphore, file_path, src_path, dst_path)
+    audio_codec_handler = backend_selector.get(target_audio_codec, lossless_audio_codec_handlers)(
+        semaphore, file_path, src_path, dst_path
+    )
+    await _single_or_chunked_convert(audio_codec_handler)
+
+    if pcm_verifier.enabled:
+        new_file_path = PathUtils.create_file_path_struct(file_path, src_path, dst_path, audio_codec_handler.get_ext())
+        retries = 0
+        while not await pcm_verifier.verify(file_path, new_file_path):
+            if retries == pcm_verifier.get_retries():
+                pcm_verifier.failures.append(file_path)
+                break
+            retries += 1
+            print(f're-queued: {file_path}')
+            loudness_tracker.remove_meters(file_path)
+            await audio_codec_handler.single_convert()
+
+    _write_converted_cue(file_path, src_path, dst_path, audio_codec_handler.get_ext())
+
+
+@supervised
+async def audio_convert_hybrid(semaphore, file_path, src_path, dst_path, portable_path):
+    # one wavpack encode for both destinations, the archive gets the lossy part and its correction file,
+    # the portable destination only the lossy part
+    audio_codec_handler = WavPackHybridConverter(semaphore, file_path, src_path, dst_path)
+    new_file_path = PathUtils.create_file_path_struct(file_path, src_path, dst_path, audio_codec_handler.get_ext())
+    # wavpack writes the correction file itself, so it is registered here to be removed with a failed job
+    supervisor.add_output(os.path.splitext(new_file_path)[0] + '.wvc')
+    returncode = await audio_codec_handler.single_convert()
+
+    if pcm_verifier.enabled:
+        # wavpack -v checks the lossless result itself and reports a mismatch through its exit status
+        retries = 0
+        while returncode != 0:
+            print(f'verification failed: {new_file_path}')
+            if retries == pcm_verifier.get_retries():
+                pcm_verifier.failures.append(file_path)
+                break
+            retries += 1
+            print(f're-queued: {file_path}')
+            loudness_tracker.remove_meters(file_path)
+            returncode = await audio_codec_handler.single_convert()
+
+    portable_file_path = PathUtils.create_file_path_struct(
+        file_path, src_path, portable_path, audio_codec_handler.get_ext()
+    )
+    if os.path.exists(portable_file_path):
+        os.remove(portable_file_path)
+    # a hard link saves the space of the lossy part, but every later change to one of the two files shows in both
+    if config.get('wavpack_config', {}).get('link_portable', False):
+        print(f'linking portable file: {portable_file_path}')
+        try:
+            os.link(new_file_path, portable_file_path)
+        except OSError:
+            shutil.copyfile(new_file_path, portable_file_path)
+    else:
+        print(f'copying portable file: {portable_file_path}')
+        shutil.copyfile(new_file_path, portable_file_path)
+
+    _write_converted_cue(file_path, src_path, dst_path, audio_codec_handler.get_ext())
+    _write_converted_cue(file_path, src_path, portable_path, audio_codec_handler.get_ext())
+
+
+@supervised
+async def audio_convert_multi(semaphore, file_path, src_path, targets):
+    lossy_handlers = []
+    lossless_handlers = []
+    for codec, dst_path in targets:
+        if codec in audio_codec_handlers:
+            handler = backend_selector.get(codec, audio_codec_handlers)
+            lossy_handlers.append(handler(semaphore, file_path, src_path, dst_path))
+        else:
+            handler = backend_selector.get(codec, lossless_audio_codec_handlers)
+            lossless_handlers.append(handler(semaphore, file_path, src_path, dst_path))
+
+    cue_path = os.path.splitext(file_path)[0] + '.cue'
+    if archive_source.exists(cue_path):
+        # lossy targets split the image into tracks while lossless targets keep it intact,
+        # so each group shares its own decode pass
+        sub_workers_list = []
+        if lossy_handlers:
+            sub_workers_list.append(MultiTargetConverter(semaphore, file_path, src_path, lossy_handlers).cue_convert())
+        if lossless_handlers:
+            sub_workers_list.append(
+                MultiTargetConverter(semaphore, file_path, src_path, lossless_handlers).single_convert()
+            )
+        await supervisor.gather(*sub_workers_list)
+    else:
+        await MultiTargetConverter(semaphore, file_path, src_path, lossy_handlers + lossless_handlers).single_convert()
+
+    for handler in lossless_handlers:
+        _write_converted_cue(file_path, src_path, handler.dst_path, handler.get_ext())
+
+
+async def _single_or_chunked_convert(audio_codec_handler):
+    chunk_config = config.get('chunk_config', {})
+    if chunk_config.get('enable', False) and audio_codec_handler.is_chunk_joinable():
+        audio_info = await AudioUtils.get_audio_info_by_ffprobe(audio_codec_handler.file_path)
+        if audio_info['sample_rate'] and audio_info['duration'] >= chunk_config.get('min_duration', 1800):
+            if await audio_codec_handler.chunked_convert(audio_info):
+                await _measure_chunked_loudness(audio_codec_handler)
+            return
+
     await audio_codec_handler.single_convert()
 
+
+async def _measure_chunked_loudness(audio_codec_handler):
+    file_path = audio_codec_handler.file_path
+    new_file_path = PathUtils.create_file_path_struct(
+        file_path, audio_codec_handler.src_path, audio_codec_handler.dst_path, audio_codec_handler.get_ext()
+    )
+    if (meter := loudness_tracker.create_meter(file_path, new_file_path)) is None:
+        return
+
+    # the segments are encoded by separate processes, so the joined lossless output is measured instead
+    async with tracer.hold(audio_codec_handler.semaphore, 'loudness', file=file_path):
+        ffmpeg_path = config.get('executable', {}).get('ffmpeg', 'ffmpeg')
+        await AudioUtils.ffmpeg_convert(f'"{ffmpeg_path}" -i "{new_file_path}" -map 0:a', meter)
+
+
+def _write_converted_cue(file_path, src_path, dst_path, new_ext):
     file_path_str, ext = os.path.splitext(file_path)
     cue_path = file_path_str + '.cue'
-    if os.path.exists(cue_path):
+    if archive_source.exists(cue_path):
         lines = CueFileLoader(cue_path).get_content()
-        lines = [line.replace(ext, audio_codec_handler.get_ext()) for line in lines]
+        lines = [line.replace(ext, new_ext) for line in lines]
 
         dst_cue_path = PathUtils.create_file_path_struct(cue_path, src_path, dst_path, '.cue')
         with open(dst_cue_path, 'w', encoding='utf-8-sig') as cue:
             cue.writelines(lines)
 
 
+@supervised
 async def image_convert_lossless(semaphore, file_path, src_path, dst_path):
     image_codec_handlers = {
         'webp': WebpLosslessConverter,
@@ -104,8 +282,11 @@ async def image_convert_lossless(semaphore, file_path, src_path, dst_path):
     await image_codec_handler.convert()
 
 
+@supervised
+@tracer.traced('copy')
 async def file_copy(semaphore, file_path, src_path, dst_path):
-    new_file_path = os.path.join(dst_path, os.path.relpath(file_path, src_path))
+    new_file_path = os.path.join(dst_path, os.path.relpath(archive_source.get_extracted_path(file_path), src_path))
+    supervisor.add_output(new_file_path)
 
     if os.name == 'nt':
         cmd = f'copy /Y "{file_path}" "{new_file_path}"'
@@ -118,9 +299,26 @@ async def file_copy(semaphore, file_path, src_path, dst_path):
         if not os.path.exists((dir_path := os.path.dirname(new_file_path))):
             os.makedirs(dir_path)
 
-        process = await asyncio.create_subprocess_shell(
+        if archive_source.split(file_path) is not None or checksum_cache.enabled:
+            await asyncio.get_running_loop().run_in_executor(None, _copy_file, file_path, new_file_path)
+            return
+
+        process = await supervisor.create_subprocess_shell(
             cmd,
             stdout=asyncio.subprocess.DEVNULL,
             stderr=asyncio.subprocess.DEVNULL
         )
-        await process.communicate()
+        await supervisor.wait([process])
+
+
+async def lossless_copy(semaphore, file_path, src_path, dst_path):
+    await file_copy(semaphore, file_path, src_path, dst_path)
+
+    cue_path = os.path.splitext(file_path)[0] + '.cue'
+    if archive_source.exists(cue_path):
+        await file_copy(semaphore, cue_path, src_path, dst_path)
+
+
+def _copy_file(file_path, new_file_path):
+    with archive_source.open(file_path) as src_file:
+        checksum_cache.copy(src_file, new_file_path)
@@ -0,0 +1,204 @@
+#  py_album_condense - a simple tool to compress and condense your album collections
+#  Copyright (c) 2022 kewenyu
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#  SOFTWARE.
+
+
+import os
+import time
+import shutil
+import asyncio
+import contextvars
+
+from common.archive import archive_source
+from common.config import config
+from common.probe_cache import probe_cache
+from common.router import media_exts
+from common.tracer import tracer
+
+job_ticket = contextvars.ContextVar('job_ticket', default=None)
+
+
+class AdmissionTicket:
+    def __init__(self, file_path, memory, disk):
+        self.file_path = file_path
+        self.memory = memory
+        self.disk = disk
+        self.admitted_at = None
+
+
+class AdmittedSemaphore:
+    # the worker semaphore, which admits the job of the acquiring task when it takes its first slot
+    def __init__(self, semaphore):
+        self.semaphore = semaphore
+
+    def locked(self):
+        return self.semaphore.locked()
+
+    async def acquire(self):
+        await self.semaphore.acquire()
+        if (ticket := job_ticket.get()) is not None and ticket.admitted_at is None:
+            await admission_controller.admit(ticket, self.semaphore)
+        return True
+
+    def release(self):
+        self.semaphore.release()
+
+    async def __aenter__(self):
+        await self.acquire()
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+class AdmissionController:
+    def __init__(self):
+        self.dst_paths = None
+        self.temp_pcm = False
+        self.condition = None
+        self.tickets = set()
+        self.settle_task = None
+
+    @property
+    def enabled(self):
+        return self.dst_paths is not None
+
+    def setup(self, dst_paths, temp_pcm=False):
+        if config.get('admission_config', {}).get('enable', False):
+            self.dst_paths = dst_paths
+            # encoders that need an intermediate wav file write the whole decoded pcm to disk first
+            self.temp_pcm = temp_pcm
+            self.condition = asyncio.Condition()
+
+    @staticmethod
+    def create_semaphore(semaphore):
+        return AdmittedSemaphore(semaphore)
+
+    async def run(self, file_path, job):
+        if not self.enabled:
+            return await job
+
+        # only estimated here, the reservation is made once the job has a worker slot
+        ticket = AdmissionTicket(file_path, *await self._estimate(file_path))
+        token = job_ticket.set(ticket)
+        try:
+            return await job
+        finally:
+            job_ticket.reset(token)
+            if ticket.admitted_at is not None:
+                async with self.condition:
+                    self.tickets.discard(ticket)
+                    self.condition.notify_all()
+
+    async def admit(self, ticket, semaphore):
+        waiting = False
+        while True:
+            async with self.condition:
+                if self._has_capacity(ticket):
+                    ticket.admitted_at = time.monotonic()
+                    self.tickets.add(ticket)
+                    if self.settle_task is None:
+                        self.settle_task = asyncio.create_task(self._notify_settled())
+                    return
+
+                # the slot is handed back while waiting, admitted jobs may still need it to finish
+                semaphore.release()
+                if not waiting:
+                    print(f'waiting for memory or disk space: {ticket.file_path}')
+                    waiting = True
+                with tracer.span('wait for admission', file=ticket.file_path):
+                    await self.condition.wait_for(lambda: self._has_capacity(ticket))
+            await semaphore.acquire()
+
+    def _has_capacity(self, ticket):
+        # a job is always let through when nothing else runs, even if it exceeds the reserves on its own
+        if not self.tickets:
+            return True
+
+        admission_config = config.get('admission_config', {})
+        available_memory = self._get_available_memory()
+        if available_memory is not None:
+            # the memory of jobs that run for a while already shows in the available memory
+            pending_memory = sum(t.memory for t in self._get_unsettled_tickets())
+            if available_memory - pending_memory - ticket.memory < admission_config.get('memory_reserve', 1 << 31):
+                return False
+
+        disk_reserve = admission_config.get('disk_reserve', 5 << 30)
+        reserved_disk = sum(t.disk for t in self.tickets)
+        for dst_path in self.dst_paths:
+            if self._get_free_disk(dst_path) - reserved_disk - ticket.disk < disk_reserve:
+                return False
+        return True
+
+    def _get_unsettled_tickets(self):
+        settle_time = config.get('admission_config', {}).get('settle_time', 5)
+        now = time.monotonic()
+        return [t for t in self.tickets if now - t.admitted_at < settle_time]
+
+    async def _notify_settled(self):
+        # a settled reservation frees capacity as well, so the waiters are woken once it stops counting
+        settle_time = config.get('admission_config', {}).get('settle_time', 5)
+        while unsettled_tickets := self._get_unsettled_tickets():
+            await asyncio.sleep(min(t.admitted_at for t in unsettled_tickets) + settle_time - time.monotonic())
+            async with self.condition:
+                self.condition.notify_all()
+        self.settle_task = None
+
+    async def _estimate(self, file_path):
+        size = archive_source.get_size(file_path)
+        if os.path.splitext(file_path)[1].strip('.').lower() not in media_exts:
+            return 0, size
+
+        info = await probe_cache.get_info(file_path)
+        if info['kind'] == 'image':
+            # decoded frame plus a converted or scaled copy of it, at up to 16 bits per rgba channel
+            return info['width'] * info['height'] * 16, size
+        if info['kind'] == 'audio':
+            disk = size
+            if self.temp_pcm:
+                disk += int(info['duration'] * info['sample_rate'] * info['channels'] * max(info['bits'], 16) / 8)
+            return config.get('admission_config', {}).get('audio_job_memory', 1 << 26), disk
+        return 0, size
+
+    @staticmethod
+    def _get_available_memory():
+        try:
+            import psutil
+            return psutil.virtual_memory().available
+        except ModuleNotFoundError:
+            pass
+
+        try:
+            with open('/proc/meminfo', 'r') as meminfo:
+                for line in meminfo:
+                    if line.startswith('MemAvailable:'):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return None
+
+    @staticmethod
+    def _get_free_disk(dst_path):
+        dst_path = os.path.abspath(dst_path)
+        while not os.path.exists(dst_path) and os.path.dirname(dst_path) != dst_path:
+            dst_path = os.path.dirname(dst_path)
+        return shutil.disk_usage(dst_path).free
+
+
+admission_controller = AdmissionController()
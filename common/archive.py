@@ -0,0 +1,352 @@
+#  py_album_condense - a simple tool to compress and condense your album collections
+#  Copyright (c) 2022 kewenyu
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#  SOFTWARE.
+
+
+import os
+import io
+import asyncio
+import tarfile
+import zipfile
+import subprocess
+import urllib.parse
+
+from common.config import config
+
+
+class ArchiveSource:
+    archive_exts = ('.zip', '.7z', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+
+    def __init__(self):
+        self.archives = {}
+        self.idle_streams = {}
+        self.server = None
+        self.port = None
+
+    @property
+    def enabled(self):
+        return config.get('archive_config', {}).get('enable', False)
+
+    async def start(self):
+        if self.enabled and self.server is None:
+            # members are served over loopback http, so that ffmpeg and ffprobe can read and seek them like files
+            self.server = await asyncio.start_server(self._handle_request, '127.0.0.1', 0)
+            self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+        for member_file in self.idle_streams.values():
+            member_file.close()
+        self.idle_streams.clear()
+
+    def walk(self, src_path):
+        for path, dir_names, file_names in os.walk(src_path):
+            if not self.enabled:
+                yield path, dir_names, file_names
+                continue
+
+            archive_names = [file_name for file_name in file_names if self._get_archive_ext(file_name)]
+            yield path, dir_names, [file_name for file_name in file_names if file_name not in archive_names]
+
+            for archive_name in archive_names:
+                archive_path = os.path.join(path, archive_name)
+                if (members := self.archives.get(archive_path)) is None:
+                    try:
+                        members = self._list_members(archive_path)
+                    except (OSError, RuntimeError, tarfile.TarError, zipfile.BadZipFile) as e:
+                        print(f'failed to read archive {archive_path}: {e}')
+                        continue
+                    self.archives[archive_path] = members
+
+                member_dirs = {}
+                for member_name in members:
+                    member_dir, member_file_name = os.path.split(member_name)
+                    member_dirs.setdefault(member_dir, []).append(member_file_name)
+                for member_dir, member_file_names in member_dirs.items():
+                    # normalized, so that members at the archive root are in the archive path itself, not `foo.zip/`
+                    yield os.path.normpath(os.path.join(archive_path, *member_dir.split('/'))), [], member_file_names
+
+    def list_files(self, dir_path):
+        for archive_path, members in self.archives.items():
+            if dir_path == archive_path or dir_path.startswith(archive_path + os.sep):
+                prefix = dir_path[len(archive_path) + 1:].replace(os.sep, '/')
+                prefix = prefix + '/' if prefix else ''
+                return [
+                    os.path.join(archive_path, *member_name.split('/'))
+                    for member_name in members if member_name.startswith(prefix)
+                ]
+
+        return [
+            os.path.join(path, file_name)
+            for path, _, file_names in self.walk(dir_path) for file_name in file_names
+        ]
+
+    def list_dir(self, dir_path):
+        # the direct children of a folder only, as sorted names of sub folders and files
+        for archive_path, members in self.archives.items():
+            if dir_path == archive_path or dir_path.startswith(archive_path + os.sep):
+                prefix = dir_path[len(archive_path) + 1:].replace(os.sep, '/')
+                prefix = prefix + '/' if prefix else ''
+                dir_names, file_names = set(), []
+                for member_name in members:
+                    if member_name.startswith(prefix):
+                        name, sep, _ = member_name[len(prefix):].partition('/')
+                        if sep:
+                            dir_names.add(name)
+                        else:
+                            file_names.append(name)
+                return sorted(dir_names), sorted(file_names)
+
+        if not os.path.isdir(dir_path):
+            return [], []
+        with os.scandir(dir_path) as entries:
+            entries = list(entries)
+        dir_names = sorted(entry.name for entry in entries if entry.is_dir())
+        return dir_names, sorted(entry.name for entry in entries if not entry.is_dir())
+
+    def split(self, file_path):
+        for archive_path in self.archives:
+            if file_path.startswith(archive_path + os.sep):
+                return archive_path, file_path[len(archive_path) + 1:].replace(os.sep, '/')
+        return None
+
+    def exists(self, file_path):
+        if (member := self.split(file_path)) is not None:
+            archive_path, member_name = member
+            return member_name in self.archives[archive_path]
+        return os.path.exists(file_path)
+
+    def get_size(self, file_path):
+        if (member := self.split(file_path)) is not None:
+            archive_path, member_name = member
+            return self.archives[archive_path][member_name]
+        return os.path.getsize(file_path)
+
+    def get_input(self, file_path):
+        if self.split(file_path) is None:
+            return file_path
+        return f'http://127.0.0.1:{self.port}/{urllib.parse.quote(file_path)}'
+
+    def get_extracted_path(self, file_path):
+        if (member := self.split(file_path)) is not None:
+            archive_path, member_name = member
+            archive_dir = archive_path[:-len(self._get_archive_ext(archive_path))]
+            return os.path.join(archive_dir, *member_name.split('/'))
+        return file_path
+
+    def open(self, file_path):
+        if (member := self.split(file_path)) is None:
+            return open(file_path, 'rb')
+
+        archive_path, member_name = member
+        ext = self._get_archive_ext(archive_path)
+        if ext == '.zip':
+            archive = zipfile.ZipFile(archive_path)
+            return _ArchiveMemberFile(archive.open(member_name), archive)
+        elif ext == '.7z':
+            sevenzip_path = config.get('executable', {}).get('7z', '7z')
+            process = subprocess.Popen(
+                [sevenzip_path, 'x', '-so', archive_path, member_name],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL
+            )
+            return _ArchiveMemberFile(process.stdout, process)
+        else:
+            archive = tarfile.open(archive_path)
+            return _ArchiveMemberFile(archive.extractfile(member_name), archive)
+
+    async def _acquire_stream(self, file_path, start):
+        # ffmpeg reconnects for every seek, so the stream of its previous request is kept open and forward seeks
+        # continue reading from it instead of decompressing the member from the beginning again
+        loop = asyncio.get_running_loop()
+        member_file = self.idle_streams.pop(file_path, None)
+        if member_file is not None and not member_file.can_reach(start):
+            await loop.run_in_executor(None, member_file.close)
+            member_file = None
+        if member_file is None:
+            member_file = await loop.run_in_executor(None, self.open, file_path)
+        await loop.run_in_executor(None, member_file.skip_to, start)
+        return member_file
+
+    async def _release_stream(self, file_path, member_file):
+        loop = asyncio.get_running_loop()
+        if (idle_file := self.idle_streams.pop(file_path, None)) is not None:
+            await loop.run_in_executor(None, idle_file.close)
+        self.idle_streams[file_path] = member_file
+
+        max_idle_streams = config.get('archive_config', {}).get('max_idle_streams', 8)
+        while len(self.idle_streams) > max_idle_streams:
+            oldest_path = next(iter(self.idle_streams))
+            await loop.run_in_executor(None, self.idle_streams.pop(oldest_path).close)
+
+    def _get_archive_ext(self, file_name):
+        lower_file_name = file_name.lower()
+        for ext in self.archive_exts:
+            if lower_file_name.endswith(ext):
+                return ext
+        return None
+
+    def _list_members(self, archive_path):
+        ext = self._get_archive_ext(archive_path)
+        if ext == '.zip':
+            with zipfile.ZipFile(archive_path) as archive:
+                return {info.filename: info.file_size for info in archive.infolist() if not info.is_dir()}
+        elif ext == '.7z':
+            sevenzip_path = config.get('executable', {}).get('7z', '7z')
+            listing = subprocess.run(
+                [sevenzip_path, 'l', '-slt', '-ba', archive_path],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                check=True
+            ).stdout.decode('utf-8', errors='replace')
+
+            members = {}
+            for block in listing.replace('\r\n', '\n').split('\n\n'):
+                fields = dict(line.split(' = ', 1) for line in block.split('\n') if ' = ' in line)
+                if 'Path' in fields and 'D' not in fields.get('Attributes', ''):
+                    members[fields['Path'].replace('\\', '/')] = int(fields.get('Size') or 0)
+            return members
+        else:
+            with tarfile.open(archive_path) as archive:
+                return {info.name: info.size for info in archive.getmembers() if info.isfile()}
+
+    async def _handle_request(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        try:
+            request = (await reader.readuntil(b'\r\n\r\n')).decode('latin-1').split('\r\n')
+            method, target, _ = request[0].split(' ', 2)
+            headers = dict(line.split(':', 1) for line in request[1:] if ':' in line)
+            headers = {k.strip().lower(): v.strip() for k, v in headers.items()}
+
+            file_path = urllib.parse.unquote(target[1:])
+            if self.split(file_path) is None or not self.exists(file_path):
+                writer.write(b'HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+                return
+
+            size = self.get_size(file_path)
+            start, end = 0, size - 1
+            if (byte_range := headers.get('range', '')).startswith('bytes='):
+                range_start, range_end = byte_range[6:].split(',', 1)[0].strip().split('-', 1)
+                if range_start:
+                    start = int(range_start)
+                    if range_end:
+                        end = min(int(range_end), size - 1)
+                elif range_end:
+                    # suffix range, the last n bytes of the member
+                    start = max(size - int(range_end), 0)
+
+            if start > end and byte_range:
+                writer.write((
+                    f'HTTP/1.1 416 Range Not Satisfiable\r\n'
+                    f'Content-Range: bytes */{size}\r\n'
+                    f'Content-Length: 0\r\nConnection: close\r\n\r\n'
+                ).encode('latin-1'))
+                return
+
+            if start > 0 or end < size - 1:
+                status = '206 Partial Content'
+                extra_header = f'Content-Range: bytes {start}-{end}/{size}\r\n'
+            else:
+                status = '200 OK'
+                extra_header = ''
+            writer.write((
+                f'HTTP/1.1 {status}\r\n'
+                f'Content-Length: {end - start + 1}\r\n'
+                f'Accept-Ranges: bytes\r\n'
+                f'{extra_header}'
+                f'Connection: close\r\n\r\n'
+            ).encode('latin-1'))
+            if method == 'HEAD':
+                return
+
+            member_file = await self._acquire_stream(file_path, start)
+            remaining = end - start + 1
+            try:
+                while remaining > 0:
+                    if not (chunk := await loop.run_in_executor(None, member_file.read, min(remaining, 1 << 18))):
+                        break
+                    remaining -= len(chunk)
+                    writer.write(chunk)
+                    await writer.drain()
+            except ConnectionError:
+                await self._release_stream(file_path, member_file)
+                raise
+            except BaseException:
+                await loop.run_in_executor(None, member_file.close)
+                raise
+            await self._release_stream(file_path, member_file)
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+class _ArchiveMemberFile(io.RawIOBase):
+    def __init__(self, member_file, owner):
+        super().__init__()
+        self.member_file = member_file
+        self.owner = owner
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        data = self.member_file.read(size)
+        self.position += len(data)
+        return data
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def can_reach(self, position):
+        return position >= self.position or self._is_seekable()
+
+    def skip_to(self, position):
+        if position == self.position:
+            return
+        if self._is_seekable():
+            self.member_file.seek(position)
+            self.position = position
+            return
+        while self.position < position and self.read(min(position - self.position, 1 << 20)):
+            pass
+
+    def _is_seekable(self):
+        return getattr(self.member_file, 'seekable', lambda: False)()
+
+    def close(self):
+        if not self.closed:
+            self.member_file.close()
+            if isinstance(self.owner, subprocess.Popen):
+                self.owner.kill()
+                self.owner.wait()
+            else:
+                self.owner.close()
+        super().close()
+
+
+archive_source = ArchiveSource()
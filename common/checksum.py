@@ -0,0 +1,89 @@
+#  py_album_condense - a simple tool to compress and condense your album collections
+#  Copyright (c) 2022 kewenyu
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#  SOFTWARE.
+
+
+import os
+import shutil
+import hashlib
+
+from common.config import config
+from common.stat_cache import StatCache
+
+
+class ChecksumCache(StatCache):
+    def __init__(self):
+        super().__init__('checksum_config', 'checksum_cache.json')
+
+    @property
+    def enabled(self):
+        return config.get('checksum_config', {}).get('enable', False)
+
+    @property
+    def algorithm(self):
+        return config.get('checksum_config', {}).get('algorithm', 'sha256')
+
+    def copy(self, src_file, new_file_path, chunk_size=1 << 20):
+        if not self.enabled:
+            with open(new_file_path, 'wb') as new_file:
+                shutil.copyfileobj(src_file, new_file, chunk_size)
+            return
+
+        # hashed on the way through, so that the copy never has to be read back
+        digest = hashlib.new(self.algorithm)
+        with open(new_file_path, 'wb') as new_file:
+            while chunk := src_file.read(chunk_size):
+                digest.update(chunk)
+                new_file.write(chunk)
+        self.put(new_file_path, {self.algorithm: digest.hexdigest()})
+
+    def get_digest(self, file_path, chunk_size=1 << 20):
+        if (value := self.get(file_path)) is not None and self.algorithm in value:
+            return value[self.algorithm]
+
+        # encoder outputs are hashed once they are final, while they are still in the page cache
+        digest = hashlib.new(self.algorithm)
+        with open(file_path, 'rb') as file:
+            while chunk := file.read(chunk_size):
+                digest.update(chunk)
+        self.put(file_path, {self.algorithm: digest.hexdigest()})
+        return digest.hexdigest()
+
+    def get_manifest_name(self):
+        return f'checksums.{self.algorithm}'
+
+    @staticmethod
+    def format_manifest(digests):
+        # the format of sha256sum and friends, so that the manifest can be checked with the usual tools
+        return ''.join([f'{digest}  {name}\n' for name, digest in digests])
+
+    def write_manifest(self, album_dir, album_files):
+        manifest_path = os.path.join(album_dir, self.get_manifest_name())
+        print(f'writing checksums: {manifest_path}')
+
+        digests = [
+            (os.path.relpath(file_path, album_dir).replace(os.sep, '/'), self.get_digest(file_path))
+            for file_path in album_files if file_path != manifest_path
+        ]
+        with open(manifest_path, 'w', encoding='utf-8', newline='\n') as manifest_file:
+            manifest_file.write(self.format_manifest(digests))
+
+
+checksum_cache = ChecksumCache()
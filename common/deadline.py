@@ -0,0 +1,126 @@
+#  py_album_condense - a simple tool to compress and condense your album collections
+#  Copyright (c) 2022 kewenyu
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#  SOFTWARE.
+
+
+
+import re
+import time
+import datetime
+
+from common.archive import archive_source
+from common.config import config
+
+
+class DeadlineController:
+    def __init__(self):
+        self.deadline = None
+        self.total_size = 0
+        self.done_size = 0
+        self.level = 0
+        self.level_start = 0
+        self.level_done_size = 0
+        self.level_jobs = 0
+        self.rates = {}
+
+    @property
+    def enabled(self):
+        return self.deadline is not None
+
+    def setup(self, deadline):
+        if deadline is None:
+            return
+
+        now = time.time()
+        if match := re.fullmatch(r'(\d{1,2}):(\d{2})', deadline):
+            # a time of day means its next occurrence, e.g. 07:00 tomorrow morning
+            target = datetime.datetime.now().replace(hour=int(match[1]), minute=int(match[2]), second=0, microsecond=0)
+            if target.timestamp() <= now:
+                target += datetime.timedelta(days=1)
+            self.deadline = target.timestamp()
+        elif match := re.fullmatch(r'(\d+(?:\.\d+)?)([smh]?)', deadline):
+            self.deadline = now + float(match[1]) * {'': 1, 's': 1, 'm': 60, 'h': 3600}[match[2]]
+        else:
+            raise ValueError(f'invalid deadline: {deadline}, expected HH:MM or a duration like 90m or 8h')
+        self.level_start = now
+
+    def get_effort(self, name, default):
+        if not self.enabled or not (ladder := config.get('deadline_config', {}).get('ladders', {}).get(name)):
+            return default
+        # the configured effort is the top of the ladder, so the deadline can only ever make an encoder faster
+        default_key = self._get_effort_key(default)
+        ladder = [default] + [effort for effort in ladder if self._get_effort_key(effort) < default_key]
+        return ladder[min(self.level, len(ladder) - 1)]
+
+    @staticmethod
+    def _get_effort_key(effort):
+        # tak presets like p4m are ordered by level first, then by the e and m evaluation suffixes
+        if isinstance(effort, str) and (match := re.fullmatch(r'p(\d)([em]?)', effort)):
+            return int(match[1]), ' em'.index(match[2])
+        return effort, 0
+
+    async def run(self, file_path, job):
+        if not self.enabled:
+            return await job
+
+        size = archive_source.get_size(file_path)
+        self.total_size += size
+        try:
+            return await job
+        finally:
+            self.done_size += size
+            self.level_done_size += size
+            self.level_jobs += 1
+            self._update()
+
+    def _update(self):
+        deadline_config = config.get('deadline_config', {})
+        now = time.time()
+        elapsed = now - self.level_start
+        # jobs started before the last change still finish with the old settings, so wait for a few of the new ones
+        if self.level_jobs < deadline_config.get('min_jobs', 4) or elapsed <= 0:
+            return
+
+        rate = self.level_done_size / elapsed
+        self.rates[self.level] = rate
+        remaining_size = self.total_size - self.done_size
+        remaining_time = self.deadline - now
+        max_level = max([len(ladder) for ladder in deadline_config.get('ladders', {}).values()] or [1]) - 1
+
+        level = self.level
+        if remaining_time <= 0 or rate <= 0:
+            level = max_level
+        elif remaining_size / rate > remaining_time:
+            level = min(self.level + 1, max_level)
+        elif self.level > 0 and (slower_rate := self.rates.get(self.level - 1)):
+            # only go back to a better effort when its measured speed still leaves some margin
+            if remaining_size / slower_rate < remaining_time * (1 - deadline_config.get('margin', 0.1)):
+                level = self.level - 1
+
+        if level != self.level:
+            print(f'deadline: {remaining_size / (1 << 20):.0f} MiB left in {remaining_time / 60:.0f} minutes, '
+                  f'effort level {self.level} -> {level}')
+            self.level = level
+            self.level_start = now
+            self.level_done_size = 0
+            self.level_jobs = 0
+
+
+deadline_controller = DeadlineController()
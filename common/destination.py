@@ -0,0 +1,390 @@
+#  py_album_condense - a simple tool to compress and condense your album collections
+#  Copyright (c) 2022 kewenyu
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#  SOFTWARE.
+
+
+import io
+import os
+import json
+import time
+import shutil
+import struct
+import asyncio
+import hashlib
+import posixpath
+import tarfile
+import zipfile
+import tempfile
+import concurrent.futures
+
+from audio_converter.loudness import loudness_tracker
+from common.archive import archive_source
+from common.checksum import checksum_cache
+from common.config import config
+
+
+class Destination:
+    def __init__(self, dst_path, semaphore):
+        self.dst_path = dst_path
+        # where the converters write to
+        self.local_path = dst_path
+        self.name = os.path.basename(os.path.abspath(dst_path))
+        self.semaphore = semaphore
+        self.album_tasks = []
+
+    @staticmethod
+    def create(dst_path, semaphore):
+        mode = config.get('output_config', {}).get('mode', 'files')
+        archive_format = mode if mode in ('tar', 'zip') else None
+        if dst_path.startswith('s3://'):
+            return S3Destination(dst_path, semaphore, archive_format)
+        if archive_format is not None:
+            return ArchiveDestination(dst_path, semaphore, archive_format)
+        return Destination(dst_path, semaphore)
+
+    def add_album(self, src_dir, src_path, file_names, jobs):
+        if not file_names or not self._is_album_stored():
+            return
+        album_dir = self.get_album_dir(src_dir, src_path, file_names)
+        self.album_tasks.append(asyncio.create_task(self._finish_album(src_dir, album_dir, file_names, jobs)))
+
+    async def close(self):
+        await asyncio.gather(*self.album_tasks)
+
+    def get_album_dir(self, src_dir, src_path, file_names):
+        extracted_path = archive_source.get_extracted_path(os.path.join(src_dir, file_names[0]))
+        album_dir = os.path.join(self.local_path, os.path.relpath(os.path.dirname(extracted_path), src_path))
+        return os.path.normpath(album_dir)
+
+    @staticmethod
+    def get_album_files(album_dir, file_names):
+        # files of the album itself and the track folders of its cue images, but no sub albums
+        image_dirs = {os.path.splitext(file_name)[0] for file_name in file_names}
+        album_files = []
+        if not os.path.isdir(album_dir):
+            return album_files
+        for entry in sorted(os.scandir(album_dir), key=lambda e: e.name):
+            if entry.is_file():
+                album_files.append(entry.path)
+            elif entry.is_dir() and entry.name in image_dirs:
+                for path, _, names in os.walk(entry.path):
+                    album_files.extend([os.path.join(path, name) for name in sorted(names)])
+        return album_files
+
+    @staticmethod
+    def remove_album_files(album_dir, album_files):
+        for file_path in album_files:
+            os.remove(file_path)
+            checksum_cache.remove(file_path)
+        for dir_path in sorted({os.path.dirname(file_path) for file_path in album_files}, key=len, reverse=True):
+            while dir_path.startswith(album_dir) and os.path.isdir(dir_path) and not os.listdir(dir_path):
+                os.rmdir(dir_path)
+                dir_path = os.path.dirname(dir_path)
+
+    async def _finish_album(self, src_dir, album_dir, file_names, jobs):
+        await asyncio.gather(*jobs, return_exceptions=True)
+        # all tracks of the album are measured now, so its replaygain tags go in before it is stored
+        await loudness_tracker.write_album_tags(self.semaphore, src_dir)
+        await asyncio.get_running_loop().run_in_executor(None, self._store_album, album_dir, file_names)
+
+    def _is_album_stored(self):
+        return checksum_cache.enabled or config.get('replaygain_config', {}).get('enable', False)
+
+    def _store_album(self, album_dir, file_names):
+        self._write_manifest(album_dir, file_names)
+
+    def _write_manifest(self, album_dir, file_names):
+        if checksum_cache.enabled and (album_files := self.get_album_files(album_dir, file_names)):
+            checksum_cache.write_manifest(album_dir, album_files)
+
+
+class ArchiveDestination(Destination):
+    def __init__(self, dst_path, semaphore, archive_format):
+        super().__init__(dst_path, semaphore)
+        self.archive_format = archive_format
+        # albums are converted in a staging folder and only their archives are written to archive_path, so no album
+        # ever sees the archive of another one, whichever finishes first
+        if staging_path := self._get_staging_path():
+            os.makedirs(staging_path, exist_ok=True)
+        self.staging_dir = tempfile.mkdtemp(prefix='py_album_condense_', dir=staging_path or None)
+        self.local_path = os.path.join(self.staging_dir, 'albums')
+        os.makedirs(self.local_path)
+        self.archive_path = dst_path
+
+    async def close(self):
+        await super().close()
+        self._remove_staging_dir()
+
+    def _get_staging_path(self):
+        return config.get('output_config', {}).get('staging_path', '')
+
+    def _remove_staging_dir(self):
+        # files left behind were not stored, e.g. because their archive could not be written
+        if any(file_names for _, _, file_names in os.walk(self.staging_dir)):
+            print(f'files that were not stored are kept in: {self.staging_dir}')
+        else:
+            shutil.rmtree(self.staging_dir, ignore_errors=True)
+
+    def _is_album_stored(self):
+        return True
+
+    def _store_album(self, album_dir, file_names):
+        self._write_archive(album_dir, file_names)
+
+    def _write_archive(self, album_dir, file_names):
+        if not (album_files := self.get_album_files(album_dir, file_names)):
+            return []
+
+        if (album_path := os.path.relpath(album_dir, self.local_path)) == '.':
+            # files right in the source folder are packed into an archive named after the destination
+            album_path = self.name
+        archive_path = os.path.join(self.archive_path, f'{album_path}.{self.archive_format}')
+        os.makedirs(os.path.dirname(archive_path), exist_ok=True)
+        print(f'packing: {archive_path}')
+
+        # member names are relative to the destination, so that extracting there gives the usual layout
+        members = [
+            (file_path, os.path.relpath(file_path, self.local_path).replace(os.sep, '/')) for file_path in album_files
+        ]
+        # the manifest is packed last, with digests taken from the data on its way into the archive
+        manifest_name = None
+        if checksum_cache.enabled:
+            manifest_path = os.path.join(album_dir, checksum_cache.get_manifest_name())
+            manifest_name = os.path.relpath(manifest_path, self.local_path).replace(os.sep, '/')
+        tmp_archive_path = f'{archive_path}.tmp'
+        if self.archive_format == 'tar':
+            index = self._write_tar(tmp_archive_path, members, manifest_name)
+        else:
+            index = self._write_zip(tmp_archive_path, members, manifest_name)
+        os.replace(tmp_archive_path, archive_path)
+
+        index_path = f'{archive_path}.index.json'
+        with open(index_path, 'w', encoding='utf-8') as index_file:
+            json.dump({'format': self.archive_format, 'files': index}, index_file, ensure_ascii=False)
+        self.remove_album_files(album_dir, album_files)
+        return [archive_path, index_path]
+
+    @staticmethod
+    def _write_tar(archive_path, members, manifest_name):
+        def add_member(tar_info, member_file):
+            # the data follows the header, which may include an extended pax header for long names
+            data_offset = tar.offset + len(tar_info.tobuf(tar.format, tar.encoding, tar.errors))
+            tar.addfile(tar_info, member_file)
+            index[tar_info.name] = [data_offset, tar_info.size]
+
+        index = {}
+        digests = []
+        with tarfile.open(archive_path, 'w', format=tarfile.PAX_FORMAT) as tar:
+            for file_path, name in members:
+                with open(file_path, 'rb') as member_file:
+                    reader = _DigestReader(member_file) if manifest_name is not None else member_file
+                    add_member(tar.gettarinfo(file_path, name), reader)
+                if manifest_name is not None:
+                    digests.append((name, reader.hexdigest()))
+
+            if manifest_name is not None:
+                manifest = ArchiveDestination._format_manifest(manifest_name, digests)
+                tar_info = tarfile.TarInfo(manifest_name)
+                tar_info.size, tar_info.mtime = len(manifest), int(time.time())
+                add_member(tar_info, io.BytesIO(manifest))
+        return index
+
+    @staticmethod
+    def _write_zip(archive_path, members, manifest_name):
+        digests = []
+        with zipfile.ZipFile(archive_path, 'w', zipfile.ZIP_STORED, allowZip64=True) as zip_file:
+            for file_path, name in members:
+                if manifest_name is None:
+                    zip_file.write(file_path, name)
+                    continue
+                with open(file_path, 'rb') as member_file, \
+                        zip_file.open(zipfile.ZipInfo.from_file(file_path, name), 'w') as zip_member:
+                    reader = _DigestReader(member_file)
+                    shutil.copyfileobj(reader, zip_member, 1 << 20)
+                digests.append((name, reader.hexdigest()))
+
+            if manifest_name is not None:
+                zip_file.writestr(manifest_name, ArchiveDestination._format_manifest(manifest_name, digests))
+            zip_infos = zip_file.infolist()
+
+        # the data follows the local header, whose variable length fields may differ from the central directory
+        index = {}
+        with open(archive_path, 'rb') as zip_file:
+            for zip_info in zip_infos:
+                zip_file.seek(zip_info.header_offset + 26)
+                name_length, extra_length = struct.unpack('<HH', zip_file.read(4))
+                data_offset = zip_info.header_offset + 30 + name_length + extra_length
+                index[zip_info.filename] = [data_offset, zip_info.file_size]
+        return index
+
+    @staticmethod
+    def _format_manifest(manifest_name, digests):
+        # member names are relative to the destination, the names in the manifest to the album
+        manifest_dir = posixpath.dirname(manifest_name) or '.'
+        digests = [(posixpath.relpath(name, manifest_dir), digest) for name, digest in digests]
+        return checksum_cache.format_manifest(digests).encode('utf-8')
+
+
+class S3Destination(ArchiveDestination):
+    def __init__(self, dst_path, semaphore, archive_format):
+        super().__init__(dst_path, semaphore, archive_format)
+        self.bucket, _, prefix = dst_path[len('s3://'):].partition('/')
+        self.prefix = prefix.strip('/')
+        self.name = self.prefix.rsplit('/', 1)[-1] or self.bucket
+        self.failures = []
+
+        s3_config = config.get('s3_config', {})
+        # archives wait in the staging folder next to the albums until they are uploaded
+        self.archive_path = os.path.join(self.staging_dir, 'archives')
+        # s3 rejects parts smaller than 5 MiB, except for the last one
+        self.part_size = max(s3_config.get('part_size', 16), 5) << 20
+        max_concurrency = s3_config.get('max_concurrency', 8)
+        # every request of every upload shares these threads and the connection pool of the client
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_concurrency)
+        self.client = self._create_client(s3_config, max_concurrency)
+
+    async def close(self):
+        await super().close()
+        self.executor.shutdown()
+
+    def _get_staging_path(self):
+        return config.get('s3_config', {}).get('staging_path', '')
+
+    def _remove_staging_dir(self):
+        if self.failures:
+            print(f'{len(self.failures)} album(s) failed to upload:')
+            for album_dir, reason in self.failures:
+                print(f'  {album_dir}: {reason}')
+        super()._remove_staging_dir()
+
+    def _store_album(self, album_dir, file_names):
+        if self.archive_format is not None:
+            file_paths, root_path = self._write_archive(album_dir, file_names), self.archive_path
+        else:
+            self._write_manifest(album_dir, file_names)
+            file_paths, root_path = self.get_album_files(album_dir, file_names), self.local_path
+        if not file_paths:
+            return
+
+        print(f'uploading: {album_dir}')
+        try:
+            self._upload_files(file_paths, root_path)
+        except Exception as e:
+            self.failures.append((album_dir, e))
+            return
+
+        if self.archive_format is not None:
+            for file_path in file_paths:
+                os.remove(file_path)
+        else:
+            self.remove_album_files(album_dir, file_paths)
+
+    def _upload_files(self, file_paths, root_path):
+        uploads = []
+        try:
+            for file_path in file_paths:
+                uploads.append(self._start_upload(file_path, root_path))
+            for key, upload_id, futures in uploads:
+                parts = [future.result() for future in futures]
+                if upload_id is not None:
+                    self.client.complete_multipart_upload(
+                        Bucket=self.bucket, Key=key, UploadId=upload_id, MultipartUpload={'Parts': parts}
+                    )
+        except BaseException:
+            for key, upload_id, futures in uploads:
+                for future in futures:
+                    future.cancel()
+                concurrent.futures.wait(futures)
+                if upload_id is not None:
+                    self._abort_upload(key, upload_id)
+            raise
+
+    def _start_upload(self, file_path, root_path):
+        key = os.path.relpath(file_path, root_path).replace(os.sep, '/')
+        if self.prefix:
+            key = f'{self.prefix}/{key}'
+
+        file_size = os.path.getsize(file_path)
+        if file_size <= self.part_size:
+            return key, None, [self.executor.submit(self._put_object, file_path, key)]
+
+        # parts are read from the file by the thread sending them, so at most one part per thread is in memory
+        upload_id = self.client.create_multipart_upload(Bucket=self.bucket, Key=key)['UploadId']
+        futures = [
+            self.executor.submit(self._upload_part, file_path, key, upload_id, part_number, offset)
+            for part_number, offset in enumerate(range(0, file_size, self.part_size), 1)
+        ]
+        return key, upload_id, futures
+
+    def _put_object(self, file_path, key):
+        with open(file_path, 'rb') as upload_file:
+            self.client.put_object(Bucket=self.bucket, Key=key, Body=upload_file)
+
+    def _upload_part(self, file_path, key, upload_id, part_number, offset):
+        with open(file_path, 'rb') as upload_file:
+            upload_file.seek(offset)
+            data = upload_file.read(self.part_size)
+        response = self.client.upload_part(
+            Bucket=self.bucket, Key=key, UploadId=upload_id, PartNumber=part_number, Body=data
+        )
+        return {'ETag': response['ETag'], 'PartNumber': part_number}
+
+    def _abort_upload(self, key, upload_id):
+        try:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=key, UploadId=upload_id)
+        except Exception:
+            # the upload may already be completed, or the endpoint is unreachable
+            pass
+
+    @staticmethod
+    def _create_client(s3_config, max_concurrency):
+        try:
+            import boto3
+            import botocore.config
+        except ModuleNotFoundError:
+            raise RuntimeError('boto3 is required for s3 destinations')
+
+        client_config = botocore.config.Config(
+            max_pool_connections=max_concurrency,
+            # failed requests are retried one by one, an upload never restarts from its first part
+            retries={'max_attempts': s3_config.get('retries', 5), 'mode': 'standard'},
+        )
+        return boto3.session.Session().client(
+            's3',
+            endpoint_url=s3_config.get('endpoint_url') or None,
+            region_name=s3_config.get('region') or None,
+            aws_access_key_id=s3_config.get('access_key_id') or None,
+            aws_secret_access_key=s3_config.get('secret_access_key') or None,
+            config=client_config,
+        )
+
+
+class _DigestReader:
+    def __init__(self, member_file):
+        self.member_file = member_file
+        self.digest = hashlib.new(checksum_cache.algorithm)
+
+    def read(self, size=-1):
+        data = self.member_file.read(size)
+        self.digest.update(data)
+        return data
+
+    def hexdigest(self):
+        return self.digest.hexdigest()
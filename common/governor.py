@@ -0,0 +1,251 @@
+#  py_album_condense - a simple tool to compress and condense your album collections
+#  Copyright (c) 2022 kewenyu
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#  SOFTWARE.
+
+
+
+import os
+import signal
+import asyncio
+import weakref
+import datetime
+import contextlib
+import collections
+
+from common.config import config
+from common.tracer import tracer
+
+
+class GovernedSemaphore:
+    def __init__(self, value):
+        self.limit = value
+        self.active = 0
+        self.waiters = collections.deque()
+
+    def locked(self):
+        return self.active >= self.limit or bool(self.waiters)
+
+    async def acquire(self):
+        if not self.locked():
+            self.active += 1
+            return True
+
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        with tracer.span('wait for slot'):
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    # the slot was already handed over, pass it on
+                    self.release()
+                else:
+                    self.waiters.remove(waiter)
+                raise
+        return True
+
+    def release(self):
+        self.active -= 1
+        self._wake()
+
+    def resize(self, value):
+        self.limit = value
+        self._wake()
+
+    def _wake(self):
+        while self.waiters and self.active < self.limit:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                self.active += 1
+                waiter.set_result(True)
+
+    async def __aenter__(self):
+        await self.acquire()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release()
+
+
+class Governor:
+    def __init__(self):
+        self.semaphore = None
+        self.worker_num = 0
+        self.override = None
+        self.paused = False
+        self.processes = weakref.WeakSet()
+        self.server = None
+        self.window_task = None
+
+    @property
+    def enabled(self):
+        return config.get('governor_config', {}).get('enable', False)
+
+    def create_semaphore(self, worker_num):
+        if not self.enabled:
+            return tracer.create_semaphore(worker_num)
+
+        self.worker_num = worker_num
+        self._apply_priority()
+        self.semaphore = GovernedSemaphore(worker_num)
+        return self.semaphore
+
+    async def start(self):
+        if self.semaphore is None:
+            return
+
+        governor_config = config.get('governor_config', {})
+        self._update()
+        if governor_config.get('windows'):
+            self.window_task = asyncio.create_task(self._watch_windows(governor_config.get('check_interval', 60)))
+
+        if hasattr(signal, 'SIGUSR1'):
+            loop = asyncio.get_running_loop()
+            loop.add_signal_handler(signal.SIGUSR1, self.execute, ['pause'])
+            loop.add_signal_handler(signal.SIGUSR2, self.execute, ['resume'])
+
+        if socket_path := governor_config.get('control_socket'):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(socket_path)
+            self.server = await asyncio.start_unix_server(self._handle_client, socket_path)
+        elif port := governor_config.get('control_port'):
+            self.server = await asyncio.start_server(self._handle_client, '127.0.0.1', port)
+
+    async def stop(self):
+        if self.semaphore is None:
+            return
+
+        if self.window_task is not None:
+            self.window_task.cancel()
+            self.window_task = None
+        if hasattr(signal, 'SIGUSR1'):
+            loop = asyncio.get_running_loop()
+            loop.remove_signal_handler(signal.SIGUSR1)
+            loop.remove_signal_handler(signal.SIGUSR2)
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+            if socket_path := config.get('governor_config', {}).get('control_socket'):
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(socket_path)
+
+    def register(self, process):
+        if self.semaphore is None:
+            return
+        self.processes.add(process)
+        # jobs that are already running may start another stage while paused
+        if self.paused:
+            self._signal_group(process, signal.SIGSTOP)
+
+    def execute(self, command):
+        if command == ['pause']:
+            self.override = 0
+        elif command == ['resume']:
+            self.override = None
+        elif len(command) == 2 and command[0] == 'workers' and command[1].isdigit():
+            self.override = int(command[1])
+        elif command != ['status']:
+            return f'unknown command: {" ".join(command)}'
+
+        self._update()
+        return self._get_status()
+
+    def _update(self):
+        limit = self.override if self.override is not None else self._get_scheduled_workers()
+        if limit != self.semaphore.limit:
+            print(f'workers: {limit}' if limit else 'paused')
+        self.semaphore.resize(limit)
+
+        # a pause also stops the encoders that are already running, instead of waiting for them to finish
+        if (limit == 0) != self.paused:
+            self.paused = limit == 0
+            for process in list(self.processes):
+                self._signal_group(process, signal.SIGSTOP if self.paused else signal.SIGCONT)
+
+    def _get_scheduled_workers(self):
+        now = datetime.datetime.now().strftime('%H:%M')
+        for window in config.get('governor_config', {}).get('windows', []):
+            start, end = window['start'], window['end']
+            # a window whose end is before its start runs over midnight
+            if (start <= now < end) if start <= end else (now >= start or now < end):
+                return window.get('workers', self.worker_num)
+        return self.worker_num
+
+    def _get_status(self):
+        state = 'paused' if self.paused else f'workers {self.semaphore.limit}'
+        return f'{state}, running {self.semaphore.active}, waiting {len(self.semaphore.waiters)}'
+
+    async def _watch_windows(self, check_interval):
+        while True:
+            await asyncio.sleep(check_interval)
+            self._update()
+
+    async def _handle_client(self, reader, writer):
+        # one command per connection, e.g. echo pause | nc -U control_socket
+        try:
+            if command := (await reader.readline()).decode('utf-8', errors='replace').split():
+                writer.write(f'{self.execute(command)}\n'.encode('utf-8'))
+                await writer.drain()
+        finally:
+            writer.close()
+
+    @staticmethod
+    def _apply_priority():
+        # encoders are started by this process, so they inherit its priority and affinity
+        governor_config = config.get('governor_config', {})
+        try:
+            import psutil
+        except ModuleNotFoundError:
+            psutil = None
+
+        if nice := governor_config.get('nice', 0):
+            if hasattr(os, 'nice'):
+                os.nice(nice)
+            elif psutil is not None:
+                psutil.Process().nice(psutil.IDLE_PRIORITY_CLASS if nice >= 15 else psutil.BELOW_NORMAL_PRIORITY_CLASS)
+
+        if ionice_class := governor_config.get('ionice_class', 0):
+            # the level only applies to the best-effort and realtime classes
+            ionice_level = governor_config.get('ionice_level', 7) if ionice_class in (1, 2) else None
+            if psutil is not None and hasattr(psutil.Process, 'ionice'):
+                psutil.Process().ionice(ionice_class, ionice_level)
+            elif os.name != 'nt':
+                ionice_cmd = f'ionice -c {ionice_class} -p {os.getpid()}'
+                if ionice_level is not None:
+                    ionice_cmd = f'ionice -c {ionice_class} -n {ionice_level} -p {os.getpid()}'
+                if os.system(ionice_cmd) != 0:
+                    print('ionice is not available, io priority is unchanged')
+
+        if cpu_affinity := governor_config.get('cpu_affinity', []):
+            if hasattr(os, 'sched_setaffinity'):
+                os.sched_setaffinity(0, cpu_affinity)
+            elif psutil is not None:
+                psutil.Process().cpu_affinity(cpu_affinity)
+
+    @staticmethod
+    def _signal_group(process, sig):
+        # stopping a process is only possible on posix, on windows a pause only holds back new jobs
+        if os.name == 'nt' or process.returncode is not None:
+            return
+        with contextlib.suppress(ProcessLookupError, PermissionError):
+            os.killpg(process.pid, sig)
+
+
+governor = Governor()
@@ -0,0 +1,82 @@
+#  py_album_condense - a simple tool to compress and condense your album collections
+#  Copyright (c) 2022 kewenyu
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#  SOFTWARE.
+
+
+import os
+import asyncio
+
+from common.archive import archive_source
+from common.config import config
+from common.tracer import tracer
+
+
+class IOScheduler:
+    def __init__(self):
+        self.staging_semaphore = None
+        self.device_semaphores = {}
+
+    @property
+    def enabled(self):
+        return self.staging_semaphore is not None
+
+    def setup(self, worker_num):
+        io_config = config.get('io_config', {})
+        if io_config.get('enable', False):
+            # jobs being encoded plus the ones staged ahead of their encode slot
+            self.staging_semaphore = asyncio.Semaphore(worker_num + io_config.get('readahead_files', 4))
+
+    async def run(self, file_path, job):
+        with tracer.span('job', file=file_path):
+            if not self.enabled or archive_source.split(file_path) is not None:
+                return await job
+
+            async with self.staging_semaphore:
+                async with self._get_device_semaphore(file_path):
+                    with tracer.span('stage', file=file_path):
+                        await asyncio.get_running_loop().run_in_executor(None, self._stage, file_path)
+                return await job
+
+    def _get_device_semaphore(self, file_path):
+        device = os.stat(file_path).st_dev
+        if (semaphore := self.device_semaphores.get(device)) is None:
+            semaphore = asyncio.Semaphore(config.get('io_config', {}).get('readers_per_device', 1))
+            self.device_semaphores[device] = semaphore
+        return semaphore
+
+    @staticmethod
+    def _stage(file_path, chunk_size=1 << 22):
+        max_stage_size = config.get('io_config', {}).get('max_stage_size', 1 << 30)
+        with open(file_path, 'rb', buffering=0) as staged_file:
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(staged_file.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                if os.fstat(staged_file.fileno()).st_size > max_stage_size:
+                    # too large to be kept in page cache, let the kernel read ahead on its own
+                    os.posix_fadvise(staged_file.fileno(), 0, max_stage_size, os.POSIX_FADV_WILLNEED)
+                    return
+
+            # one sequential pass pulls the whole file into page cache while holding the device slot,
+            # the encoders then read it from memory instead of seeking on the disk
+            remaining = max_stage_size
+            while remaining > 0 and (chunk := staged_file.read(min(chunk_size, remaining))):
+                remaining -= len(chunk)
+
+
+io_scheduler = IOScheduler()
@@ -0,0 +1,91 @@
+#  py_album_condense - a simple tool to compress and condense your album collections
+#  Copyright (c) 2022 kewenyu
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#  SOFTWARE.
+
+
+import asyncio
+
+from audio_converter.backend import backend_selector
+from audio_converter.cover_art import cover_art_cache
+from audio_converter.loudness import loudness_tracker
+from audio_converter.verifier import pcm_verifier
+from image_converter.image_converter import image_strategy_cache
+from common.admission import admission_controller
+from common.archive import archive_source
+from common.checksum import checksum_cache
+from common.destination import Destination
+from common.governor import governor
+from common.io_scheduler import io_scheduler
+from common.probe_cache import probe_cache
+from common.supervisor import supervisor
+from common.tracer import tracer
+from cue.cue_cache import cue_cache
+
+
+class Pipeline:
+    # setup and teardown shared by all entry scripts, used as `async with Pipeline(...) as pipeline:`
+    def __init__(self, worker_num, dst_paths, codecs, extra_paths=(), large_jobs=False):
+        self.semaphore = admission_controller.create_semaphore(governor.create_semaphore(worker_num))
+        io_scheduler.setup(worker_num)
+        self.destinations = [Destination.create(dst_path, self.semaphore) for dst_path in dst_paths]
+        # the converters write to the local side of each destination
+        self.dst_paths = [destination.local_path for destination in self.destinations]
+        admission_controller.setup(self.dst_paths + list(extra_paths), large_jobs)
+        self.codecs = codecs
+        self.workers = []
+
+    async def __aenter__(self):
+        await archive_source.start()
+        await backend_selector.select(self.codecs)
+        await governor.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            await archive_source.stop()
+            await governor.stop()
+            return
+
+        await asyncio.gather(*self.workers)
+        await loudness_tracker.write_tags(self.semaphore)
+        await asyncio.gather(*[destination.close() for destination in self.destinations])
+        # caches are saved once every album is stored, so a failing save never holds back the output
+        probe_cache.save()
+        cue_cache.save()
+        image_strategy_cache.save()
+        checksum_cache.save()
+        await archive_source.stop()
+        await governor.stop()
+        cover_art_cache.cleanup()
+        pcm_verifier.report()
+        supervisor.report()
+
+        tracer.save()
+
+        print('all done !')
+
+    def add_job(self, job):
+        worker = asyncio.create_task(job)
+        self.workers.append(worker)
+        return worker
+
+    def add_album(self, src_dir, src_path, file_names, jobs):
+        for destination in self.destinations:
+            destination.add_album(src_dir, src_path, file_names, jobs)
@@ -0,0 +1,99 @@
+#  py_album_condense - a simple tool to compress and condense your album collections
+#  Copyright (c) 2022 kewenyu
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#  SOFTWARE.
+
+
+import json
+import asyncio
+
+from common.archive import archive_source
+from common.config import config
+from common.tracer import tracer
+from common.stat_cache import StatCache
+
+lossless_codecs = ('flac', 'alac', 'ape', 'tak', 'tta', 'wavpack', 'mp4als', 'mlp', 'truehd')
+
+
+class ProbeCache(StatCache):
+    def __init__(self):
+        super().__init__('routing_config', 'probe_cache.json')
+
+    async def get_info(self, file_path):
+        if (info := self.get(file_path)) is None:
+            info = await self._probe(file_path)
+            self.put(file_path, info)
+        return info
+
+    @staticmethod
+    @tracer.traced('ffprobe routing')
+    async def _probe(file_path):
+        ffprobe_path = config.get('executable', {}).get('ffprobe', 'ffprobe')
+        ffprobe_cmd = f'"{ffprobe_path}" -loglevel error -show_format -show_streams'
+        ffprobe_cmd += f' -of json "{archive_source.get_input(file_path)}"'
+        ffprobe_process = await asyncio.create_subprocess_shell(
+            ffprobe_cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        ffprobe_stdout, ffprobe_stderr = await ffprobe_process.communicate()
+
+        try:
+            src_info = json.loads(ffprobe_stdout)
+        except ValueError:
+            src_info = {}
+        src_format = src_info.get('format', {})
+        streams = src_info.get('streams', [])
+        audio_stream = next((s for s in streams if s.get('codec_type') == 'audio'), None)
+        video_stream = next((s for s in streams if s.get('codec_type') == 'video'), None)
+
+        format_name = src_format.get('format_name', '')
+        has_cover_only = video_stream is None or video_stream.get('disposition', {}).get('attached_pic')
+        if audio_stream is not None and has_cover_only:
+            kind = 'audio'
+        elif format_name.endswith('_pipe') or format_name == 'image2':
+            kind = 'image'
+        elif video_stream is not None:
+            kind = 'video'
+        else:
+            kind = 'other'
+
+        stream = audio_stream if kind == 'audio' else video_stream or {}
+        info = {
+            'kind': kind,
+            'format': format_name,
+            'codec': stream.get('codec_name', ''),
+            'size': int(src_format.get('size') or 0),
+            'duration': float(src_format.get('duration') or 0),
+            'bitrate': int(stream.get('bit_rate') or src_format.get('bit_rate') or 0),
+            'sample_rate': int(stream.get('sample_rate') or 0),
+            'channels': int(stream.get('channels') or 0),
+            'bits': int(stream.get('bits_per_raw_sample') or stream.get('bits_per_sample') or 0),
+            'width': int(stream.get('width') or 0),
+            'height': int(stream.get('height') or 0),
+        }
+        info['lossless'] = info['codec'] in lossless_codecs or info['codec'].startswith('pcm_')
+
+        # bitrate relative to the plain pcm stream, the closest thing to a compression setting that can be probed
+        pcm_bitrate = info['sample_rate'] * info['channels'] * info['bits']
+        info['compression_ratio'] = round(info['bitrate'] / pcm_bitrate, 4) if pcm_bitrate else 0
+        return info
+
+
+probe_cache = ProbeCache()
@@ -0,0 +1,74 @@
+#  py_album_condense - a simple tool to compress and condense your album collections
+#  Copyright (c) 2022 kewenyu
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#  SOFTWARE.
+
+
+import os
+import asyncio
+
+from common.config import config
+from common.probe_cache import probe_cache
+
+media_exts = (
+    'wav', 'flac', 'aiff', 'aif', 'ape', 'tak', 'tta', 'wv', 'alac', 'mp3', 'm4a', 'aac', 'ogg', 'opus',
+    'png', 'tiff', 'tif', 'bmp', 'jpg', 'jpeg', 'jp2', 'webp', 'heif', 'heic',
+    'mkv', 'avi', 'mp4',
+)
+
+
+class Router:
+    def __init__(self, ext_handler, action_handlers, rules, default_handler=None):
+        self.ext_handler = ext_handler
+        self.action_handlers = action_handlers
+        self.rules = rules
+        self.default_handler = default_handler
+        self.semaphore = asyncio.Semaphore(config.get('routing_config', {}).get('probe_workers', 8))
+
+    @property
+    def enabled(self):
+        return config.get('routing_config', {}).get('enable', False) and bool(self.rules)
+
+    async def route(self, file_path):
+        ext = os.path.splitext(file_path)[1].strip('.').lower()
+        handler = self.ext_handler.get(ext, self.default_handler)
+        if not self.enabled or ext not in media_exts:
+            return handler
+
+        async with self.semaphore:
+            info = await probe_cache.get_info(file_path)
+        info = dict(info, ext=ext)
+
+        for rule in self.rules:
+            if all(self._match(info, key, value) for key, value in rule.get('match', {}).items()):
+                action = rule['action']
+                if action == 'skip':
+                    return None
+                return self.action_handlers.get(info['kind'], {}).get(action, handler)
+        return handler
+
+    @staticmethod
+    def _match(info, key, value):
+        if key.startswith('min_'):
+            return info.get(key[4:], 0) >= value
+        if key.startswith('max_'):
+            return info.get(key[4:], 0) <= value
+        if isinstance(value, list):
+            return info.get(key) in value
+        return info.get(key) == value
@@ -0,0 +1,94 @@
+#  py_album_condense - a simple tool to compress and condense your album collections
+#  Copyright (c) 2022 kewenyu
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#  SOFTWARE.
+
+
+import os
+import json
+
+from common.archive import archive_source
+from common.config import config
+
+
+class StatCache:
+    def __init__(self, config_name, file_name):
+        self.config_name = config_name
+        self.file_name = file_name
+        self.entries = None
+        self.dirty = False
+
+    @property
+    def cache_path(self):
+        default_path = os.path.join(os.path.expanduser('~'), '.cache', 'py_album_condense', self.file_name)
+        return config.get(self.config_name, {}).get('cache_path') or default_path
+
+    def get(self, file_path):
+        if self.entries is None:
+            self.entries = self._load()
+
+        entry = self.entries.get(os.path.abspath(file_path))
+        if entry is not None and entry.get('stat') == self._get_stat_key(file_path):
+            return entry.get('value')
+        return None
+
+    def put(self, file_path, value):
+        if self.entries is None:
+            self.entries = self._load()
+
+        self.entries[os.path.abspath(file_path)] = {'stat': self._get_stat_key(file_path), 'value': value}
+        self.dirty = True
+
+    def remove(self, file_path):
+        if self.entries is None:
+            self.entries = self._load()
+
+        if self.entries.pop(os.path.abspath(file_path), None) is not None:
+            self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+
+        # a cache that cannot be written only costs the next run some work, it must never fail this one
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            tmp_cache_path = f'{self.cache_path}.tmp'
+            with open(tmp_cache_path, 'w', encoding='utf-8') as cache_file:
+                json.dump(self.entries, cache_file, ensure_ascii=False, separators=(',', ':'))
+            os.replace(tmp_cache_path, self.cache_path)
+            self.dirty = False
+        except OSError as e:
+            print(f'failed to save cache {self.cache_path}: {e}')
+
+    def _load(self):
+        try:
+            with open(self.cache_path, 'r', encoding='utf-8') as cache_file:
+                return json.load(cache_file)
+        except (OSError, ValueError):
+            return {}
+
+    @staticmethod
+    def _get_stat_key(file_path):
+        # archive members are keyed by the stat of their archive, which changes whenever a member does
+        if (archive := archive_source.split(file_path)) is not None:
+            stat = os.stat(archive[0])
+            return [archive_source.get_size(file_path), stat.st_mtime_ns]
+        stat = os.stat(file_path)
+        return [stat.st_size, stat.st_mtime_ns]
@@ -0,0 +1,205 @@
+#  py_album_condense - a simple tool to compress and condense your album collections
+#  Copyright (c) 2022 kewenyu
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#  SOFTWARE.
+
+
+import os
+import time
+import shutil
+import signal
+import asyncio
+import contextvars
+
+from common.config import config
+from common.governor import governor
+
+job_duration = contextvars.ContextVar('job_duration', default=0)
+job_outputs = contextvars.ContextVar('job_outputs', default=None)
+
+
+class ProcessStalledError(RuntimeError):
+    pass
+
+
+class Supervisor:
+    def __init__(self):
+        self.failures = []
+
+    @property
+    def enabled(self):
+        return config.get('supervisor_config', {}).get('enable', False)
+
+    async def create_subprocess_shell(self, cmd, **kwargs):
+        if self.enabled or governor.enabled:
+            # a group of its own, so that the shell and everything it started can be killed together
+            if os.name == 'nt':
+                import subprocess
+                kwargs['creationflags'] = subprocess.CREATE_NEW_PROCESS_GROUP
+            else:
+                kwargs['start_new_session'] = True
+        process = await asyncio.create_subprocess_shell(cmd, **kwargs)
+        governor.register(process)
+        return process
+
+    async def wait(self, processes, *aws):
+        waiter = asyncio.ensure_future(asyncio.gather(*aws, *[process.wait() for process in processes]))
+        if not self.enabled:
+            return await waiter
+
+        try:
+            return await self._watch(processes, waiter)
+        except asyncio.CancelledError:
+            # a cancelled job must not leave processes writing to outputs that are about to be removed
+            for process in processes:
+                self._kill_group(process)
+            await asyncio.gather(waiter, return_exceptions=True)
+            raise
+
+    @staticmethod
+    async def gather(*aws):
+        # when one part of a job fails, the others are cancelled and awaited, so that none of them is still running
+        # when the job is retried or its outputs are removed
+        tasks = [asyncio.ensure_future(aw) for aw in aws]
+        try:
+            return await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+    async def _watch(self, processes, waiter):
+        supervisor_config = config.get('supervisor_config', {})
+        poll_interval = supervisor_config.get('poll_interval', 5)
+        stall_timeout = supervisor_config.get('stall_timeout', 120)
+        # long sources are allowed proportionally more time
+        timeout = supervisor_config.get('min_timeout', 300)
+        timeout += job_duration.get() * supervisor_config.get('timeout_factor', 4)
+
+        start_time = last_progress_time = last_check_time = time.monotonic()
+        last_progress = None
+        while True:
+            await asyncio.wait({waiter}, timeout=poll_interval)
+            if waiter.done():
+                return waiter.result()
+
+            now = time.monotonic()
+            if governor.paused:
+                # stopped processes make no progress, and the pause does not count against the timeout
+                start_time += now - last_check_time
+                last_progress_time = last_check_time = now
+                continue
+            last_check_time = now
+            progress = self._get_progress(processes)
+            if progress is None or progress != last_progress:
+                last_progress, last_progress_time = progress, now
+
+            if now - last_progress_time > stall_timeout:
+                reason = f'no progress for {stall_timeout} seconds'
+            elif now - start_time > timeout:
+                reason = f'not finished within {timeout:.0f} seconds'
+            else:
+                continue
+
+            for process in processes:
+                self._kill_group(process)
+            await asyncio.gather(waiter, return_exceptions=True)
+            raise ProcessStalledError(reason)
+
+    @staticmethod
+    def add_output(path):
+        if (outputs := job_outputs.get()) is not None:
+            outputs.add(path)
+
+    @staticmethod
+    def remove_outputs(outputs):
+        # temporary files of a job are written next to its outputs with a _tmp_ prefix
+        for path in outputs:
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            elif os.path.exists(path):
+                os.remove(path)
+
+            dir_path, tmp_prefix = os.path.dirname(path), f'_tmp_{os.path.basename(path)}'
+            if os.path.isdir(dir_path):
+                for file_name in os.listdir(dir_path):
+                    if file_name.startswith(tmp_prefix):
+                        os.remove(os.path.join(dir_path, file_name))
+
+    def get_retries(self):
+        return config.get('supervisor_config', {}).get('retries', 1)
+
+    def report(self):
+        if self.failures:
+            print(f'{len(self.failures)} file(s) failed because of stalled processes:')
+            for file_path, reason in self.failures:
+                print(f'  {file_path}: {reason}')
+
+    @staticmethod
+    def _get_progress(processes):
+        # bytes read and written by every process in the groups, both through files and pipes
+        groups = {process.pid for process in processes if process.returncode is None}
+        if os.path.isdir('/proc'):
+            progress = 0
+            for pid in filter(str.isdigit, os.listdir('/proc')):
+                try:
+                    with open(f'/proc/{pid}/stat', 'r') as stat_file:
+                        stat = stat_file.read()
+                    if int(stat[stat.rindex(')') + 2:].split()[2]) not in groups:
+                        continue
+                    with open(f'/proc/{pid}/io', 'r') as io_file:
+                        for line in io_file:
+                            if line.startswith(('rchar:', 'wchar:')):
+                                progress += int(line.split()[1])
+                except (OSError, ValueError):
+                    continue
+            return progress
+
+        try:
+            import psutil
+        except ModuleNotFoundError:
+            # progress is unknown, only the total timeout applies
+            return None
+
+        progress = 0
+        for pid in groups:
+            try:
+                process = psutil.Process(pid)
+                for child in [process] + process.children(recursive=True):
+                    io_counters = child.io_counters()
+                    progress += io_counters.read_bytes + io_counters.write_bytes
+            except (psutil.Error, AttributeError):
+                continue
+        return progress
+
+    @staticmethod
+    def _kill_group(process):
+        if process.returncode is not None:
+            return
+        try:
+            if os.name == 'nt':
+                os.system(f'taskkill /F /T /PID {process.pid} >NUL 2>&1')
+            else:
+                os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+
+supervisor = Supervisor()
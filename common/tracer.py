@@ -0,0 +1,125 @@
+#  py_album_condense - a simple tool to compress and condense your album collections
+#  Copyright (c) 2022 kewenyu
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#  SOFTWARE.
+
+
+import os
+import json
+import time
+import asyncio
+import weakref
+import functools
+import threading
+import contextlib
+
+
+class TracedSemaphore(asyncio.Semaphore):
+    async def acquire(self):
+        if not self.locked():
+            return await super().acquire()
+        with tracer.span('wait for slot'):
+            return await super().acquire()
+
+
+class Tracer:
+    def __init__(self):
+        self.trace_path = None
+        self.events = []
+        self.lanes = weakref.WeakKeyDictionary()
+        self.thread_lanes = {}
+        self.lane_count = 0
+
+    @property
+    def enabled(self):
+        return self.trace_path is not None
+
+    def setup(self, trace_path):
+        self.trace_path = trace_path
+
+    def create_semaphore(self, value):
+        return TracedSemaphore(value) if self.enabled else asyncio.Semaphore(value)
+
+    @contextlib.contextmanager
+    def span(self, name, **args):
+        if not self.enabled:
+            yield
+            return
+
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            # complete events are appended once the span ends, nothing is written until the run is over
+            self.events.append({
+                'name': name,
+                'ph': 'X',
+                'ts': start // 1000,
+                'dur': (time.perf_counter_ns() - start) // 1000,
+                'pid': os.getpid(),
+                'tid': self._get_lane(),
+                'args': args,
+            })
+
+    def traced(self, name):
+        def decorator(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return await func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    @contextlib.asynccontextmanager
+    async def hold(self, semaphore, name, **args):
+        async with semaphore:
+            with self.span(name, **args):
+                yield
+
+    def save(self):
+        if not self.enabled:
+            return
+
+        # every asyncio task is drawn as its own lane, so that concurrent spans nest properly
+        metadata = [
+            {'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': lane, 'args': {'name': f'task {lane}'}}
+            for lane in sorted({event['tid'] for event in self.events})
+        ]
+        with open(self.trace_path, 'w', encoding='utf-8') as trace_file:
+            json.dump({'traceEvents': metadata + self.events, 'displayTimeUnit': 'ms'}, trace_file)
+        print(f'trace written: {self.trace_path}')
+
+    def _get_lane(self):
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            task = None
+        if task is None:
+            thread = threading.get_ident()
+            if (lane := self.thread_lanes.get(thread)) is None:
+                lane = self.thread_lanes[thread] = -len(self.thread_lanes) - 1
+            return lane
+
+        if (lane := self.lanes.get(task)) is None:
+            self.lane_count += 1
+            lane = self.lanes[task] = self.lane_count
+        return lane
+
+
+tracer = Tracer()
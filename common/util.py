@@ -21,10 +21,14 @@
 
 import os
 
+from common.archive import archive_source
+from common.supervisor import supervisor
+
 
 class PathUtils:
     @staticmethod
     def create_dir_path_struct(file_path, src_path, dst_path):
+        file_path = archive_source.get_extracted_path(file_path)
         file_dir = os.path.dirname(file_path)
         new_file_dir = os.path.join(
             dst_path,
@@ -33,12 +37,15 @@ class PathUtils:
         )
         if not os.path.exists(new_file_dir):
             os.makedirs(new_file_dir)
+        supervisor.add_output(new_file_dir)
         return new_file_dir
 
     @staticmethod
     def create_file_path_struct(file_path, src_path, dst_path, ext):
+        file_path = archive_source.get_extracted_path(file_path)
         new_file_name = os.path.splitext(file_path)[0] + ext
         new_file_path = os.path.join(dst_path, os.path.relpath(new_file_name, src_path))
         if not os.path.exists((dir_path := os.path.dirname(new_file_path))):
             os.makedirs(dir_path)
+        supervisor.add_output(new_file_path)
         return new_file_path
@@ -0,0 +1,48 @@
+#  py_album_condense - a simple tool to compress and condense your album collections
+#  Copyright (c) 2022 kewenyu
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#  SOFTWARE.
+
+
+from common.config import config
+from common.stat_cache import StatCache
+from cue.cue_loader import CueFileLoader
+from cue.cue_parser import CueContentParser
+from cue.cue_sheet import CueSheet
+
+
+class CueCache(StatCache):
+    def __init__(self):
+        super().__init__('cue_config', 'cue_cache.json')
+
+    @property
+    def enabled(self):
+        return config.get('cue_config', {}).get('enable', True)
+
+    def get_sheet(self, cue_path):
+        if not self.enabled:
+            return CueContentParser(CueFileLoader(cue_path).get_content()).get_sheet()
+
+        if (value := self.get(cue_path)) is None:
+            value = CueContentParser(CueFileLoader(cue_path).get_content()).get_sheet().to_dict()
+            self.put(cue_path, value)
+        return CueSheet.from_dict(value)
+
+
+cue_cache = CueCache()
@@ -19,6 +19,11 @@
 #  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 #  SOFTWARE.
 
+import io
+
+from common.archive import archive_source
+
+
 class CueFileLoader:
     def __init__(self, cue_path):
         self.lines = ''
@@ -31,27 +36,41 @@ class CueFileLoader:
     def _load_cue_content(self):
         encodings = [
             'utf-8-sig',
-            'utf-8',
             'shift-jis',
             'gb2312',
             'gbk',
         ]
 
+        with archive_source.open(self.cue_path) as cue_file:
+            raw_content = cue_file.read()
+
+        # legacy encodings are practically never valid utf-8, so the slow charset guess is only needed when it fails
+        try:
+            self.lines = self._split_lines(raw_content.decode('utf-8-sig'))
+            return
+        except UnicodeDecodeError:
+            pass
+
         try:
             import chardet
-            with open(self.cue_path, 'rb') as cue_file:
-                guessed_charset = chardet.detect(cue_file.read())
-                if (guessed_encoding := guessed_charset.get('encoding')) is not None:
-                    encodings.insert(0, guessed_encoding)
+            # the cue commands are plain ascii and tell nothing about the charset, only the text around them does
+            sample = b'\n'.join([line for line in raw_content.splitlines() if not line.isascii()])
+            guessed_charset = chardet.detect(sample)
+            if (guessed_encoding := guessed_charset.get('encoding')) is not None:
+                encodings.insert(0, guessed_encoding)
         except ModuleNotFoundError:
             pass
 
         for encoding in encodings:
             try:
-                with open(self.cue_path, encoding=encoding) as cue_file:
-                    self.lines = cue_file.readlines()
-                    break
-            except UnicodeDecodeError:
+                self.lines = self._split_lines(raw_content.decode(encoding))
+                break
+            except (UnicodeDecodeError, LookupError):
                 continue
         else:
             raise RuntimeError(f'failed to decode cue file {self.cue_path}')
+
+    @staticmethod
+    def _split_lines(content):
+        # universal newlines, the same as reading the file in text mode
+        return io.StringIO(content, newline=None).readlines()
@@ -19,106 +19,82 @@
 #  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 #  SOFTWARE.
 
-import re
+
+from cue.cue_sheet import CueSheet
 
 
 class CueContentParser:
-    def __init__(self, file_name, content):
+    def __init__(self, content):
         self.content = content
-        self.state = 'global'
-        self.global_metadata = {
-            'title': file_name,
-        }
+        self.metadata = {}
+        self.files = []
         self.tracks = []
+        self.handlers = {
+            'REM': self._parse_rem,
+            'PERFORMER': self._parse_text('performer'),
+            'TITLE': self._parse_text('title'),
+            'SONGWRITER': self._parse_text('songwriter'),
+            'CATALOG': self._parse_text('catalog'),
+            'ISRC': self._parse_text('isrc'),
+            'FILE': self._parse_file,
+            'TRACK': self._parse_track,
+            'INDEX': self._parse_index,
+        }
         self._parse_cue_file()
 
-    def get_tracks(self):
-        return self.tracks
+    def get_sheet(self):
+        return CueSheet(self.metadata, self.files, self.tracks)
 
     def _parse_cue_file(self):
-        matchers = {
-            'rem': re.compile(r'\s*REM\s+(.+?)\s+(.+)'),
-            'performer': re.compile(r'\s*PERFORMER\s+(.+)'),
-            'title': re.compile(r'\s*TITLE\s+(.+)'),
-            'songwriter': re.compile(r'\s*SONGWRITER\s+(.+)'),
-            'file': re.compile(r'\s*FILE.+'),
-            'catalog': re.compile(r'\s*CATALOG\s+(.+)'),
-            'isrc': re.compile(r'\s*ISRC\s+(.+)'),
-            'track': re.compile(r'\s*TRACK\s+(\d+?)\s+.+'),
-            'index': re.compile(r'\s*INDEX\s+(\d+?)\s+(.+)'),
-        }
-
+        # every line is split once into its command and arguments, unknown commands such as FLAGS are skipped.
+        # fields may be separated by any whitespace, some rippers write tabs
         for line in self.content:
-            for match, regex in matchers.items():
-                if (group := regex.match(line)) is not None:
-                    handler = getattr(self, f'_{self.state}_{match}', None)
-                    if handler is None:
-                        raise RuntimeError(f'failed to parse cue file: no handler _{self.state}_{match}')
-                    else:
-                        handler(group)
-                        break
-
-    def _global_rem(self, group):
-        self.global_metadata[group.group(1).strip().strip('"').lower()] = group.group(2).strip().strip('"')
-
-    def _global_file(self, _):
-        self.state = 'track'
-
-    def _global_catalog(self, group):
-        self.global_metadata['catalog'] = group.group(1).strip().strip('"')
-
-    def _global_performer(self, group):
-        self.global_metadata['performer'] = group.group(1).strip().strip('"')
-
-    def _global_songwriter(self, group):
-        self.global_metadata['songwriter'] = group.group(1).strip().strip('"')
-
-    def _global_title(self, group):
-        self.global_metadata['album'] = group.group(1).strip().strip('"')
-
-    def _track_performer(self, group):
-        self.tracks[-1].setdefault('metadata', {})['performer'] = group.group(1).strip().strip('"')
-
-    def _track_title(self, group):
-        illegal_chars = r'\/:*?"<>|'
-        title = group.group(1).strip().strip('"')
-        for c in illegal_chars:
-            title = title.replace(c, '_')
-        self.tracks[-1]['title'] = title
-        self.tracks[-1].setdefault('metadata', {})['title'] = group.group(1).strip().strip('"')
-
-    def _track_songwriter(self, group):
-        self.tracks[-1].setdefault('metadata', {})['songwriter'] = group.group(1).strip().strip('"')
-
-    def _track_isrc(self, group):
-        self.tracks[-1].setdefault('metadata', {})['isrc'] = group.group(1).strip().strip('"')
-
-    def _track_rem(self, group):
-        self.tracks[-1].setdefault('metadata', {})[group.group(1).strip().strip('"').lower()] = group.group(
-            2).strip().strip('"')
-
-    def _track_track(self, group):
-        idx = int(group.group(1))
+            command, argument = (line.split(None, 1) + ['', ''])[:2]
+            if (handler := self.handlers.get(command.upper())) is not None:
+                handler(argument.strip())
+
+    @staticmethod
+    def _unquote(value):
+        return value.strip().strip('"')
+
+    def _get_metadata(self):
+        return self.tracks[-1]['metadata'] if self.tracks else self.metadata
+
+    def _parse_rem(self, argument):
+        key, value = (argument.split(None, 1) + [''])[:2]
+        if value.strip():
+            self._get_metadata()[self._unquote(key).lower()] = self._unquote(value)
+
+    def _parse_text(self, key):
+        def handler(argument):
+            # the disc title is the album, while a track title is its own
+            self._get_metadata()[key if key != 'title' or self.tracks else 'album'] = self._unquote(argument)
+        return handler
+
+    def _parse_file(self, argument):
+        if argument.startswith('"'):
+            file_name = argument[1:].partition('"')[0]
+        else:
+            file_name = argument.rsplit(None, 1)[0]
+        self.files.append(file_name)
+
+    def _parse_track(self, argument):
+        idx = int(argument.split()[0])
+        if idx != (track_num := len(self.tracks) + 1):
+            raise RuntimeError(f'inconsistent track number: track_idx: {idx}, track_nums: {track_num}')
         self.tracks.append({
             'idx': idx,
-            'start_time': '',
-            'end_time': '',
-            'metadata': self.global_metadata.copy(),
+            'file': self.files[-1] if self.files else None,
+            'start_frame': 0,
+            'metadata': {},
         })
-        self.tracks[-1]['metadata']['track'] = idx
-        self.tracks[-1]['metadata']['title'] = f"{self.tracks[-1]['metadata']['title']} {idx:02d}"
-        self.tracks[-1]['title'] = self.tracks[-1]['metadata']['title']
 
-        if (track_idx := int(group.group(1))) != (track_num := len(self.tracks)):
-            raise RuntimeError(f'inconsistent track number: track_idx: {track_idx}, track_nums: {track_num}')
-
-    def _track_index(self, group):
-        if group.group(1) != '01':
+    def _parse_index(self, argument):
+        number, timestamp = argument.split()[:2]
+        if int(number) != 1 or not self.tracks:
             return
 
-        minute, second, frame = [int(t) for t in group.group(2).split(':')]
-        timestamp = f'{minute // 60}:{minute % 60:02d}:{second:02d}.{int(frame * (1 / 75) * 1000):03d}'
-
-        self.tracks[-1]['start_time'] = timestamp
-        if len(self.tracks) > 1:
-            self.tracks[-2]['end_time'] = timestamp
+        minute, second, frame = [int(t) for t in timestamp.split(':')]
+        self.tracks[-1]['start_frame'] = (minute * 60 + second) * 75 + frame
+        # a track may start in the file that follows its TRACK line
+        self.tracks[-1]['file'] = self.files[-1] if self.files else None
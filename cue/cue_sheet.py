@@ -0,0 +1,102 @@
+#  py_album_condense - a simple tool to compress and condense your album collections
+#  Copyright (c) 2022 kewenyu
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#  SOFTWARE.
+
+
+import os
+
+
+class CueSheet:
+    def __init__(self, metadata, files, tracks):
+        # the raw parse result, defaults that depend on the audio file are filled in by get_tracks
+        self.metadata = metadata
+        self.files = files
+        self.tracks = tracks
+
+    @classmethod
+    def from_dict(cls, value):
+        return cls(value['metadata'], value['files'], value['tracks'])
+
+    def to_dict(self):
+        return {'metadata': self.metadata, 'files': self.files, 'tracks': self.tracks}
+
+    def get_tracks(self, file_path):
+        file_name = self._get_file_name(file_path)
+        stem = os.path.splitext(os.path.basename(file_path))[0]
+        tracks = [track for track in self.tracks if file_name is None or track['file'] == file_name]
+
+        cue_tracks = []
+        for i, track in enumerate(tracks):
+            metadata = {'title': f'{stem} {track["idx"]:02d}', **self.metadata, 'track': track['idx']}
+            metadata.update(track['metadata'])
+            # a track ends where the next one in the same file starts, the last one runs to the end of the file
+            end_frame = tracks[i + 1]['start_frame'] if i + 1 < len(tracks) else None
+            cue_tracks.append(CueTrack(track['idx'], metadata, track['start_frame'], end_frame))
+        return cue_tracks
+
+    def _get_file_name(self, file_path):
+        if len(self.files) <= 1:
+            return None
+
+        # the referenced name often has the extension of the original rip, e.g. wav for a flac image
+        stem = os.path.splitext(os.path.basename(file_path))[0].lower()
+        for file_name in self.files:
+            if os.path.splitext(os.path.basename(file_name.replace('\\', '/')))[0].lower() == stem:
+                return file_name
+        raise RuntimeError(f'{os.path.basename(file_path)} is not referenced by its cue file')
+
+
+class CueTrack:
+    frames_per_second = 75
+
+    def __init__(self, idx, metadata, start_frame, end_frame=None):
+        self.idx = idx
+        self.metadata = metadata
+        self.start_frame = start_frame
+        self.end_frame = end_frame
+
+    @property
+    def title(self):
+        title = str(self.metadata['title'])
+        for c in r'\/:*?"<>|':
+            title = title.replace(c, '_')
+        return title
+
+    @property
+    def start_time(self):
+        return self.frames_to_timestamp(self.start_frame)
+
+    @property
+    def end_time(self):
+        return self.frames_to_timestamp(self.end_frame) if self.end_frame is not None else None
+
+    @property
+    def start_ms(self):
+        return round(self.start_frame * 1000 / self.frames_per_second)
+
+    @property
+    def end_ms(self):
+        return round(self.end_frame * 1000 / self.frames_per_second) if self.end_frame is not None else None
+
+    @staticmethod
+    def frames_to_timestamp(frames):
+        microseconds = frames * 1000000 // CueTrack.frames_per_second
+        seconds, microseconds = divmod(microseconds, 1000000)
+        return f'{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}.{microseconds:06d}'
@@ -19,11 +19,18 @@
 #  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 #  SOFTWARE.
 
+import os
 import abc
 import asyncio
 
-from image_converter.image_converter import ImageConverter
+from image_converter.image_converter import ImageConverter, image_strategy_cache
+from common.archive import archive_source
+from common.checksum import checksum_cache
 from common.config import config
+from common.deadline import deadline_controller
+from common.supervisor import supervisor
+from common.tracer import tracer
+from common.probe_cache import probe_cache
 from common.util import PathUtils
 
 
@@ -32,17 +39,99 @@ class FFMPEGImageConverter(ImageConverter, metaclass=abc.ABCMeta):
         super().__init__(semaphore, file_path, src_path, dst_path)
 
     async def convert(self):
-        async with self.semaphore:
+        if config.get('image_optimize_config', {}).get('enable', False):
+            await self._optimized_convert()
+            return
+
+        async with tracer.hold(self.semaphore, 'convert image', file=self.file_path):
             print(f'converting to {self._get_format_name()}: {self.file_path}')
 
             new_file_path = PathUtils.create_file_path_struct(
                 self.file_path, self.src_path, self.dst_path, self._get_ext()
             )
             ffmpeg_path = config.get('executable', {}).get('ffmpeg', 'ffmpeg')
-            cmd = f'"{ffmpeg_path}" -y -i "{self.file_path}" {self._get_parameter()} "{new_file_path}"'
-
-            process = await asyncio.create_subprocess_shell(cmd, stderr=asyncio.subprocess.DEVNULL)
-            await process.communicate()
+            cmd = f'"{ffmpeg_path}" -y {await self._get_thread_args()} -i "{self.input_path}" {self._get_filter_args()}'
+            cmd += f' {self._get_parameter()} "{new_file_path}"'
+
+            process = await supervisor.create_subprocess_shell(cmd, stderr=asyncio.subprocess.DEVNULL)
+            await supervisor.wait([process])
+
+    async def _optimized_convert(self):
+        new_file_path = PathUtils.create_file_path_struct(self.file_path, self.src_path, self.dst_path, self._get_ext())
+        strategies = image_strategy_cache.get(self.file_path) or {}
+        candidates = self._get_candidates()
+        if (winner := strategies.get(self.__class__.__name__)) == 'copy':
+            candidates = {}
+        elif winner in candidates:
+            candidates = {winner: candidates[winner]}
+
+        tmp_file_prefix = os.path.join(os.path.dirname(new_file_path), f'_tmp_{os.path.basename(new_file_path)}')
+        tmp_file_paths = {name: f'{tmp_file_prefix}.{name}{self._get_ext()}' for name in candidates}
+        input_args = f'{await self._get_thread_args()} -i "{self.input_path}" {self._get_filter_args()}'
+
+        async def candidate_task(name, parameter):
+            async with tracer.hold(self.semaphore, 'convert candidate', file=self.file_path):
+                print(f'converting to {self._get_format_name()} ({name}): {self.file_path}')
+                ffmpeg_path = config.get('executable', {}).get('ffmpeg', 'ffmpeg')
+                cmd = f'"{ffmpeg_path}" -y {input_args} {parameter} "{tmp_file_paths[name]}"'
+                process = await supervisor.create_subprocess_shell(cmd, stderr=asyncio.subprocess.DEVNULL)
+                await supervisor.wait([process])
+
+        await asyncio.gather(*[candidate_task(name, parameter) for name, parameter in candidates.items()])
+
+        sizes = {
+            name: size for name, path in tmp_file_paths.items()
+            if os.path.exists(path) and (size := os.path.getsize(path)) > 0
+        }
+        winner = min(sizes, key=sizes.get, default=None)
+        # the original is kept whenever no candidate is smaller, so the destination never grows
+        if winner is None or sizes[winner] >= archive_source.get_size(self.file_path):
+            winner = 'copy'
+            copy_file_path = PathUtils.create_file_path_struct(
+                self.file_path, self.src_path, self.dst_path, os.path.splitext(self.file_path)[1]
+            )
+            print(f'keeping original: {self.file_path}')
+            await asyncio.get_running_loop().run_in_executor(None, self._copy_source, copy_file_path)
+        else:
+            os.replace(tmp_file_paths[winner], new_file_path)
+
+        for path in tmp_file_paths.values():
+            if os.path.exists(path):
+                os.remove(path)
+
+        # re-read, other formats of the same source may have finished in the meantime
+        strategies = image_strategy_cache.get(self.file_path) or {}
+        strategies[self.__class__.__name__] = winner
+        image_strategy_cache.put(self.file_path, strategies)
+
+    def _copy_source(self, copy_file_path):
+        with archive_source.open(self.file_path) as src_file:
+            checksum_cache.copy(src_file, copy_file_path)
+
+    def _get_candidates(self):
+        return {'default': self._get_parameter()}
+
+    async def _get_thread_args(self):
+        scan_config = config.get('scan_config', {})
+        if not (threads := scan_config.get('threads', 0)):
+            return ''
+
+        info = await probe_cache.get_info(self.file_path)
+        if info['width'] * info['height'] < scan_config.get('huge_image_pixels', 40000000):
+            return ''
+        # huge scans are the long tail of a run, let decoding and scaling use several cores
+        return f'-threads {threads} -filter_threads {threads}'
+
+    def _get_filter_args(self):
+        return ''
+
+    @staticmethod
+    def _get_scale_filter_args():
+        if not (max_dimension := config.get('scan_config', {}).get('max_dimension', 0)):
+            return ''
+        # only ever shrinks, keeping the aspect ratio
+        scale_filter = f"scale='min({max_dimension},iw)':'min({max_dimension},ih)'"
+        return f'-vf "{scale_filter}:force_original_aspect_ratio=decrease:flags=lanczos"'
 
     @abc.abstractmethod
     def _get_ext(self):
@@ -61,6 +150,9 @@ class WebpConverter(FFMPEGImageConverter):
     def __init__(self, semaphore, file_path, src_path, dst_path):
         super().__init__(semaphore, file_path, src_path, dst_path)
 
+    def _get_filter_args(self):
+        return self._get_scale_filter_args()
+
     def _get_ext(self):
         return '.webp'
 
@@ -71,11 +163,21 @@ class WebpConverter(FFMPEGImageConverter):
         quality = config.get('webp_config', {}).get('quality', 78)
         return f'-quality {quality}'
 
+    def _get_candidates(self):
+        return {
+            'default': self._get_parameter(),
+            'drawing': f'{self._get_parameter()} -preset drawing',
+            'text': f'{self._get_parameter()} -preset text',
+        }
+
 
 class JPEGConverter(FFMPEGImageConverter):
     def __init__(self, semaphore, file_path, src_path, dst_path):
         super().__init__(semaphore, file_path, src_path, dst_path)
 
+    def _get_filter_args(self):
+        return self._get_scale_filter_args()
+
     def _get_ext(self):
         return '.jpg'
 
@@ -100,6 +202,13 @@ class WebpLosslessConverter(FFMPEGImageConverter):
     def _get_parameter(self):
         return f'-lossless 1'
 
+    def _get_candidates(self):
+        return {
+            'default': self._get_parameter(),
+            'level6': f'{self._get_parameter()} -compression_level 6',
+            'drawing': f'{self._get_parameter()} -compression_level 6 -preset drawing',
+        }
+
 
 class PNGConverter(FFMPEGImageConverter):
     def __init__(self, semaphore, file_path, src_path, dst_path):
@@ -112,5 +221,15 @@ class PNGConverter(FFMPEGImageConverter):
         return 'PNG'
 
     def _get_parameter(self):
-        compression_level = config.get('png_config', {}).get('compression_level', 100)
+        # ffmpeg clamps the png level to the zlib range, so the deadline ladder starts from the effective level
+        compression_level = deadline_controller.get_effort(
+            'png', min(config.get('png_config', {}).get('compression_level', 100), 9)
+        )
         return f'-compression_level {compression_level}'
+
+    def _get_candidates(self):
+        return {
+            'default': self._get_parameter(),
+            'paeth': f'{self._get_parameter()} -pred paeth',
+            'mixed': f'{self._get_parameter()} -pred mixed',
+        }
@@ -21,6 +21,9 @@
 
 import abc
 
+from common.archive import archive_source
+from common.stat_cache import StatCache
+
 
 class ImageConverter(metaclass=abc.ABCMeta):
     def __init__(self, semaphore, file_path, src_path, dst_path):
@@ -29,6 +32,13 @@ class ImageConverter(metaclass=abc.ABCMeta):
         self.src_path = src_path
         self.dst_path = dst_path
 
+    @property
+    def input_path(self):
+        return archive_source.get_input(self.file_path)
+
     @abc.abstractmethod
     async def convert(self):
         raise NotImplemented
+
+
+image_strategy_cache = StatCache('image_optimize_config', 'image_strategy_cache.json')
@@ -0,0 +1,94 @@
+#  py_album_condense - a simple tool to compress and condense your album collections
+#  Copyright (c) 2022 kewenyu
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#  SOFTWARE.
+
+
+import asyncio
+import os
+import shutil
+import subprocess
+
+import pytest
+
+from audio_converter.audio_converter import AudioUtils
+from common.action import audio_codec_handlers, lossless_audio_codec_handlers
+from common.config import config
+
+# the stream a joinable codec is encoded to, ffmpeg's alac encoder stands in for qaac
+join_formats = {
+    'alac': ('.m4a', '-c:a alac'),
+}
+
+
+def test_every_joinable_codec_has_a_join_test():
+    handlers = {**audio_codec_handlers, **lossless_audio_codec_handlers}
+    joinable = {codec for codec, handler in handlers.items() if handler(None, 'a.wav', '.', '.').is_chunk_joinable()}
+    assert joinable == set(join_formats)
+
+
+def test_failed_join_keeps_segments(tmp_path, monkeypatch):
+    monkeypatch.setitem(config, 'executable', {**config.get('executable', {}), 'ffmpeg': 'false'})
+    segment_paths = [str(tmp_path / f'_tmp_a.m4a.part{i:03d}.m4a') for i in range(2)]
+    for segment_path in segment_paths:
+        open(segment_path, 'wb').close()
+
+    returncode = asyncio.run(AudioUtils.concat_by_ffmpeg(segment_paths, 'a.wav', str(tmp_path / 'a.m4a')))
+
+    assert returncode != 0
+    assert all(os.path.exists(segment_path) for segment_path in segment_paths)
+
+
+def decode(file_path):
+    return subprocess.run(
+        ['ffmpeg', '-v', 'error', '-i', file_path, '-map', '0:a', '-f', 's16le', '-'],
+        check=True, capture_output=True,
+    ).stdout
+
+
+@pytest.mark.skipif(shutil.which('ffmpeg') is None, reason='needs ffmpeg')
+@pytest.mark.parametrize('codec', sorted(join_formats))
+def test_join_is_sample_exact(tmp_path, codec):
+    ext, encoder_args = join_formats[codec]
+    src_path = str(tmp_path / 'src.wav')
+    subprocess.run(
+        ['ffmpeg', '-v', 'error', '-f', 'lavfi', '-i', 'sine=frequency=997:sample_rate=44100:duration=3',
+         '-ac', '2', '-c:a', 'pcm_s16le', src_path],
+        check=True,
+    )
+
+    # odd segment lengths, so that every segment ends in a partial frame
+    sample_boundaries = [0, 44101, 90007, None]
+    segment_paths = []
+    for i in range(len(sample_boundaries) - 1):
+        trim_filter = f'atrim=start_sample={sample_boundaries[i]}'
+        if sample_boundaries[i + 1] is not None:
+            trim_filter += f':end_sample={sample_boundaries[i + 1]}'
+        segment_paths.append(str(tmp_path / f'_tmp_dst{ext}.part{i:03d}{ext}'))
+        subprocess.run(
+            ['ffmpeg', '-v', 'error', '-i', src_path, '-af', trim_filter, *encoder_args.split(), segment_paths[-1]],
+            check=True,
+        )
+
+    new_file_path = str(tmp_path / f'dst{ext}')
+    returncode = asyncio.run(AudioUtils.concat_by_ffmpeg(segment_paths, src_path, new_file_path))
+
+    assert returncode == 0
+    assert decode(new_file_path) == decode(src_path)
+    assert not any(os.path.exists(segment_path) for segment_path in segment_paths)
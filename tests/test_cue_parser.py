@@ -0,0 +1,60 @@
+#  py_album_condense - a simple tool to compress and condense your album collections
+#  Copyright (c) 2022 kewenyu
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#  SOFTWARE.
+
+
+from cue.cue_parser import CueContentParser
+
+
+def parse(content):
+    return CueContentParser(content.splitlines()).get_sheet()
+
+
+def test_tab_separated_sheet():
+    sheet = parse(
+        'REM\tDATE\t1999\n'
+        'PERFORMER\t"Artist"\n'
+        'TITLE\t"Album"\n'
+        'FILE\t"image.wav"\tWAVE\n'
+        '\tTRACK\t01\tAUDIO\n'
+        '\t\tTITLE\t"First"\n'
+        '\t\tINDEX\t01\t00:00:00\n'
+        '\tTRACK\t02\tAUDIO\n'
+        '\t\tTITLE\t"Second"\n'
+        '\t\tINDEX\t00\t03:00:00\n'
+        '\t\tINDEX\t01\t03:02:10\n'
+    )
+
+    assert sheet.metadata == {'date': '1999', 'performer': 'Artist', 'album': 'Album'}
+    assert sheet.files == ['image.wav']
+    assert [track['metadata']['title'] for track in sheet.tracks] == ['First', 'Second']
+    assert [track['start_frame'] for track in sheet.tracks] == [0, (3 * 60 + 2) * 75 + 10]
+
+
+def test_space_and_tab_separated_sheets_agree():
+    content = (
+        'FILE "disc one.flac" WAVE\n'
+        '  TRACK 01 AUDIO\n'
+        '    INDEX 01 00:00:00\n'
+        '  TRACK 02 AUDIO\n'
+        '    INDEX 01 04:10:33\n'
+    )
+
+    assert parse(content).to_dict() == parse(content.replace(' ', '\t').replace('disc\tone', 'disc one')).to_dict()